@@ -0,0 +1,65 @@
+#!/bin/env python
+# -*- coding: utf8 -*-
+
+""" Benchmarks the download/decompress/write step of the EC2 upload process
+    on a set of utility instance types and block sizes, and records the
+    throughput and cost per image of each. The upload process uses the
+    recorded results to pick the utility instance type for each region. """
+
+import argparse
+import logging
+import logging.config
+import multiprocessing.pool
+
+import fedmsg.config
+
+import fedimg
+import fedimg.benchmark
+from fedimg.services.ec2 import EC2Service
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'url', help="URL of the .raw.xz image to write")
+    parser.add_argument(
+        '-r', '--region', action='append', dest='regions',
+        help="Region to benchmark in.  May be given more than once.  "
+        "Default: every region with a utility AMI")
+    parser.add_argument(
+        '-s', '--sizes', default=fedimg.AWS_BENCHMARK_SIZES, nargs='+',
+        help="Instance types to try")
+    parser.add_argument(
+        '-b', '--block-sizes', default=fedimg.AWS_BENCHMARK_BLOCK_SIZES,
+        nargs='+', help="dd block sizes to try")
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help="Print the results without recording them")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.config.dictConfig(fedmsg.config.load_config()['logging'])
+    log = logging.getLogger('fedmsg')
+
+    service = EC2Service(args.url)
+    regions = args.regions or [a['region'] for a in service.util_amis]
+
+    # Regions are benchmarked at the same time, each with its own service
+    pool = multiprocessing.pool.ThreadPool(processes=len(regions))
+    runs = pool.map(
+        lambda region: EC2Service(args.url).benchmark(
+            region, args.sizes, args.block_sizes),
+        regions)
+    results = [r for run in runs for r in run]
+
+    for r in results:
+        print '{0:15} {1:12} {2:5} {3:8.1f} MB/s {4:>10}'.format(
+            r['region'], r['size'], r['block_size'], r['mbps'],
+            '${0:.4f}'.format(r['cost']) if r['cost'] is not None else '?')
+
+    if not args.dry_run:
+        fedimg.benchmark.record_results(results)
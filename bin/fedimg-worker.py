@@ -0,0 +1,52 @@
+#!/bin/env python
+# -*- coding: utf8 -*-
+
+""" Runs upload jobs taken off the job queue (the `queue` option, or
+    --queue). Start as many workers, on as many hosts, as there are jobs to
+    run. A worker stops on SIGTERM or SIGINT, handing back the jobs it
+    couldn't finish in time. """
+
+import argparse
+import logging
+import logging.config
+import signal
+
+import fedmsg.config
+
+import fedimg
+import fedimg.jobqueue
+import fedimg.ledger
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--queue', default=fedimg.QUEUE,
+                    help='job queue: an SQLite database or a redis:// URL '
+                         '(default: %(default)s)')
+parser.add_argument('--name',
+                    help='name of the worker in the queue '
+                         '(default: host:pid)')
+parser.add_argument('--dead', action='store_true',
+                    help='only list the jobs that were tried too many times')
+args = parser.parse_args()
+if not args.queue:
+    parser.error('no job queue given')
+
+logging.config.dictConfig(fedmsg.config.load_config()['logging'])
+log = logging.getLogger('fedmsg')
+
+queue = fedimg.jobqueue.open_queue(args.queue)
+
+if args.dead:
+    for id, label in queue.dead():
+        print '{0}\t{1}'.format(id, label)
+else:
+    # Destroy what an earlier worker on this host left running
+    ledger = fedimg.ledger.get_ledger()
+    if ledger is not None:
+        fedimg.ledger.reclaim(ledger)
+
+    worker = fedimg.jobqueue.Worker(queue, name=args.name)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: worker.stop())
+    worker.run()
+    log.info('Worker {0} stopping'.format(worker.name))
+    worker.drain()
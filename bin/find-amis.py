@@ -0,0 +1,64 @@
+#!/bin/env python
+# -*- coding: utf8 -*-
+
+""" Looks up AMIs registered by Fedimg in its local catalog. """
+
+from __future__ import print_function
+
+import argparse
+import datetime
+
+import fedimg
+import fedimg.catalog
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b', '--build',
+        help="Exact build name (ex. Fedora-Cloud-Base-25-1.3.x86_64)")
+    parser.add_argument(
+        '-l', '--latest', metavar='PREFIX',
+        help="Only show the newest AMI whose build starts with PREFIX "
+        "(ex. Fedora-Cloud-Base-25).  Requires all of --region, "
+        "--virt-type and --vol-type")
+    parser.add_argument(
+        '-r', '--region', help="Region (ex. eu-west-1)")
+    parser.add_argument(
+        '--virt-type', choices=['hvm', 'paravirtual'])
+    parser.add_argument(
+        '--vol-type', choices=['standard', 'gp2'])
+    parser.add_argument(
+        '-c', '--compose', help="Compose ID")
+    parser.add_argument(
+        '--catalog', default=fedimg.CATALOG,
+        help="Catalog database.  Default: %(default)s")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    catalog = fedimg.catalog.Catalog(args.catalog)
+
+    if args.latest:
+        if not (args.region and args.virt_type and args.vol_type):
+            raise SystemExit("--latest needs --region, --virt-type and "
+                             "--vol-type")
+        ami = catalog.latest(args.latest, args.region, args.virt_type,
+                             args.vol_type)
+        amis = [ami] if ami else []
+    else:
+        amis = catalog.find(build=args.build, region=args.region,
+                            virt_type=args.virt_type, vol_type=args.vol_type,
+                            compose_id=args.compose)
+
+    for ami in amis:
+        print(
+            ami['build'].ljust(45),
+            ami['region'].ljust(16),
+            ami['id'].ljust(15),
+            (ami['virt_type'] or '').ljust(13),
+            (ami['vol_type'] or '').ljust(10),
+            datetime.datetime.utcfromtimestamp(ami['created']).isoformat(),
+        )
@@ -1,38 +1,40 @@
 #!/bin/env python
 # -*- coding: utf8 -*-
 
+""" Destroys the nodes, volumes and snapshots that failed Fedimg upload jobs
+    left behind, in every region Fedimg uses. Only resources tagged by
+    Fedimg that are older than two hours (or --max-age seconds) are
+    touched. """
+
+import argparse
 import logging
 logging.basicConfig()
 
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
-import datetime
 import fedimg
+import fedimg.reaper
 
-EC2_ACCESS_ID = fedimg.AWS_ACCESS_ID
-EC2_SECRET_KEY = fedimg.AWS_SECRET_KEY
 
-def kill_all_instances(region):
-    """
-    Kills all the instances which are running for 2 hours or more.
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--max-age', default=fedimg.AWS_REAP_MAX_AGE, type=int,
+        help="Minimum age in seconds of the resources to destroy.  "
+        "Default: %(default)s")
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help="Only list what would be destroyed")
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help="Produce lots of output")
 
-    :param region: AWS region
-    """
-    cls = get_driver(region)
-    driver = cls(EC2_ACCESS_ID, EC2_SECRET_KEY)
-    nodes = driver.list_nodes()
-    for n in nodes:
-        d1 = datetime.datetime.strptime(n.extra['launch_time'], '%Y-%m-%dT%H:%M:%S.000Z')
-        d2 =  datetime.datetime.utcnow()
-        delta = d2 - d1
-        if delta.total_seconds() > 7200: # If more than 2 hours of up time.
-            n.destroy()
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    regions = [Provider.EC2_AP_NORTHEAST, Provider.EC2_AP_SOUTHEAST,
-                Provider.EC2_AP_SOUTHEAST2, Provider.EC2_EU_WEST,
-                Provider.EC2_SA_EAST, Provider.EC2_US_EAST,
-                Provider.EC2_US_WEST, Provider.EC2_US_WEST_OREGON]
-    for region in regions:
-        kill_all_instances(region)
+    args = parse_args()
+    if args.verbose or args.dry_run:
+        logging.getLogger('fedmsg').setLevel(logging.INFO)
+
+    reaper = fedimg.reaper.Reaper(max_age=args.max_age, dry_run=args.dry_run)
+    for region, kind, resource_id in reaper.reap():
+        print region.ljust(20), kind.ljust(10), resource_id
@@ -1,6 +1,10 @@
 #!/usr/bin/python
 """ List the AMIs uploaded by fedimg in the last N days.
 
+Messages already seen are cached locally (by default in
+~/.cache/fedimg/list-the-amis.json), so later runs only fetch what's newer
+than the cache.  Pages are fetched concurrently.
+
 Deps:  $ sudo dnf install python-requests
 
 Author:     Ralph Bean <rbean@redhat.com>
@@ -11,9 +15,11 @@ from __future__ import print_function
 
 import argparse
 import collections
-import datetime
-import functools
+import json
 import logging
+import multiprocessing.pool
+import os
+import time
 
 import requests
 
@@ -22,18 +28,75 @@ log = logging.getLogger()
 base_url = 'https://apps.fedoraproject.org/datagrepper/raw'
 topic = "org.fedoraproject.prod.fedimg.image.upload"
 
+default_cache = os.path.expanduser('~/.cache/fedimg/list-the-amis.json')
+
+# Number of pages fetched at once, which is also the size of the session's
+# connection pool.
+concurrency = 8
+
+# Messages can show up in datagrepper a while after they were sent, so the
+# last hour the cache covers is always fetched again.
+late_slack = 60 * 60
 
-def get_page(page, pages, delta):
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=concurrency))
+
+
+def get_page(page, start, end):
     """ Retrieve the JSON for a particular page of datagrepper results """
-    log.debug("Getting page %i of %s", page, pages)
-    response = requests.get(base_url, params=dict(
+    log.debug("Getting page %i of %s to %s", page, start, end)
+    response = session.get(base_url, params=dict(
         topic=topic,
-        delta=delta,
+        start=start,
+        end=end,
         page=page,
+        rows_per_page=100,
     ))
+    response.raise_for_status()
     return response.json()
 
 
+def get_range(start, end):
+    """ Returns all messages between the `start` and `end` timestamps.
+    The first page tells how many there are; the rest are then fetched
+    concurrently. """
+    data = get_page(1, start, end)
+    messages = data['raw_messages']
+
+    pages = range(2, data['pages'] + 1)
+    if pages:
+        pool = multiprocessing.pool.ThreadPool(
+            processes=min(concurrency, len(pages)))
+        try:
+            results = pool.map(lambda page: get_page(page, start, end), pages)
+        finally:
+            pool.close()
+        for data in results:
+            messages.extend(data['raw_messages'])
+
+    return messages
+
+
+def load_cache(path):
+    """ Returns the cache as a dict with the messages (keyed by msg_id), the
+    time from which they are complete, and the timestamp of the newest. """
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'messages': {}, 'start': None, 'end': None}
+
+
+def save_cache(path, cache):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp, path)
+
+
 def desirable(msg, args):
     if not msg['msg']['status'] == 'completed':
         return False
@@ -44,26 +107,56 @@ def desirable(msg, args):
     return True
 
 
-def get_messages(args):
-    """ Generator that yields messages from datagrepper """
+def missing_ranges(cache, start, end):
+    """ Returns the (start, end) ranges of the window from `start` to `end`
+    that have to be fetched, as the cache doesn't cover them. """
+    if cache['start'] is None or cache['end'] is None:
+        return [(start, end)]
+    # Late messages can still turn up just before the newest one seen
+    cached_end = cache['end'] - late_slack
+    if end <= cache['start'] or start >= cached_end:
+        return [(start, end)]
 
-    delta = int(datetime.timedelta(days=args.days).total_seconds())
+    ranges = []
+    if start < cache['start']:
+        ranges.append((start, cache['start']))
+    ranges.append((max(start, cached_end), end))
+    return ranges
 
-    # Get the first page
-    data = get_page(1, 'unknown', delta)
-    for message in data['raw_messages']:
-        if desirable(message, args):
-            yield message
 
-    more = functools.partial(get_page, pages=data['pages'], delta=delta)
+def update_cache(cache, start, messages):
+    """ Adds `messages`, fetched for the window from `start` on, to the
+    cache, dropping those older than the window. """
+    for message in messages:
+        cache['messages'][message['msg_id']] = message
+    cache['messages'] = dict(
+        (msg_id, message) for msg_id, message in cache['messages'].items()
+        if message['timestamp'] >= start)
+    cache['start'] = start
+    # Nothing newer than the newest message is known to be complete
+    cache['end'] = max([m['timestamp'] for m in cache['messages'].values()]
+                       or [start])
+
 
-    # Get all subsequent pages (if there are any...)
-    for page in range(1, data['pages']):
-        data = more(page + 1)
+def get_messages(args):
+    """ Returns the messages from the last `args.days` days, newest first,
+    fetching only the parts of that window the cache doesn't cover. """
 
-        for message in data['raw_messages']:
-            if desirable(message, args):
-                yield message
+    end = time.time()
+    start = end - args.days * 24 * 60 * 60
+
+    cache = load_cache(args.cache)
+    fetched = []
+    for range_start, range_end in missing_ranges(cache, start, end):
+        fetched.extend(get_range(range_start, range_end))
+    update_cache(cache, start, fetched)
+
+    if args.cache:
+        save_cache(args.cache, cache)
+
+    messages = [m for m in cache['messages'].values()
+                if m['timestamp'] >= start and desirable(m, args)]
+    return sorted(messages, key=lambda m: m['timestamp'], reverse=True)
 
 
 def parse_args():
@@ -74,6 +167,12 @@ def parse_args():
     parser.add_argument(
         '-r', '--rawhide', action='store_true',
         help="Show rawhide instead of the branched (pre-)release")
+    parser.add_argument(
+        '-c', '--cache', default=default_cache,
+        help="Where to cache messages.  Default: %(default)s")
+    parser.add_argument(
+        '--no-cache', action='store_const', const=None, dest='cache',
+        help="Don't use or update the cache")
     parser.add_argument(
         '-v', '--verbose', action='store_true',
         help="Produce lots of output")
@@ -1,32 +1,47 @@
 #!/bin/env python
 # -*- coding: utf8 -*-
 
-""" Triggers an upload process with the specified raw.xz URL. Useful for
-    manually triggering Fedimg jobs. """
+""" Triggers an upload process with the specified raw.xz URLs, or those of a
+    compose. Useful for manually triggering Fedimg jobs. With --plan, only
+    prints what the upload process would do. """
 
+import argparse
 import logging
 import logging.config
-import multiprocessing.pool
-import sys
 
 import fedmsg
 import fedmsg.config
 
 import fedimg
-import fedimg.services
-from fedimg.services.ec2 import EC2Service, EC2ServiceException
+import fedimg.compose
+import fedimg.planner
 import fedimg.uploader
-from fedimg.util import virt_types_from_url
-
-if len(sys.argv) != 2:
-    print 'Usage: trigger_upload.py <rawxz_image_url>'
-    sys.exit(1)
+from fedimg.util import get_rawxz_urls
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('urls', nargs='*', metavar='rawxz_image_url')
+parser.add_argument('--compose', metavar='LOCATION',
+                    help='upload the images of the compose at LOCATION')
+parser.add_argument('--plan', action='store_true',
+                    help='only print the jobs, API calls and time the '
+                         'upload would take')
+parser.add_argument('--traces', metavar='DIR',
+                    help='estimate stage durations from the traces in DIR '
+                         '(default: the trace_dir option)')
+args = parser.parse_args()
+if not args.urls and not args.compose:
+    parser.error('no image URL or compose given')
 
 logging.config.dictConfig(fedmsg.config.load_config()['logging'])
 log = logging.getLogger('fedmsg')
 
-upload_pool = multiprocessing.pool.ThreadPool(processes=4)
-
-url = sys.argv[1]
+urls = list(args.urls)
+if args.compose:
+    images = fedimg.compose.get_images(args.compose)
+    urls.extend(get_rawxz_urls(args.compose, images))
 
-fedimg.uploader.upload(upload_pool, [url])
+if args.plan:
+    durations = fedimg.planner.Durations.load(args.traces)
+    print fedimg.planner.format_plan(fedimg.uploader.plan(urls, durations))
+else:
+    fedimg.uploader.upload(urls, None)
@@ -27,9 +27,75 @@ import ConfigParser
 config = ConfigParser.RawConfigParser()
 config.read('/etc/fedimg.cfg')
 
+
+def _get(section, option, default=None):
+    """ Returns the value of an optional config option, or `default` if the
+    option isn't set. """
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+
+def _getboolean(section, option, default=False):
+    """ Returns the value of an optional boolean config option, or `default`
+    if the option isn't set. """
+    if config.has_option(section, option):
+        return config.getboolean(section, option)
+    return default
+
+
 CLEAN_UP_ON_FAILURE = config.get('general', 'clean_up_on_failure')
 DELETE_IMAGES_ON_FAILURE = config.get('general', 'delete_images_on_failure')
 
+# Upload providers (see fedimg.services) run for every image
+PROVIDERS = _get('general', 'providers', 'ec2 ftp').split()
+# Number of upload jobs each provider may run at the same time, from the
+# `concurrency` option of the provider's own section
+PROVIDER_CONCURRENCY = dict(
+    (name, int(_get(name, 'concurrency', 4 if name == 'ec2' else 2)))
+    for name in PROVIDERS)
+# What happens to the jobs for a build of an image when jobs for a newer
+# build of it come in: 'cancel' them, cancel only those still 'queued', or
+# 'none'.
+SUPERSEDE = _get('general', 'supersede', 'none')
+
+# SQLite database that completed uploads are recorded in. Empty to disable.
+CATALOG = _get('general', 'catalog', '/var/lib/fedimg/catalog.db')
+
+# SQLite database of the instances and volumes running jobs created, and of
+# the jobs handed off at shutdown (see fedimg.ledger). Empty to disable.
+LEDGER = _get('general', 'ledger', '/var/lib/fedimg/ledger.db')
+# Seconds that running jobs get to finish when the consumer stops, before
+# they're cancelled and handed off to the next start
+SHUTDOWN_GRACE = int(_get('general', 'shutdown_grace', 60))
+
+# Job queue that workers on other hosts take upload jobs from, instead of
+# the consumer running them (see fedimg.jobqueue): the path of an SQLite
+# database or a redis:// URL. Empty to run jobs in the consumer. Workers
+# hold a job for `queue_lease` seconds at a time, and a job is tried at most
+# `queue_attempts` times. Jobs given up on are kept for `queue_retention`
+# seconds; 0 keeps them.
+QUEUE = _get('general', 'queue', '')
+QUEUE_LEASE = int(_get('general', 'queue_lease', 300))
+QUEUE_ATTEMPTS = int(_get('general', 'queue_attempts', 3))
+QUEUE_RETENTION = int(_get('general', 'queue_retention', 604800))
+
+# Directory that a Chrome trace of each compose's upload jobs is written to
+# (see fedimg.trace). Empty to disable.
+TRACE_DIR = _get('general', 'trace_dir', '')
+
+# Signal that starts and stops the sampling profiler in the consumer (see
+# fedimg.profiler), where its samples are written, and how often it samples,
+# in seconds. An empty signal disables the profiler.
+PROFILE_SIGNAL = _get('general', 'profile_signal', 'SIGUSR2')
+PROFILE_DIR = _get('general', 'profile_dir', '/var/tmp/fedimg')
+PROFILE_INTERVAL = float(_get('general', 'profile_interval', 0.01))
+
+# Variant/arch subsets (like "CloudImages/x86_64", or "Cloud/*" for every
+# arch) and file formats of the images in a compose that get uploaded
+COMPOSE_IMAGES = _get('general', 'compose_images', 'CloudImages/x86_64')
+COMPOSE_FORMATS = _get('general', 'compose_formats', 'raw.xz').split()
+
 # koji_server is the location of the Koji hub that should be used
 # to initialize the Koji connection.
 KOJI_SERVER = config.get('koji', 'server')
@@ -37,6 +103,17 @@ KOJI_SERVER = config.get('koji', 'server')
 # The two slashes ("//") in the following URL are NOT a mistake.
 BASE_KOJI_TASK_URL = config.get('koji', 'base_task_url')
 
+# With early intake, images matching EARLY_INTAKE_PATTERNS are uploaded as
+# soon as the Koji task that built them completes, rather than once the
+# whole compose has finished.
+EARLY_INTAKE = _getboolean('general', 'early_intake')
+EARLY_INTAKE_PATTERNS = _get(
+    'general', 'early_intake_patterns',
+    'Fedora-Cloud-Base-*.x86_64.raw.xz Fedora-Atomic-*.x86_64.raw.xz').split()
+# Seconds an image uploaded early is waited for in a compose before it's
+# forgotten
+EARLY_INTAKE_MAX_AGE = int(_get('general', 'early_intake_max_age', 259200))
+
 # AMAZON WEB SERVICES (EC2)
 AWS_UTIL_USER = config.get('aws', 'util_username')
 AWS_TEST_USER = config.get('aws', 'test_username')
@@ -50,18 +127,92 @@ AWS_TEST_VOL_SIZE = config.get('aws', 'test_volume_size')
 AWS_TEST = config.get('aws', 'test')
 AWS_AMIS = config.get('aws', 'amis')
 AWS_IAM_PROFILE = config.get('aws', 'iam_profile')
+# Number of AMI boot tests that may run at the same time, across all jobs.
+AWS_TEST_CONCURRENCY = int(_get('aws', 'test_concurrency', 8))
+# Number of destination regions in which a copied AMI is boot tested
+# before being made public. 0 only tests in the origin region.
+AWS_REGIONAL_TESTS = int(_get('aws', 'regional_tests', 0))
+# Ask for spot capacity for utility and test nodes, falling back to on-demand
+# nodes if none can be had within AWS_SPOT_DEADLINE seconds.
+AWS_SPOT = _getboolean('aws', 'spot')
+AWS_SPOT_MAX_PRICE = _get('aws', 'spot_max_price')
+AWS_SPOT_DEADLINE = int(_get('aws', 'spot_deadline', 300))
+# Number of times a stage is restarted on spot capacity after an interruption
+# before it's retried on-demand.
+AWS_SPOT_RESTARTS = int(_get('aws', 'spot_restarts', 2))
+# Utility node type used in regions without benchmark results, the file
+# benchmark results are recorded in, and whether the best benchmarked type
+# is the fastest ('speed') or the cheapest per image ('cost').
+AWS_UTIL_SIZE = _get('aws', 'util_size', 'm1.xlarge')
+AWS_BENCHMARK_RESULTS = _get('aws', 'benchmark_results',
+                             '/var/lib/fedimg/benchmarks.json')
+AWS_UTIL_OBJECTIVE = _get('aws', 'util_objective', 'speed')
+# Candidates tried by benchmark runs
+AWS_BENCHMARK_SIZES = _get('aws', 'benchmark_sizes',
+                           'm1.xlarge m4.xlarge c4.xlarge').split()
+AWS_BENCHMARK_BLOCK_SIZES = _get('aws', 'benchmark_block_sizes',
+                                 '1M 4M').split()
+# Leftover fedimg nodes, volumes and snapshots older than AWS_REAP_MAX_AGE
+# seconds are destroyed every AWS_REAP_INTERVAL seconds by the consumer.
+# An interval of 0 disables this.
+AWS_REAP_MAX_AGE = int(_get('aws', 'reap_max_age', 7200))
+AWS_REAP_INTERVAL = int(_get('aws', 'reap_interval', 0))
+# Per-region resource limits upload stages wait for, like
+# "instances=20 eu-west-1:copies=5" (see fedimg.quota)
+AWS_LIMITS = _get('aws', 'limits', '')
+# Regions the image is built in, rather than copied to. Every other region
+# copies from the nearest of them, going by the distances between regions
+# (see fedimg.regions), which can be overridden like "us-east-1:sa-east-1=120".
+# By default the image is only built in the first region in `amis`.
+AWS_ORIGINS = _get('aws', 'origins', '').split()
+AWS_DISTANCES = _get('aws', 'distances', '')
+# How images get to the other regions: 'image' copies every variant's AMI,
+# 'snapshot' copies the image's snapshot once and registers each variant
+# from it in every region.
+AWS_REPLICATE = _get('aws', 'replicate', 'image')
+# What to do with an image whose checksum matches one uploaded before:
+# 'register' it again from the earlier snapshots, 'reference' the earlier
+# AMIs, or build it again if empty or 'none'.
+AWS_REUSE = _get('aws', 'reuse', '')
+# Create the utility volume from the snapshot of the previous build of the
+# image and only write the blocks that changed.
+AWS_DELTA = _getboolean('aws', 'delta')
+# Number of connections the utility node downloads each image over, in
+# ranges; 1 downloads it as a single stream with curl.
+AWS_FETCH_CONNECTIONS = int(_get('aws', 'fetch_connections', 1))
 
 # RACKSPACE
 RACKSPACE_USER = config.get('rackspace', 'username')
 RACKSPACE_API_KEY = config.get('rackspace', 'api_key')
+RACKSPACE_AUTH_URL = _get('rackspace', 'auth_url',
+                          'https://identity.api.rackspacecloud.com/v2.0')
 
 # GCE
 GCE_EMAIL = config.get('gce', 'email')
 GCE_KEYPATH = config.get('gce', 'keypath')
 GCE_PROJECT_ID = config.get('gce', 'project_id')
+# Bucket that image tarballs are uploaded to before being imported, and the
+# resumable upload endpoint of the object storage API.
+GCE_BUCKET = _get('gce', 'bucket')
+GCE_STORAGE_URL = _get('gce', 'storage_url',
+                       'https://www.googleapis.com/upload/storage/v1')
+
+# FTP
+# Directory (the NFS share behind the FTP server) images are published to.
+# Empty to disable publishing.
+FTP_TARGET_DIR = _get('ftp', 'target_dir')
+# Number of parts large images are downloaded in at the same time
+FTP_CONNECTIONS = int(_get('ftp', 'connections', 4))
+# Disk formats (qcow2, vhd, vmdk) images are also published in
+FTP_FORMATS = _get('ftp', 'formats', '').split()
+# Stored images and conversions no compose has linked to for this many
+# seconds are deleted after each publish. 0 disables this.
+FTP_PRUNE_AGE = int(_get('ftp', 'prune_age', 86400))
 
 # HP
 HP_USER = config.get('hp', 'username')
 HP_PASSWORD = config.get('hp', 'password')
 HP_TENANT = config.get('hp', 'tenant')
+HP_AUTH_URL = _get('hp', 'auth_url', 'https://region-b.geo-1.identity.'
+                   'hpcloudsvc.com:35357/v2.0')
 
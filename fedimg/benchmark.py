@@ -0,0 +1,125 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Recording and use of utility node write-throughput benchmarks.
+
+Benchmark runs (see `EC2Service.benchmark` and `bin/benchmark_util_nodes.py`)
+measure how fast each candidate instance type downloads, decompresses and
+writes an image, and what that costs. The results are kept in a JSON file,
+from which the upload process picks the utility node type for each region.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+import fedimg
+
+_lock = threading.Lock()
+
+
+def result(region, size, block_size, seconds, output):
+    """ Returns the record of a single benchmark run of `size` (a libcloud
+    NodeSize) in `region`. `output` is the output of the write command,
+    from which the number of bytes written is read. """
+    # dd's summary is the last thing it prints
+    matches = re.findall(r'(\d+) bytes', output)
+    written = int(matches[-1]) if matches else 0
+    mbps = written / (1024.0 * 1024.0) / seconds if seconds else 0.0
+
+    # libcloud knows the hourly on-demand price of most instance types
+    cost = None
+    if size.price:
+        cost = float(size.price) * seconds / 3600.0
+
+    return {'region': region,
+            'size': size.id,
+            'block_size': block_size,
+            'seconds': seconds,
+            'bytes': written,
+            'mbps': mbps,
+            'cost': cost,
+            'time': time.time()}
+
+
+def load_results(path=None):
+    """ Returns the list of recorded benchmark results. """
+    path = path or fedimg.AWS_BENCHMARK_RESULTS
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def record_results(results, path=None):
+    """ Adds `results` to the recorded benchmark results. """
+    path = path or fedimg.AWS_BENCHMARK_RESULTS
+    with _lock:
+        recorded = load_results(path) + list(results)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(recorded, f, indent=2)
+        os.rename(tmp, path)
+
+
+def summarize(results, region):
+    """ Averages the results for `region` per (instance type, block size)
+    pair. Returns a dict mapping those pairs to dicts of average MB/s and
+    average cost per image. """
+    runs = {}
+    for r in results:
+        if r['region'] != region or not r['bytes']:
+            continue
+        runs.setdefault((r['size'], r['block_size']), []).append(r)
+
+    summary = {}
+    for key, rs in runs.items():
+        costs = [r['cost'] for r in rs if r['cost'] is not None]
+        summary[key] = {
+            'mbps': sum(r['mbps'] for r in rs) / len(rs),
+            'cost': sum(costs) / len(costs) if costs else None,
+        }
+    return summary
+
+
+def best_util_size(region, results=None, objective=None):
+    """ Returns the (instance type, block size) pair that did best in the
+    benchmarks recorded for `region`, or (None, None) if there are none.
+    With the 'speed' objective the highest throughput wins; with 'cost',
+    the lowest cost per image. """
+    if results is None:
+        results = load_results()
+    objective = objective or fedimg.AWS_UTIL_OBJECTIVE
+
+    summary = summarize(results, region)
+    if not summary:
+        return None, None
+
+    if objective == 'cost':
+        priced = dict((k, v) for k, v in summary.items()
+                      if v['cost'] is not None)
+        if priced:
+            return min(priced, key=lambda k: priced[k]['cost'])
+
+    return max(summary, key=lambda k: summary[k]['mbps'])
@@ -0,0 +1,114 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+Cooperative cancellation of upload jobs.
+
+Each job the uploader runs gets a Token. Cancelling it doesn't stop the job
+outright: the job checks its token between stages and while it polls, and
+raises JobCancelled at the first chance, cleaning up what it created on the
+way out. Blocking calls that can't poll can be hooked to be interrupted.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import contextlib
+import threading
+
+
+# Reason jobs are cancelled for when the consumer stops (see
+# fedimg.uploader.drain)
+SHUTDOWN = 'shutting down'
+
+
+class JobCancelled(Exception):
+    """ The job was cancelled before it was done. """
+    pass
+
+
+class Token(object):
+    """ The cancellation state of one job. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.reason = None
+        self.started = False
+        self.hooks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def start(self):
+        """ Marks the job as started. Returns False if it was cancelled
+        before it could start. """
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.started = True
+            return True
+
+    def cancel(self, reason, pending_only=False):
+        """ Cancels the job for `reason`, unless it's already cancelled or,
+        with `pending_only`, has started. Returns True if it was
+        cancelled. """
+        with self.lock:
+            if self.event.is_set() or (pending_only and self.started):
+                return False
+            self.reason = reason
+            self.event.set()
+            hooks = list(self.hooks)
+        log.info('Cancelling job: {0}'.format(reason))
+        for callback in hooks:
+            try:
+                callback()
+            except Exception:
+                log.exception('Cancellation hook failed')
+        return True
+
+    def check(self):
+        """ Raises JobCancelled if the job was cancelled. """
+        if self.event.is_set():
+            raise JobCancelled(self.reason)
+
+    def sleep(self, seconds):
+        """ Sleeps for `seconds`, raising JobCancelled as soon as the job is
+        cancelled. """
+        if self.event.wait(seconds):
+            raise JobCancelled(self.reason)
+
+    @contextlib.contextmanager
+    def hook(self, callback):
+        """ Calls `callback` if the job is cancelled while in this
+        context, to interrupt whatever it's blocked on. """
+        with self.lock:
+            self.hooks.append(callback)
+            cancelled = self.event.is_set()
+        try:
+            if cancelled:
+                callback()
+            yield
+        finally:
+            with self.lock:
+                self.hooks.remove(callback)
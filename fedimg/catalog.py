@@ -0,0 +1,245 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+A local catalog of the images fedimg has registered.
+
+Every completed upload that goes through `fedimg.messenger.message` is
+recorded in an SQLite database, indexed so that questions like "what's the
+latest gp2 HVM AMI of Fedora-Cloud-Base-25 in eu-west-1" don't need a trip
+through datagrepper history. The AMIs and snapshots of each image are also
+recorded by the image's checksum, so that an unchanged image in a later
+compose can reuse them.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import fedimg
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS amis (
+    id TEXT PRIMARY KEY,
+    build TEXT NOT NULL,
+    region TEXT NOT NULL,
+    virt_type TEXT,
+    vol_type TEXT,
+    compose_id TEXT,
+    image_url TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS amis_variant
+    ON amis (build, region, virt_type, vol_type);
+CREATE INDEX IF NOT EXISTS amis_region
+    ON amis (region, virt_type, vol_type, created);
+CREATE INDEX IF NOT EXISTS amis_compose
+    ON amis (compose_id);
+CREATE TABLE IF NOT EXISTS checksums (
+    checksum TEXT NOT NULL,
+    region TEXT NOT NULL,
+    virt_type TEXT NOT NULL,
+    vol_type TEXT NOT NULL,
+    ami_id TEXT NOT NULL,
+    snapshot_id TEXT,
+    created REAL NOT NULL,
+    PRIMARY KEY (checksum, region, virt_type, vol_type)
+);
+"""
+
+COLUMNS = ('id', 'build', 'region', 'virt_type', 'vol_type', 'compose_id',
+           'image_url', 'created')
+
+CHECKSUM_COLUMNS = ('checksum', 'region', 'virt_type', 'vol_type', 'ami_id',
+                    'snapshot_id', 'created')
+
+
+def region_from_destination(dest):
+    """ Takes an upload destination (ex. "EC2 (eu-west-1)") and returns the
+    region in it, or the destination itself if it names no region. """
+    match = re.search(r'\((.+)\)', dest)
+    return match.group(1) if match else dest
+
+
+def _escape_glob(text):
+    return text.replace('[', '[[]').replace('*', '[*]').replace('?', '[?]')
+
+
+class Catalog(object):
+    """ An SQLite catalog of registered images, safe to share between
+        threads. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path != ':memory:':
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+
+    def add(self, id, build, region, virt_type=None, vol_type=None,
+            compose_id=None, image_url=None, created=None):
+        """ Records the image `id`, registered from `build` in `region`. """
+        created = created or time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO amis "
+                    "(id, build, region, virt_type, vol_type, compose_id, "
+                    "image_url, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (id, build, region, virt_type, vol_type, compose_id,
+                     image_url, created))
+
+    def _select(self, build=None, region=None, virt_type=None,
+                vol_type=None, compose_id=None, prefix=None, suffix='',
+                limit=None):
+        clauses, params = [], []
+        for column, value in (('build', build), ('region', region),
+                              ('virt_type', virt_type),
+                              ('vol_type', vol_type),
+                              ('compose_id', compose_id)):
+            if value is not None:
+                clauses.append('{0} = ?'.format(column))
+                params.append(value)
+        if prefix is not None:
+            # GLOB (unlike LIKE) is case sensitive, so it can use the index
+            clauses.append('build GLOB ?')
+            params.append(_escape_glob(prefix) + '*' + _escape_glob(suffix))
+
+        query = 'SELECT * FROM amis'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY created DESC'
+        if limit:
+            query += ' LIMIT {0:d}'.format(limit)
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [dict(zip(COLUMNS, [row[c] for c in COLUMNS]))
+                for row in rows]
+
+    def add_checksum(self, checksum, region, virt_type, vol_type, ami_id,
+                     snapshot_id=None, created=None):
+        """ Records that the image with the SHA256 `checksum` is registered
+        as `ami_id`, from the snapshot `snapshot_id` if known, in `region`.
+        Replaces what was recorded for that variant of it there before. """
+        created = created or time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO checksums "
+                    "(checksum, region, virt_type, vol_type, ami_id, "
+                    "snapshot_id, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (checksum, region, virt_type, vol_type, ami_id,
+                     snapshot_id, created))
+
+    def forget_checksum(self, checksum, region=None):
+        """ Drops what was recorded for `checksum`, in `region` or
+        everywhere. """
+        query = "DELETE FROM checksums WHERE checksum = ?"
+        params = [checksum]
+        if region is not None:
+            query += " AND region = ?"
+            params.append(region)
+        with self.lock:
+            with self.conn:
+                self.conn.execute(query, params)
+
+    def find_checksum(self, checksum, virt_type=None, vol_type=None):
+        """ Returns what was recorded for the image with `checksum`, of any
+        or the given variant, in each region, as dicts. """
+        query = "SELECT * FROM checksums WHERE checksum = ?"
+        params = [checksum]
+        for column, value in (('virt_type', virt_type),
+                              ('vol_type', vol_type)):
+            if value is not None:
+                query += " AND {0} = ?".format(column)
+                params.append(value)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [dict(zip(CHECKSUM_COLUMNS,
+                         [row[c] for c in CHECKSUM_COLUMNS]))
+                for row in rows]
+
+    def find(self, build=None, region=None, virt_type=None, vol_type=None,
+             compose_id=None):
+        """ Returns the recorded images matching all the given attributes,
+        newest first, as dicts. """
+        return self._select(build=build, region=region, virt_type=virt_type,
+                            vol_type=vol_type, compose_id=compose_id)
+
+    def latest(self, prefix, region, virt_type, vol_type, suffix=''):
+        """ Returns the newest recorded image whose build name starts with
+        `prefix` (ex. "Fedora-Cloud-Base-25") and ends with `suffix` in
+        `region`, or None. """
+        rows = self._select(prefix=prefix, suffix=suffix, region=region,
+                            virt_type=virt_type, vol_type=vol_type, limit=1)
+        return rows[0] if rows else None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """ Returns the catalog configured for fedimg, or None if there's none
+    or it can't be opened. """
+    global _catalog
+    if not fedimg.CATALOG:
+        return None
+    with _catalog_lock:
+        if _catalog is None:
+            try:
+                _catalog = Catalog(fedimg.CATALOG)
+            except (OSError, sqlite3.Error):
+                log.exception('Could not open the catalog {0}'.format(
+                    fedimg.CATALOG))
+                return None
+    return _catalog
+
+
+def record(image_url, dest, compose, extra):
+    """ Records a completed upload, as described by a fedimg message, in the
+    configured catalog. Errors are logged rather than raised, since the
+    catalog is never worth failing an upload over. """
+    try:
+        catalog = get_catalog()
+        image_id = (extra or {}).get('id')
+        if catalog is None or not image_id:
+            return
+        build = image_url.split('/')[-1].replace('.raw.xz', '')
+        catalog.add(image_id, build, region_from_destination(dest),
+                    virt_type=extra.get('virt_type'),
+                    vol_type=extra.get('vol_type'),
+                    compose_id=(compose or {}).get('compose_id'),
+                    image_url=image_url)
+    except Exception:
+        log.exception('Could not record {0} in the catalog'.format(
+            image_url))
@@ -0,0 +1,127 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Reading the images manifest of a compose.
+
+Only the compose's `metadata/images.json` is fetched, and only the entries
+for the configured variants, arches and formats are kept. The manifest is
+parsed with `ijson` as it streams in, so that the rest of it is never held in
+memory. Without `ijson` (which setup.py requires), it's parsed in one go.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import json
+
+import requests
+
+import fedimg
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    log.warn('ijson is not installed; compose manifests are read whole')
+    ijson = None
+
+
+def images_url(location):
+    """ Returns the URL of the images manifest of the compose at
+    `location`. """
+    return '{0}/metadata/images.json'.format(location.rstrip('/'))
+
+
+def parse_subsets(text):
+    """ Parses subsets like "CloudImages/x86_64 Cloud/*" into a list of
+    (variant, arch) pairs, where '*' matches any arch. """
+    subsets = []
+    for item in (text or '').split():
+        variant, _, arch = item.partition('/')
+        subsets.append((variant, arch or '*'))
+    return subsets
+
+
+def _wanted(subsets, variant, arch):
+    return any(v == variant and a in ('*', arch) for v, a in subsets)
+
+
+def _iter_stream(fileobj, subsets):
+    """ Yields (variant, arch, image) for the wanted images in the manifest
+    in `fileobj`, parsing it as a stream. """
+    builder = None
+    current = None
+    for prefix, event, value in ijson.parse(fileobj):
+        if builder is None:
+            # Images are at payload.images.<variant>.<arch>.item
+            if event != 'start_map' or not prefix.startswith(
+                    'payload.images.'):
+                continue
+            parts = prefix.split('.')
+            if len(parts) != 5 or parts[4] != 'item':
+                continue
+            if not _wanted(subsets, parts[2], parts[3]):
+                continue
+            builder = ObjectBuilder()
+            current = (prefix, parts[2], parts[3])
+            builder.event(event, value)
+            continue
+
+        builder.event(event, value)
+        if event == 'end_map' and prefix == current[0]:
+            yield current[1], current[2], builder.value
+            builder = None
+
+
+def _iter_loaded(fileobj, subsets):
+    """ Like `_iter_stream`, but loads the whole manifest first. """
+    images = json.load(fileobj).get('payload', {}).get('images', {})
+    for variant, arches in sorted(images.items()):
+        for arch, entries in sorted(arches.items()):
+            if _wanted(subsets, variant, arch):
+                for image in entries:
+                    yield variant, arch, image
+
+
+def iter_images(fileobj, subsets=None, formats=None):
+    """ Yields (variant, arch, image) for the images in the manifest in
+    `fileobj` that are in one of `subsets` and have one of `formats`
+    (by default, the configured ones). """
+    if subsets is None:
+        subsets = parse_subsets(fedimg.COMPOSE_IMAGES)
+    if formats is None:
+        formats = fedimg.COMPOSE_FORMATS
+    parse = _iter_stream if ijson is not None else _iter_loaded
+    for variant, arch, image in parse(fileobj, subsets):
+        if any(image.get('path', '').endswith('.' + fmt) for fmt in formats):
+            yield variant, arch, image
+
+
+def get_images(location, subsets=None, formats=None):
+    """ Returns the list of wanted images (see `iter_images`) of the compose
+    at `location`. """
+    response = requests.get(images_url(location), stream=True)
+    response.raise_for_status()
+    # Undo any transfer compression as the manifest is read
+    response.raw.decode_content = True
+    return [image for variant, arch, image
+            in iter_images(response.raw, subsets, formats)]
@@ -22,14 +22,28 @@
 import logging
 log = logging.getLogger("fedmsg")
 
-import multiprocessing.pool
+import os
+import threading
+import time
 
 import fedmsg.consumers
 import fedmsg.encoding
-import fedfind.release
 
+import fedimg
+import fedimg.compose
+import fedimg.ledger
+import fedimg.profiler
+import fedimg.reaper
 import fedimg.uploader
-from fedimg.util import get_rawxz_urls, safeget
+import fedimg.util
+from fedimg.util import compose_id_from_image, early_image, get_rawxz_urls
+from fedimg.util import get_task_images
+
+COMPOSE_TOPIC = 'org.fedoraproject.prod.pungi.compose.status.change'
+TASK_TOPIC = 'org.fedoraproject.prod.buildsys.task.state.change'
+
+# Koji task state of a task that completed successfully
+TASK_CLOSED = 2
 
 
 class FedimgConsumer(fedmsg.consumers.FedmsgConsumer):
@@ -42,16 +56,38 @@ class FedimgConsumer(fedmsg.consumers.FedmsgConsumer):
     # build.state.change topic.  That means we have to handle both cases like
     # this, at least for now.
     topic = [
-        'org.fedoraproject.prod.pungi.compose.status.change',
+        COMPOSE_TOPIC,
     ]
 
     config_key = 'fedimgconsumer'
 
     def __init__(self, *args, **kwargs):
+        # With early intake, images are picked up as soon as the createImage
+        # task that built them completes.
+        if fedimg.EARLY_INTAKE:
+            if fedimg.util.koji is None:
+                log.error('early_intake is on, but the koji package is not '
+                          'installed (see fedimg[early_intake]); images will '
+                          'wait for their compose')
+            else:
+                self.topic = self.topic + [TASK_TOPIC]
+
         super(FedimgConsumer, self).__init__(*args, **kwargs)
 
-        # threadpool for upload jobs
-        self.upload_pool = multiprocessing.pool.ThreadPool(processes=4)
+        # Images uploaded early, by file name, until their compose finishes
+        self.early_images = {}
+        self.early_lock = threading.Lock()
+
+        # periodically clean up whatever failed jobs left behind
+        if fedimg.AWS_REAP_INTERVAL:
+            fedimg.reaper.schedule(fedimg.AWS_REAP_INTERVAL)
+
+        # the profiler is started and stopped with a signal
+        fedimg.profiler.install()
+
+        # destroy what an earlier process left running, and pick up the
+        # jobs it handed off when it stopped
+        fedimg.ledger.recover()
 
         log.info("Super happy fedimg ready and reporting for duty.")
 
@@ -60,29 +96,136 @@ class FedimgConsumer(fedmsg.consumers.FedmsgConsumer):
 
         log.info('Received %r %r' % (msg['topic'], msg['body']['msg_id']))
 
+        if msg['topic'].endswith('.buildsys.task.state.change'):
+            self.consume_task(msg['body']['msg'])
+        else:
+            self.consume_compose(msg['body']['msg'])
+
+    def consume_task(self, msg_info):
+        """ Uploads the cloud images built by a completed createImage task
+        straight away. """
+        if msg_info.get('method') != 'createImage':
+            return
+        if msg_info.get('new') != TASK_CLOSED:
+            return
+
+        images = get_task_images(msg_info['id'])
+        upload_urls = []
+        with self.early_lock:
+            self._expire()
+            for url, size in sorted(images.items()):
+                file_name = url.split('/')[-1]
+                compose_id = compose_id_from_image(file_name)
+                if not early_image(file_name) or compose_id is None:
+                    continue
+                if file_name in self.early_images:
+                    log.info('%s was already uploaded early' % file_name)
+                    continue
+                self.early_images[file_name] = {'url': url, 'size': size,
+                                                'compose_id': compose_id,
+                                                'time': time.time()}
+                upload_urls.append((url, compose_id))
+
+        for url, compose_id in upload_urls:
+            log.info("Uploading %s early for compose id: %s" % (url,
+                                                                 compose_id))
+            fedimg.uploader.upload([url], {'compose_id': compose_id},
+                                   wait=False)
+
+    def _expire(self):
+        """ Drops the early uploads that no compose has shipped in
+        EARLY_INTAKE_MAX_AGE seconds, so that the ones of composes that are
+        never announced don't pile up. Called with `early_lock` held. """
+        now = time.time()
+        for file_name, early in list(self.early_images.items()):
+            if now - early['time'] > fedimg.EARLY_INTAKE_MAX_AGE:
+                log.warn('%s was uploaded early but %s never shipped it' % (
+                    file_name, early['compose_id']))
+                del self.early_images[file_name]
+
+    def _reconcile(self, compose_id, urls, images_meta):
+        """ Leaves out of `urls` the images of the compose `compose_id` that
+        were already uploaded early, and returns the rest. Early uploads
+        that the compose doesn't match are logged. """
+        sizes = dict((os.path.basename(image['path']), image.get('size'))
+                     for image in images_meta)
+        remaining = []
+        with self.early_lock:
+            for url in urls:
+                file_name = url.split('/')[-1]
+                early = self.early_images.pop(file_name, None)
+                if early is None:
+                    remaining.append(url)
+                elif sizes.get(file_name) not in (None, early['size']):
+                    log.warn('%s changed since it was uploaded early from %s; '
+                             'uploading it again' % (file_name, early['url']))
+                    remaining.append(url)
+                else:
+                    log.info('%s was already uploaded early' % file_name)
+
+            # Whatever is left for this compose was never part of it
+            for file_name, early in list(self.early_images.items()):
+                if early['compose_id'] == compose_id:
+                    log.warn('%s was uploaded early from %s but is not part '
+                             'of %s' % (file_name, early['url'], compose_id))
+                    del self.early_images[file_name]
+        return remaining
+
+    def _forget(self, compose_id):
+        """ Drops the early uploads of `compose_id`, which failed. The images
+        stay registered, but the compose never shipped them. """
+        with self.early_lock:
+            for file_name, early in list(self.early_images.items()):
+                if early['compose_id'] == compose_id:
+                    log.warn('%s was uploaded early but %s failed' % (
+                        file_name, compose_id))
+                    del self.early_images[file_name]
+
+    def consume_compose(self, msg_info):
+        """ Uploads the cloud images of a finished compose. """
+
         STATUS_F = ('FINISHED_INCOMPLETE', 'FINISHED',)
+        STATUS_FAILED = ('DOOMED', 'TERMINATED',)
+
+        compose_id = msg_info['compose_id']
+
+        if msg_info['status'] in STATUS_FAILED:
+            self._forget(compose_id)
+            return
 
-        msg_info = msg['body']['msg']
         if msg_info['status'] not in STATUS_F:
             return
 
         location = msg_info['location']
-        compose_id = msg_info['compose_id']
-        cmetadata = fedfind.release.get_release_cid(compose_id).metadata
 
-        images_meta = safeget(cmetadata, 'images', 'payload', 'images',
-                              'CloudImages', 'x86_64')
+        # Only the wanted part of the images manifest is kept
+        images_meta = fedimg.compose.get_images(location)
 
-        if images_meta is None:
+        if not images_meta:
             return
 
-        self.upload_urls = get_rawxz_urls(location, images_meta)
+        # Kept per message, since messages are handled concurrently
+        upload_urls = self._reconcile(
+            compose_id, get_rawxz_urls(location, images_meta), images_meta)
         compose_meta = {
             'compose_id': compose_id,
         }
+        # Images identical to ones uploaded before can reuse their AMIs
+        checksums = dict(
+            ('{0}/{1}'.format(location, image['path']),
+             image.get('checksums', {}).get('sha256'))
+            for image in images_meta)
 
-        if len(self.upload_urls) > 0:
+        if len(upload_urls) > 0:
             log.info("Processing compose id: %s" % compose_id)
-            fedimg.uploader.upload(self.upload_pool,
-                                   self.upload_urls,
-                                   compose_meta)
+            # Upload jobs run on the providers' own pools, so there's no
+            # need to hold up the next message while they do
+            fedimg.uploader.upload(upload_urls, compose_meta, wait=False,
+                                   checksums=checksums)
+
+    def stop(self):
+        """ Lets running upload jobs finish, within the shutdown grace
+        period, and hands off the rest before the hub stops. """
+        log.info('Stopping; draining the upload jobs')
+        fedimg.uploader.drain()
+        super(FedimgConsumer, self).stop()
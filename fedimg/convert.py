@@ -0,0 +1,406 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+Conversion of raw images to the disk formats other clouds want.
+
+The raw image is read once, in 64 KiB blocks, and written in every requested
+format at the same time. Blocks of zeros are left out of every format (as
+unallocated clusters and grains, or holes in the file), and blocks are
+compressed on a thread pool, while the next batch of blocks is being read.
+
+Outputs must be real (seekable) files, as the headers and tables of each
+format can only be written once the whole image has been read.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import multiprocessing
+import multiprocessing.pool
+import struct
+import time
+import uuid
+import zlib
+
+import fedimg.stream
+
+BLOCK_SIZE = 64 * 1024
+
+# Number of blocks handed to the compression threads at once
+BATCH_BLOCKS = 64
+
+SECTOR = 512
+
+
+def _deflate(data, level=6):
+    """ Raw deflate, as used for compressed qcow2 clusters. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -12)
+    return compressor.compress(data) + compressor.flush()
+
+
+COMPRESSORS = {
+    'deflate': _deflate,
+    'zlib': zlib.compress,
+}
+
+
+def _align(value, alignment):
+    return -(-value // alignment) * alignment
+
+
+class Qcow2Writer(object):
+    """ Writes a version 2 qcow2 image with 64 KiB clusters. Blocks of zeros
+        are left unallocated. With `compress`, clusters are stored
+        compressed when that makes them smaller. """
+
+    cluster_bits = 16
+    COPIED = 1 << 63
+    COMPRESSED = 1 << 62
+
+    def __init__(self, fileobj, compress=False):
+        self.f = fileobj
+        self.compression = 'deflate' if compress else None
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2 = {}
+        self.refcounts = {0: 1}
+        # Cluster 0 holds the header, which is written last
+        self.offset = self.cluster_size
+
+    def _allocate(self, data):
+        """ Writes `data` at the next free cluster. Returns its offset. """
+        offset = self.offset = _align(self.offset, self.cluster_size)
+        self.f.seek(offset)
+        self.f.write(data)
+        for cluster in range(offset >> self.cluster_bits,
+                             _align(offset + len(data), self.cluster_size) >>
+                             self.cluster_bits):
+            self.refcounts[cluster] = 1
+        self.offset += len(data)
+        return offset
+
+    def block(self, index, data, compressed=None):
+        if compressed is not None and len(compressed) < len(data):
+            offset = self.offset
+            self.f.seek(offset)
+            self.f.write(compressed)
+            self.offset += len(compressed)
+
+            sectors = ((offset + len(compressed) - 1) >> 9) - (offset >> 9)
+            self.l2[index] = (self.COMPRESSED | offset |
+                              sectors << (62 - (self.cluster_bits - 8)))
+            # Compressed clusters may share host clusters, which are counted
+            # once for each of them
+            end = offset + (sectors + 1) * SECTOR - (offset & (SECTOR - 1))
+            for cluster in range(offset >> self.cluster_bits,
+                                 ((end - 1) >> self.cluster_bits) + 1):
+                self.refcounts[cluster] = self.refcounts.get(cluster, 0) + 1
+        else:
+            self.l2[index] = self._allocate(data) | self.COPIED
+
+    def close(self, size):
+        entries = self.cluster_size // 8
+        clusters = -(-size // self.cluster_size)
+        l1 = [0] * -(-clusters // entries)
+
+        for i in range(len(l1)):
+            table = [self.l2.get(i * entries + j, 0) for j in range(entries)]
+            if any(table):
+                l1[i] = self._allocate(
+                    struct.pack('>{0}Q'.format(entries), *table)
+                ) | self.COPIED
+
+        l1_offset = self._allocate(
+            struct.pack('>{0}Q'.format(len(l1)), *l1) or b'\0')
+
+        # The refcount blocks and table need refcounts of their own
+        per_block = self.cluster_size // 2
+        used = _align(self.offset, self.cluster_size) >> self.cluster_bits
+        blocks = table_clusters = 0
+        while True:
+            total = used + blocks + table_clusters
+            needed = -(-total // per_block)
+            needed_table = -(-needed * 8 // self.cluster_size)
+            if (needed, needed_table) == (blocks, table_clusters):
+                break
+            blocks, table_clusters = needed, needed_table
+        for cluster in range(used, total):
+            self.refcounts[cluster] = 1
+
+        block_offsets = []
+        for b in range(blocks):
+            counts = [self.refcounts.get(b * per_block + i, 0)
+                      for i in range(per_block)]
+            block_offsets.append(self._allocate(
+                struct.pack('>{0}H'.format(per_block), *counts)))
+        table_offset = self._allocate(
+            struct.pack('>{0}Q'.format(len(block_offsets)), *block_offsets))
+
+        self.f.truncate(_align(self.offset, self.cluster_size))
+        self.f.seek(0)
+        self.f.write(struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', 2, 0, 0,
+                                 self.cluster_bits, size, 0, len(l1),
+                                 l1_offset, table_offset, table_clusters,
+                                 0, 0))
+        self.f.flush()
+
+
+def _chs(size):
+    """ Returns the (cylinders, heads, sectors per track) geometry of a disk
+    of `size` bytes, as worked out in the VHD specification. """
+    total = min(size // SECTOR, 65535 * 16 * 255)
+    if total >= 65535 * 16 * 63:
+        spt, heads = 255, 16
+        cth = total // spt
+    else:
+        spt = 17
+        cth = total // spt
+        heads = max((cth + 1023) // 1024, 4)
+        if cth >= heads * 1024 or heads > 16:
+            spt, heads = 31, 16
+            cth = total // spt
+        if cth >= heads * 1024:
+            spt, heads = 63, 16
+            cth = total // spt
+    return cth // heads, heads, spt
+
+
+class VHDWriter(object):
+    """ Writes a fixed VHD: the raw image, padded to a whole number of
+        MiB, followed by a footer. Blocks of zeros are left as holes in the
+        file. """
+
+    compression = None
+    alignment = 1024 * 1024
+
+    def __init__(self, fileobj):
+        self.f = fileobj
+
+    def block(self, index, data, compressed=None):
+        self.f.seek(index * BLOCK_SIZE)
+        self.f.write(data)
+
+    def footer(self, size, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        cylinders, heads, spt = _chs(size)
+        footer = bytearray(struct.pack(
+            '>8sIIQI4sI4sQQHBBII16sB427x', b'conectix', 2, 0x00010000,
+            0xffffffffffffffff, int(timestamp - 946684800) & 0xffffffff,
+            b'fimg', 0x00010000, b'Wi2k', size, size, cylinders, heads,
+            spt, 2, 0, uuid.uuid4().bytes, 0))
+        footer[64:68] = struct.pack('>I', ~sum(footer) & 0xffffffff)
+        return bytes(footer)
+
+    def close(self, size):
+        size = _align(size, self.alignment)
+        self.f.truncate(size)
+        self.f.seek(size)
+        self.f.write(self.footer(size))
+        self.f.flush()
+
+
+class VMDKWriter(object):
+    """ Writes a streamOptimized VMDK, the format OVAs are made of. Every
+        grain is compressed, and grains of zeros are left out. """
+
+    compression = 'zlib'
+    grain_sectors = BLOCK_SIZE // SECTOR
+    gtes_per_gt = 512
+    descriptor_sectors = 20
+    overhead = 128
+
+    GD_AT_END = 0xffffffffffffffff
+    MARKER_EOS, MARKER_GT, MARKER_GD, MARKER_FOOTER = range(4)
+
+    def __init__(self, fileobj, name='disk.vmdk'):
+        self.f = fileobj
+        self.name = name
+        self.grains = {}
+        self.f.seek(self.overhead * SECTOR)
+
+    def _pad(self):
+        self.f.write(b'\0' * (-self.f.tell() % SECTOR))
+
+    def _marker(self, sectors, kind):
+        self.f.write(struct.pack('<QII496x', sectors, 0, kind))
+
+    def _metadata(self, kind, data):
+        """ Writes a metadata marker and `data`, padded to whole sectors.
+        Returns the sector the data starts at. """
+        sectors = -(-len(data) // SECTOR)
+        self._marker(sectors, kind)
+        sector = self.f.tell() // SECTOR
+        self.f.write(data)
+        self._pad()
+        return sector
+
+    def block(self, index, data, compressed=None):
+        if compressed is None:
+            compressed = zlib.compress(data)
+        self.grains[index] = self.f.tell() // SECTOR
+        self.f.write(struct.pack('<QI', index * self.grain_sectors,
+                                 len(compressed)))
+        self.f.write(compressed)
+        self._pad()
+
+    def header(self, capacity, gd_offset):
+        return struct.pack(
+            '<IIIQQQQIQQQB4sH433x', 0x564d444b, 3, 0x30001, capacity,
+            self.grain_sectors, 1, self.descriptor_sectors, self.gtes_per_gt,
+            0, gd_offset, self.overhead, 0, b'\n \r\n', 1)
+
+    def descriptor(self, capacity):
+        return '\n'.join([
+            '# Disk DescriptorFile',
+            'version=1',
+            'CID={0:08x}'.format(uuid.uuid4().int & 0xffffffff),
+            'parentCID=ffffffff',
+            'createType="streamOptimized"',
+            '',
+            '# Extent description',
+            'RW {0} SPARSE "{1}"'.format(capacity, self.name),
+            '',
+            '# The Disk Data Base',
+            '#DDB',
+            '',
+            'ddb.virtualHWVersion = "4"',
+            'ddb.geometry.cylinders = "{0}"'.format(
+                min(capacity // (255 * 63), 65535)),
+            'ddb.geometry.heads = "255"',
+            'ddb.geometry.sectors = "63"',
+            'ddb.adapterType = "ide"',
+            '',
+        ]).encode('ascii')
+
+    def close(self, size):
+        capacity = -(-size // SECTOR)
+        grains = -(-capacity // self.grain_sectors)
+        tables = -(-grains // self.gtes_per_gt)
+
+        directory = []
+        for t in range(tables):
+            table = [self.grains.get(t * self.gtes_per_gt + i, 0)
+                     for i in range(self.gtes_per_gt)]
+            directory.append(self._metadata(
+                self.MARKER_GT,
+                struct.pack('<{0}I'.format(self.gtes_per_gt), *table)))
+        gd_offset = self._metadata(
+            self.MARKER_GD, struct.pack('<{0}I'.format(tables), *directory))
+
+        self._metadata(self.MARKER_FOOTER, self.header(capacity, gd_offset))
+        self._marker(0, self.MARKER_EOS)
+
+        self.f.seek(0)
+        self.f.write(self.header(capacity, self.GD_AT_END))
+        self.f.write(self.descriptor(capacity))
+        self.f.flush()
+
+
+FORMATS = {
+    'qcow2': lambda f: Qcow2Writer(f, compress=True),
+    'vhd': VHDWriter,
+    'vmdk': VMDKWriter,
+}
+
+
+def _prepare(args):
+    """ Pads `block` to a whole block and compresses it with each of
+    `compressions`. Returns None for blocks of zeros. """
+    block, compressions = args
+    if fedimg.stream.is_zero(block):
+        return None
+    block += b'\0' * (BLOCK_SIZE - len(block))
+    return block, dict((c, COMPRESSORS[c](block)) for c in compressions)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def convert(chunks, writers, threads=None):
+    """ Writes the raw image read from `chunks` with each of `writers`.
+    Returns the size of the raw image. """
+    compressions = set(w.compression for w in writers if w.compression)
+    pool = multiprocessing.pool.ThreadPool(
+        processes=threads or multiprocessing.cpu_count())
+
+    state = {'index': 0, 'size': 0}
+
+    def write(prepared):
+        for block in prepared:
+            if block is not None:
+                data, compressed = block
+                for writer in writers:
+                    writer.block(state['index'], data,
+                                 compressed.get(writer.compression))
+            state['index'] += 1
+
+    try:
+        pending = None
+        for batch in _batches(fedimg.stream.blocks(chunks, BLOCK_SIZE),
+                              BATCH_BLOCKS):
+            state['size'] += sum(len(block) for block in batch)
+            # Compress this batch while the previous one is written out
+            job = pool.map_async(_prepare,
+                                 [(block, compressions) for block in batch])
+            if pending is not None:
+                write(pending.get())
+            pending = job
+        if pending is not None:
+            write(pending.get())
+    finally:
+        pool.close()
+
+    for writer in writers:
+        writer.close(state['size'])
+    return state['size']
+
+
+def convert_files(chunks, paths, name=None, threads=None):
+    """ Converts the raw image read from `chunks` to each format in the
+    dict `paths`, which maps format names (see FORMATS) to output paths.
+    Returns the size of the raw image. """
+    files = []
+    try:
+        writers = []
+        for fmt, path in sorted(paths.items()):
+            f = open(path, 'w+b')
+            files.append(f)
+            if fmt == 'vmdk' and name:
+                writers.append(VMDKWriter(f, name=name + '.vmdk'))
+            else:
+                writers.append(FORMATS[fmt](f))
+        size = convert(chunks, writers, threads=threads)
+        log.info('Converted {0} bytes to {1}'.format(
+            size, ', '.join(sorted(paths))))
+        return size
+    finally:
+        for f in files:
+            f.close()
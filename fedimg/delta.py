@@ -0,0 +1,102 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+Writes an image onto a device that holds an earlier build of it, writing
+only the blocks that changed.
+
+A utility volume created from the previous build's snapshot already holds
+most of the new image. Leaving its unchanged blocks untouched means the
+snapshot taken of it afterwards only has to store the blocks that were
+written, since EBS snapshots of a volume are incremental to the snapshot it
+was created from.
+
+This module is copied to the utility node and run there as a script, so it
+only uses the standard library:
+
+    xzcat image.raw.xz | python delta.py /dev/xvdb 4M
+"""
+
+import os
+import sys
+
+BLOCK_SIZE = 1024 * 1024
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    """ Parses a block size like dd's (ex. "4M") into bytes. """
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(text[:-1]) * UNITS[text[-1]]
+    return int(text)
+
+
+def _read_full(fileobj, size):
+    """ Reads `size` bytes from `fileobj`, short only at its end. """
+    chunks = []
+    while size > 0:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def write_delta(src, dst, block_size=BLOCK_SIZE):
+    """ Writes what's read from `src` onto `dst`, a file opened for reading
+    and writing, skipping the blocks that `dst` already holds. Returns the
+    number of blocks read and of blocks written. """
+    blocks = written = 0
+    offset = 0
+    while True:
+        block = _read_full(src, block_size)
+        if not block:
+            break
+        dst.seek(offset)
+        if _read_full(dst, len(block)) != block:
+            dst.seek(offset)
+            dst.write(block)
+            written += 1
+        blocks += 1
+        offset += len(block)
+    dst.flush()
+    os.fsync(dst.fileno())
+    return blocks, written
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        sys.stderr.write('Usage: delta.py <device> [block size]\n')
+        return 2
+    block_size = parse_size(argv[2]) if len(argv) == 3 else BLOCK_SIZE
+    src = getattr(sys.stdin, 'buffer', sys.stdin)
+    with open(argv[1], 'r+b') as dst:
+        blocks, written = write_delta(src, dst, block_size)
+    sys.stdout.write('{0} of {1} blocks written\n'.format(written, blocks))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
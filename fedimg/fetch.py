@@ -0,0 +1,194 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+Downloads an image over several HTTP connections at once.
+
+A single stream from a mirror usually caps well below what the utility node
+and its volume can take. This fetches the image in ranges over several
+connections and writes them to stdout in order, for the decompressor to
+read. Redirects are followed once, and the ranges are all fetched from where
+they led. Servers that don't do ranges are read as a single stream. How the
+image was fetched and how fast is reported on stderr.
+
+This module is copied to the utility node and run there as a script, so it
+only uses the standard library:
+
+    python fetch.py https://.../image.raw.xz 4 | xzcat > /dev/xvdb
+"""
+
+import re
+import sys
+import threading
+import time
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+
+CHUNK_SIZE = 8 * 1024 * 1024
+READ_SIZE = 64 * 1024
+RETRIES = 3
+
+
+def probe(url):
+    """ Asks for the first byte of `url`, following any redirects. Returns
+    the URL they led to, the size of the file if the server serves ranges
+    (or None), and the response. """
+    response = urlopen(Request(url, headers={'Range': 'bytes=0-0'}))
+    match = re.match(r'bytes 0-0/(\d+)',
+                     response.headers.get('Content-Range') or '')
+    if response.getcode() == 206 and match:
+        return response.geturl(), int(match.group(1)), response
+    return response.geturl(), None, response
+
+
+def copy_stream(response, out):
+    """ Writes the rest of `response` to `out`. Returns the bytes copied. """
+    copied = 0
+    while True:
+        data = response.read(READ_SIZE)
+        if not data:
+            return copied
+        out.write(data)
+        copied += len(data)
+
+
+class RangedFetch(object):
+    """ Fetches the `size` bytes of `url` in ranges of `chunk_size` over
+        `connections` connections. No more than two ranges per connection
+        are held in memory waiting for the ones before them. """
+
+    def __init__(self, url, size, connections, chunk_size=CHUNK_SIZE):
+        self.url = url
+        self.size = size
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.count = (size + chunk_size - 1) // chunk_size
+        self.window = connections * 2
+        self.cond = threading.Condition()
+        self.next = 0
+        self.written = 0
+        self.done = {}
+        self.error = None
+
+    def _range(self, index):
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size) - 1
+
+    def _get(self, index):
+        start, end = self._range(index)
+        for attempt in range(RETRIES):
+            try:
+                response = urlopen(Request(self.url, headers={
+                    'Range': 'bytes={0}-{1}'.format(start, end)}))
+                if response.getcode() != 206:
+                    raise IOError('Range {0}-{1} got status {2}'.format(
+                        start, end, response.getcode()))
+                data = response.read()
+                if len(data) != end - start + 1:
+                    raise IOError('Range {0}-{1} came back short'.format(
+                        start, end))
+                return data
+            except Exception:
+                if attempt == RETRIES - 1:
+                    raise
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while (self.next < self.count and self.error is None and
+                       self.next >= self.written + self.window):
+                    self.cond.wait()
+                if self.next >= self.count or self.error is not None:
+                    return
+                index = self.next
+                self.next += 1
+            try:
+                data = self._get(index)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.done[index] = data
+                self.cond.notify_all()
+
+    def run(self, out):
+        """ Writes the file to `out`, in order. Returns the bytes written. """
+        workers = [threading.Thread(target=self._work)
+                   for _ in range(min(self.connections, self.count))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        for index in range(self.count):
+            with self.cond:
+                while index not in self.done and self.error is None:
+                    self.cond.wait()
+                if self.error is not None:
+                    raise self.error
+                data = self.done.pop(index)
+            out.write(data)
+            with self.cond:
+                self.written = index + 1
+                self.cond.notify_all()
+        return self.size
+
+
+def fetch(url, out, connections, chunk_size=CHUNK_SIZE):
+    """ Writes the file at `url` to `out`, over `connections` connections
+    if the server serves ranges. Returns how it was fetched, and the bytes
+    written. """
+    url, size, response = probe(url)
+    if size is None:
+        # The whole file is on its way already
+        return 'a single stream', copy_stream(response, out)
+    response.close()
+    if connections < 2 or size <= chunk_size:
+        response = urlopen(url)
+        return 'a single stream', copy_stream(response, out)
+    return ('{0} ranged connections'.format(connections),
+            RangedFetch(url, size, connections, chunk_size).run(out))
+
+
+def main(argv):
+    if len(argv) not in (3, 4):
+        sys.stderr.write('Usage: fetch.py <url> <connections> '
+                         '[chunk size]\n')
+        return 2
+    chunk_size = int(argv[3]) if len(argv) == 4 else CHUNK_SIZE
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    started = time.time()
+    mode, size = fetch(argv[1], out, int(argv[2]), chunk_size)
+    out.flush()
+    elapsed = max(time.time() - started, 0.001)
+    sys.stderr.write('Fetched {0} bytes over {1} in {2:.1f}s '
+                     '({3:.1f} MB/s)\n'.format(size, mode, elapsed,
+                                               size / elapsed / 1024 ** 2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
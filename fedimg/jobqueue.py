@@ -0,0 +1,603 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+A queue of upload jobs shared by worker processes on any number of hosts.
+
+With the `queue` option set, the consumer only takes images in: every job
+of every enabled provider is put on the queue instead of run. Workers (see
+`bin/fedimg-worker.py`) lease jobs off it for the providers they have free
+pool slots for, and renew their leases while the jobs run. A job whose lease
+runs out, because its worker died or lost touch with the queue, goes back on
+the queue for another worker to pick up, until it has been tried too many
+times; such jobs are purged after a while. Workers that stop hand their jobs
+back, to be resumed where they stopped where possible (see fedimg.uploader).
+
+The queue is an SQLite database, fine on one host or on a filesystem with
+working locks, or a Redis server, if the `redis` package is installed.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import fedimg
+import fedimg.cancel
+import fedimg.ledger
+import fedimg.services
+import fedimg.uploader
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Reason jobs are cancelled for when their worker's lease was taken over
+LEASE_LOST = 'lease lost'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider TEXT NOT NULL,
+    url TEXT NOT NULL,
+    label TEXT NOT NULL,
+    compose TEXT,
+    checksum TEXT,
+    state TEXT,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_provider ON jobs (provider, id);
+"""
+
+
+def _entry(id, provider, url, label, compose, checksum, state, attempts):
+    """ Returns a leased job as handed to workers. """
+    return {'id': id, 'provider': provider, 'url': url, 'label': label,
+            'compose': json.loads(compose or 'null'), 'checksum': checksum,
+            'state': json.loads(state or 'null'), 'attempts': attempts}
+
+
+class SQLiteQueue(object):
+    """ A job queue in the SQLite database at `path`. Leases are taken in
+        a write transaction, so that no two workers get the same job. """
+
+    def __init__(self, path, attempts=None):
+        self.path = path
+        self.attempts = attempts or fedimg.QUEUE_ATTEMPTS
+        self.lock = threading.Lock()
+        if path != ':memory:':
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        # Transactions are begun explicitly
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+
+    def _write(self, sql, args=()):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute(sql, args)
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return cursor
+
+    def put(self, provider, url, label, compose=None, checksum=None,
+            state=None):
+        """ Queues the job `label` of `provider` for the image at `url`.
+        Returns its ID. """
+        cursor = self._write(
+            "INSERT INTO jobs (provider, url, label, compose, checksum, "
+            "state, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (provider, url, label, json.dumps(compose), checksum,
+             None if state is None else json.dumps(state), time.time()))
+        return cursor.lastrowid
+
+    def lease(self, worker, seconds, providers):
+        """ Leases the oldest job of one of `providers` that's waiting or
+        whose lease ran out to `worker` for `seconds`. Returns the job, or
+        None if there's none. """
+        if not providers:
+            return None
+        now = time.time()
+        marks = ', '.join('?' * len(providers))
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT id, provider, url, label, compose, checksum, "
+                    "state, attempts FROM jobs "
+                    "WHERE provider IN ({0}) AND attempts < ? "
+                    "AND (worker IS NULL OR lease_until < ?) "
+                    "ORDER BY id LIMIT 1".format(marks),
+                    tuple(providers) + (self.attempts, now)).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET worker = ?, lease_until = ?, "
+                        "attempts = attempts + 1 WHERE id = ?",
+                        (worker, now + seconds, row[0]))
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        if row is None:
+            return None
+        return _entry(*(row[:7] + (row[7] + 1,)))
+
+    def renew(self, id, worker, seconds):
+        """ Extends `worker`'s lease of the job `id` by `seconds`. Returns
+        False if the lease was lost to another worker. """
+        cursor = self._write(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?",
+            (time.time() + seconds, id, worker))
+        return cursor.rowcount == 1
+
+    def done(self, id, worker):
+        """ Removes the job `id`, once `worker` is done with it. """
+        self._write("DELETE FROM jobs WHERE id = ? AND worker = ?",
+                    (id, worker))
+
+    def release(self, id, worker, state=None):
+        """ Puts the job `id` back on the queue for another worker to run
+        again, or with `state`, to resume. Handing a job back doesn't count
+        as an attempt. """
+        self._write(
+            "UPDATE jobs SET worker = NULL, lease_until = NULL, state = ?, "
+            "attempts = attempts - 1 WHERE id = ? AND worker = ?",
+            (None if state is None else json.dumps(state), id, worker))
+
+    def dead(self):
+        """ Returns the IDs and labels of the jobs that were tried too many
+        times to be leased again. """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, label FROM jobs WHERE attempts >= ? "
+                "AND lease_until < ? ORDER BY id",
+                (self.attempts, time.time())).fetchall()
+
+    def purge(self, age):
+        """ Removes the jobs that were given up on more than `age` seconds
+        ago. Returns how many there were. """
+        cursor = self._write(
+            "DELETE FROM jobs WHERE attempts >= ? AND lease_until < ?",
+            (self.attempts, time.time() - age))
+        return cursor.rowcount
+
+    def entries(self):
+        """ Returns the ID and image URL of every job on the queue, and
+        whether a worker holds its lease. """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, url, worker IS NOT NULL AND lease_until >= ? "
+                "FROM jobs ORDER BY id", (time.time(),)).fetchall()
+        return [(id, url, bool(leased)) for id, url, leased in rows]
+
+    def remove(self, id, pending_only=False):
+        """ Removes the job `id`, unless with `pending_only`, a worker holds
+        its lease. A worker that does loses it, and cancels the job. Returns
+        True if the job was removed. """
+        sql = "DELETE FROM jobs WHERE id = ?"
+        if pending_only:
+            sql += " AND (worker IS NULL OR lease_until < ?)"
+            cursor = self._write(sql, (id, time.time()))
+        else:
+            cursor = self._write(sql, (id,))
+        return cursor.rowcount == 1
+
+
+# Moves the jobs whose lease ran out back to the head of their provider's
+# list, or to the dead set once they were tried too often, then leases the
+# first job of the first of the lists in KEYS[3:] that has one.
+LEASE_SCRIPT = """
+local prefix, now = KEYS[1], tonumber(ARGV[1])
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], 0, now)) do
+    redis.call('ZREM', KEYS[2], id)
+    local job = prefix .. 'job:' .. id
+    redis.call('HDEL', job, 'worker')
+    if tonumber(redis.call('HGET', job, 'attempts')) >= tonumber(ARGV[4]) then
+        redis.call('HSET', job, 'died', now)
+        redis.call('SADD', prefix .. 'dead', id)
+    else
+        local provider = redis.call('HGET', job, 'provider')
+        redis.call('LPUSH', prefix .. 'pending:' .. provider, id)
+    end
+end
+for i = 3, #KEYS do
+    local id = redis.call('LPOP', KEYS[i])
+    if id then
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), id)
+        redis.call('HSET', prefix .. 'job:' .. id, 'worker', ARGV[3])
+        redis.call('HINCRBY', prefix .. 'job:' .. id, 'attempts', 1)
+        return id
+    end
+end
+return false
+"""
+
+# Runs ARGV[3] (renew, done or release) on the job KEYS[3] if ARGV[2] still
+# holds its lease
+OWNED_SCRIPT = """
+if redis.call('HGET', KEYS[3], 'worker') ~= ARGV[2] then
+    return 0
+end
+local action = ARGV[3]
+if action == 'renew' then
+    redis.call('ZADD', KEYS[2], tonumber(ARGV[1]), ARGV[4])
+elseif action == 'done' then
+    redis.call('ZREM', KEYS[2], ARGV[4])
+    redis.call('DEL', KEYS[3])
+else
+    redis.call('ZREM', KEYS[2], ARGV[4])
+    redis.call('HDEL', KEYS[3], 'worker')
+    redis.call('HSET', KEYS[3], 'state', ARGV[5])
+    redis.call('HINCRBY', KEYS[3], 'attempts', -1)
+    local provider = redis.call('HGET', KEYS[3], 'provider')
+    redis.call('LPUSH', KEYS[1] .. 'pending:' .. provider, ARGV[4])
+end
+return 1
+"""
+
+# Removes the job KEYS[3] with ID ARGV[1], unless ARGV[2] is set and a
+# worker holds its lease
+REMOVE_SCRIPT = """
+local provider = redis.call('HGET', KEYS[3], 'provider')
+if not provider then
+    return 0
+end
+if ARGV[2] == '1' and redis.call('HEXISTS', KEYS[3], 'worker') == 1 then
+    return 0
+end
+redis.call('LREM', KEYS[1] .. 'pending:' .. provider, 0, ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('SREM', KEYS[1] .. 'dead', ARGV[1])
+redis.call('DEL', KEYS[3])
+return 1
+"""
+
+
+class RedisQueue(object):
+    """ A job queue on the Redis server at `url`: a hash for each job, a
+        list of waiting job IDs for each provider and a sorted set of leases
+        by expiry. Leases are taken and given up by scripts, which Redis
+        runs atomically. """
+
+    def __init__(self, url, attempts=None, prefix='fedimg:'):
+        if redis is None:
+            raise ValueError('The redis package is needed to use {0} as '
+                             'the job queue'.format(url))
+        self.client = redis.StrictRedis.from_url(url)
+        self.attempts = attempts or fedimg.QUEUE_ATTEMPTS
+        self.prefix = prefix
+        self.leases = prefix + 'leases'
+        self._lease = self.client.register_script(LEASE_SCRIPT)
+        self._owned = self.client.register_script(OWNED_SCRIPT)
+        self._remove = self.client.register_script(REMOVE_SCRIPT)
+
+    def _job(self, id):
+        return '{0}job:{1}'.format(self.prefix, id)
+
+    def put(self, provider, url, label, compose=None, checksum=None,
+            state=None):
+        """ Queues the job `label` of `provider` for the image at `url`.
+        Returns its ID. """
+        id = self.client.incr(self.prefix + 'ids')
+        pipe = self.client.pipeline()
+        pipe.hmset(self._job(id), {
+            'provider': provider, 'url': url, 'label': label,
+            'compose': json.dumps(compose), 'checksum': checksum or '',
+            'state': json.dumps(state), 'attempts': 0,
+            'created': time.time()})
+        pipe.rpush('{0}pending:{1}'.format(self.prefix, provider), id)
+        pipe.execute()
+        return id
+
+    def lease(self, worker, seconds, providers):
+        """ Leases the oldest job of one of `providers` that's waiting or
+        whose lease ran out to `worker` for `seconds`. Returns the job, or
+        None if there's none. """
+        if not providers:
+            return None
+        keys = [self.prefix, self.leases] + [
+            '{0}pending:{1}'.format(self.prefix, p) for p in providers]
+        id = self._lease(keys=keys, args=[time.time(), seconds, worker,
+                                          self.attempts])
+        if not id:
+            return None
+        job = self.client.hgetall(self._job(int(id)))
+        return _entry(int(id), job['provider'], job['url'], job['label'],
+                      job['compose'], job['checksum'] or None, job['state'],
+                      int(job['attempts']))
+
+    def _call(self, action, id, worker, seconds=0, state=None):
+        return self._owned(
+            keys=[self.prefix, self.leases, self._job(id)],
+            args=[time.time() + seconds, worker, action, id,
+                  json.dumps(state)]) == 1
+
+    def renew(self, id, worker, seconds):
+        """ Extends `worker`'s lease of the job `id` by `seconds`. Returns
+        False if the lease was lost to another worker. """
+        return self._call('renew', id, worker, seconds)
+
+    def done(self, id, worker):
+        """ Removes the job `id`, once `worker` is done with it. """
+        self._call('done', id, worker)
+
+    def release(self, id, worker, state=None):
+        """ Puts the job `id` back on the queue for another worker to run
+        again, or with `state`, to resume. Handing a job back doesn't count
+        as an attempt. """
+        self._call('release', id, worker, state=state)
+
+    def dead(self):
+        """ Returns the IDs and labels of the jobs that were tried too many
+        times to be leased again. """
+        ids = sorted(int(id) for id in
+                     self.client.smembers(self.prefix + 'dead'))
+        return [(id, self.client.hget(self._job(id), 'label'))
+                for id in ids]
+
+    def purge(self, age):
+        """ Removes the jobs that were given up on more than `age` seconds
+        ago. Returns how many there were. """
+        before = time.time() - age
+        purged = 0
+        for id in self.client.smembers(self.prefix + 'dead'):
+            died = self.client.hget(self._job(int(id)), 'died')
+            if died is None or float(died) < before:
+                purged += self.remove(int(id))
+        return purged
+
+    def entries(self):
+        """ Returns the ID and image URL of every job on the queue, and
+        whether a worker holds its lease. """
+        pending = []
+        for key in self.client.scan_iter(self.prefix + 'pending:*'):
+            pending.extend(int(id) for id in self.client.lrange(key, 0, -1))
+        leased = [int(id) for id in self.client.zrange(self.leases, 0, -1)]
+        entries = []
+        for id in sorted(pending + leased):
+            url = self.client.hget(self._job(id), 'url')
+            if url is not None:
+                entries.append((id, url, id in leased))
+        return entries
+
+    def remove(self, id, pending_only=False):
+        """ Removes the job `id`, unless with `pending_only`, a worker holds
+        its lease. A worker that does loses it, and cancels the job. Returns
+        True if the job was removed. """
+        return self._remove(
+            keys=[self.prefix, self.leases, self._job(id)],
+            args=[id, '1' if pending_only else '0']) == 1
+
+
+def open_queue(location):
+    """ Returns the job queue at `location`: a redis:// URL, or the path of
+    an SQLite database. """
+    if location.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisQueue(location)
+    return SQLiteQueue(location)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """ Returns the job queue configured for fedimg, or None if jobs run in
+    the consumer. """
+    global _queue
+    if not fedimg.QUEUE:
+        return None
+    with _queue_lock:
+        if _queue is None:
+            _queue = open_queue(fedimg.QUEUE)
+    return _queue
+
+
+class Worker(object):
+    """ Runs the jobs leased off `queue` on this host, as many at a time
+        for each provider as its `concurrency` option allows, renewing their
+        leases every third of `lease` seconds. """
+
+    def __init__(self, queue, name=None, lease=None, poll=5):
+        self.queue = queue
+        self.name = name or fedimg.ledger.owner()
+        self.lease = lease or fedimg.QUEUE_LEASE
+        self.poll = poll
+        self.providers = fedimg.services.get_providers()
+        # Free pool slots, by provider
+        self.slots = dict((p, fedimg.PROVIDER_CONCURRENCY.get(p, 1))
+                          for p in self.providers)
+        # Cancellation tokens of the running jobs, by job ID
+        self.running = {}
+        self.cond = threading.Condition()
+        self.stopping = threading.Event()
+        # When the jobs given up on are next purged
+        self.next_purge = 0
+
+    def run(self):
+        """ Leases and runs jobs until `stop` is called. """
+        log.info('Worker {0} taking {1} jobs'.format(
+            self.name, ', '.join(sorted(self.providers))))
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     name='fedimg-heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+        while not self.stopping.is_set():
+            try:
+                taken = self.take()
+            except Exception:
+                log.exception('Could not lease a job')
+                taken = False
+            if not taken:
+                self.purge()
+                self.stopping.wait(self.poll)
+
+    def purge(self):
+        """ Removes the jobs that were given up on longer ago than the
+        `queue_retention` option allows, at most once an hour. """
+        if not fedimg.QUEUE_RETENTION or time.time() < self.next_purge:
+            return
+        self.next_purge = time.time() + 60 * 60
+        try:
+            purged = self.queue.purge(fedimg.QUEUE_RETENTION)
+        except Exception:
+            log.exception('Could not purge the jobs given up on')
+            return
+        if purged:
+            log.info('Purged {0} jobs given up on'.format(purged))
+
+    def stop(self):
+        """ Stops leasing jobs. """
+        self.stopping.set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def take(self):
+        """ Leases a job for a provider with a free slot and starts it.
+        Returns False if there was none. """
+        with self.cond:
+            free = sorted(p for p, n in self.slots.items() if n > 0)
+        entry = self.queue.lease(self.name, self.lease, free)
+        if entry is None:
+            return False
+        token = fedimg.cancel.Token()
+        with self.cond:
+            self.slots[entry['provider']] -= 1
+            self.running[entry['id']] = token
+        thread = threading.Thread(target=self._work, args=(entry, token),
+                                  name='fedimg-job-{0}'.format(entry['id']))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _work(self, entry, token):
+        """ Runs the leased job `entry`, then tells the queue it's done, or
+        hands it back if it was cut short by `drain`. """
+        try:
+            job = fedimg.uploader.find_job(
+                entry['provider'], entry['url'], entry['label'],
+                entry['checksum'])
+            if job is None:
+                # Never going to work here; drop it
+                self.queue.done(entry['id'], self.name)
+                return
+            if hasattr(job, 'cancel'):
+                job.cancel = token
+            if not token.start():
+                self.queue.release(entry['id'], self.name, entry['state'])
+                return
+
+            log.info('Running {0} (attempt {1})'.format(
+                entry['label'], entry['attempts']))
+            try:
+                if entry['state'] is not None:
+                    result = job.resume(entry['state'], entry['compose'])
+                else:
+                    result = job.upload(entry['compose'])
+            except fedimg.cancel.JobCancelled as e:
+                log.info('{0} was cancelled: {1}'.format(entry['label'], e))
+                result = 1
+            except Exception:
+                log.exception('{0} upload job failed'.format(
+                    entry['provider']))
+                result = 1
+
+            if result != 0 and token.reason == fedimg.cancel.SHUTDOWN:
+                checkpoint = getattr(job, 'checkpoint', None)
+                self.queue.release(entry['id'], self.name,
+                                   checkpoint() if checkpoint else None)
+            elif token.reason != LEASE_LOST:
+                self.queue.done(entry['id'], self.name)
+        except Exception:
+            # The lease runs out, and another worker tries again
+            log.exception('Could not run {0}'.format(entry['label']))
+        finally:
+            with self.cond:
+                self.running.pop(entry['id'], None)
+                self.slots[entry['provider']] += 1
+                self.cond.notify_all()
+
+    def _heartbeat(self):
+        """ Renews the leases of the running jobs until they're all done,
+        cancelling those whose lease was lost. """
+        while True:
+            with self.cond:
+                if self.stopping.is_set() and not self.running:
+                    return
+                running = list(self.running.items())
+            for id, token in running:
+                try:
+                    if not self.queue.renew(id, self.name, self.lease):
+                        token.cancel(LEASE_LOST)
+                except Exception:
+                    # Tried again on the next beat, before the lease is up
+                    log.exception('Could not renew the lease of job '
+                                  '{0}'.format(id))
+            # Woken early as jobs finish, to stop once they all have
+            with self.cond:
+                if self.running or not self.stopping.is_set():
+                    self.cond.wait(self.lease / 3.0)
+
+    def drain(self, grace=None):
+        """ Stops leasing jobs and gives the running ones `grace` seconds
+        (by default, the `shutdown_grace` option) to finish. The rest are
+        cancelled, and handed back to the queue once they've cleaned up, to
+        be resumed where possible. Returns True if every job was done or
+        handed back in time. """
+        if grace is None:
+            grace = fedimg.SHUTDOWN_GRACE
+        self.stop()
+        if self._wait(grace):
+            return True
+        with self.cond:
+            tokens = list(self.running.values())
+        log.info('Cancelling {0} upload jobs still running'.format(
+            len(tokens)))
+        for token in tokens:
+            token.cancel(fedimg.cancel.SHUTDOWN)
+        # Whatever is still running after that is picked up elsewhere once
+        # its lease runs out
+        return self._wait(grace)
+
+    def _wait(self, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.running:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                self.cond.wait(left)
+        return True
@@ -0,0 +1,319 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+A record of what a fedimg process has running, so that the next one can
+clean up or carry on after it.
+
+Every instance and volume an upload job creates is recorded until it's
+destroyed, along with the process that created it. Jobs still queued or
+running when the consumer shuts down are recorded as checkpoints: either to
+be run again from the start, or, for jobs that only had long waits left
+(like copies to complete before they're made public), to be resumed where
+they stopped. When a consumer starts, it destroys what dead processes on its
+host left running and picks up their checkpoints.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import errno
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import fedimg
+from fedimg.util import get_aws_amis
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    region TEXT,
+    build TEXT,
+    owner TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider TEXT NOT NULL,
+    url TEXT NOT NULL,
+    label TEXT NOT NULL,
+    compose TEXT,
+    checksum TEXT,
+    state TEXT,
+    created REAL NOT NULL
+);
+"""
+
+RESOURCE_COLUMNS = ('id', 'kind', 'region', 'build', 'owner', 'created')
+
+# The tag a node being deployed is found by, before its ID is known
+DEPLOY_TAG = 'fedimg-deploy'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def start_nonce(pid):
+    """ Returns a string that tells the process `pid` apart from any other
+    that has had its PID since the host booted, or from before it booted:
+    the boot ID and the process's start time, from /proc. Returns None if
+    they can't be read (the process is gone, or there's no /proc). """
+    boot_id = _read('/proc/sys/kernel/random/boot_id')
+    stat = _read('/proc/{0}/stat'.format(pid))
+    if not boot_id or not stat:
+        return None
+    # The command name can hold spaces, so count from the ')' after it;
+    # the start time is the 22nd field.
+    fields = stat[stat.rindex(')') + 2:].split()
+    return '{0}.{1}'.format(boot_id.strip(), fields[19])
+
+
+def owner():
+    """ Returns the name of this process in the ledger. """
+    pid = os.getpid()
+    nonce = start_nonce(pid)
+    if nonce is None:
+        return '{0}:{1}'.format(socket.gethostname(), pid)
+    return '{0}:{1}:{2}'.format(socket.gethostname(), pid, nonce)
+
+
+def dead(name):
+    """ Returns True if `name` is a process on this host that isn't running
+    anymore, even if its PID has been given to another process since.
+    Processes on other hosts are never taken for dead. """
+    parts = name.split(':')
+    host, pid = parts[:2]
+    nonce = parts[2] if len(parts) > 2 else None
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    if nonce is not None:
+        current = start_nonce(pid)
+        return current is not None and current != nonce
+    return False
+
+
+class Ledger(object):
+    """ An SQLite ledger of live resources and checkpoints, safe to share
+        between threads, and between processes on a host. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path != ':memory:':
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+
+    def add(self, kind, id, region=None, build=None):
+        """ Records that this process created the resource `id`, of `kind`
+        ('node' or 'volume'), in `region`. A node being deployed is recorded
+        as a 'deploy', by the value of its DEPLOY_TAG tag. """
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO resources "
+                    "(id, kind, region, build, owner, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (id, kind, region, build, owner(), time.time()))
+
+    def remove(self, id):
+        """ Records that the resource `id` is gone. """
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM resources WHERE id = ?",
+                                  (id,))
+
+    def resources(self):
+        """ Returns every recorded resource, as dicts. """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM resources ORDER BY created").fetchall()
+        return [dict(zip(RESOURCE_COLUMNS, [row[c] for c in
+                                            RESOURCE_COLUMNS]))
+                for row in rows]
+
+    def leftovers(self):
+        """ Returns the resources recorded by dead processes. """
+        return [r for r in self.resources() if dead(r['owner'])]
+
+    def checkpoint(self, provider, url, label, compose=None, checksum=None,
+                   state=None):
+        """ Records that the job `label` of `provider` for the image at
+        `url` is to be run again, or with `state`, resumed from there. """
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO checkpoints "
+                    "(provider, url, label, compose, checksum, state, "
+                    "created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (provider, url, label, json.dumps(compose), checksum,
+                     None if state is None else json.dumps(state),
+                     time.time()))
+
+    def take_checkpoints(self):
+        """ Returns every recorded checkpoint, as dicts, and forgets them so
+        that no other process picks them up too. """
+        with self.lock:
+            with self.conn:
+                rows = self.conn.execute(
+                    "SELECT * FROM checkpoints ORDER BY id").fetchall()
+                self.conn.execute("DELETE FROM checkpoints WHERE id <= ?",
+                                  (rows[-1]['id'] if rows else 0,))
+        return [{'provider': row['provider'], 'url': row['url'],
+                 'label': row['label'],
+                 'compose': json.loads(row['compose'] or 'null'),
+                 'checksum': row['checksum'],
+                 'state': json.loads(row['state'] or 'null')}
+                for row in rows]
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    """ Returns the ledger configured for fedimg, or None if there's
+    none. """
+    global _ledger
+    if not fedimg.LEDGER:
+        return None
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger(fedimg.LEDGER)
+    return _ledger
+
+
+def track(kind, id, region=None, build=None):
+    """ Records a new resource in the configured ledger, logging rather than
+    raising errors. """
+    try:
+        ledger = get_ledger()
+        if ledger is not None:
+            ledger.add(kind, id, region, build)
+    except Exception:
+        log.exception('Could not record {0} {1}'.format(kind, id))
+
+
+def untrack(id):
+    """ Records that a resource is gone in the configured ledger. """
+    try:
+        ledger = get_ledger()
+        if ledger is not None:
+            ledger.remove(id)
+    except Exception:
+        log.exception('Could not forget {0}'.format(id))
+
+
+def _keep_volumes(ledger, node, resource):
+    """ Records the volumes `node` keeps once terminated, so that they're
+    reclaimed too once they're detached. """
+    for mapping in node.extra.get('block_device_mapping') or []:
+        if mapping['ebs'].get('delete') == 'false':
+            ledger.add('volume', mapping['ebs']['volume_id'],
+                       resource['region'], resource['build'])
+
+
+def reclaim(ledger):
+    """ Destroys the resources that dead processes left behind, and forgets
+    them. Returns the IDs of those destroyed. """
+    drivers = dict((a['region'], a['driver']) for a in get_aws_amis())
+    reclaimed = []
+    for resource in ledger.leftovers():
+        cls = drivers.get(resource['region'])
+        if cls is None:
+            log.warn('Cannot reclaim {0} in unknown region {1}'.format(
+                resource['id'], resource['region']))
+            continue
+        driver = cls(fedimg.AWS_ACCESS_ID, fedimg.AWS_SECRET_KEY)
+        try:
+            if resource['kind'] == 'node':
+                nodes = driver.list_nodes(ex_node_ids=[resource['id']])
+                for node in nodes:
+                    driver.destroy_node(node)
+            elif resource['kind'] == 'deploy':
+                nodes = driver.list_nodes(ex_filters={
+                    'tag:' + DEPLOY_TAG: resource['id']})
+                for node in nodes:
+                    driver.destroy_node(node)
+                    _keep_volumes(ledger, node, resource)
+            else:
+                volumes = [v for v in driver.list_volumes()
+                           if v.id == resource['id']]
+                for volume in volumes:
+                    driver.destroy_volume(volume)
+        except Exception:
+            # Left for the next start, or the reaper
+            log.exception('Could not reclaim {0} {1}'.format(
+                resource['kind'], resource['id']))
+            continue
+        log.info('Reclaimed {0} {1} left by {2}'.format(
+            resource['kind'], resource['id'], resource['owner']))
+        ledger.remove(resource['id'])
+        reclaimed.append(resource['id'])
+    return reclaimed
+
+
+def recover():
+    """ Reclaims what dead processes left behind and resumes their
+    checkpoints, from a thread of its own. """
+    try:
+        ledger = get_ledger()
+    except Exception:
+        log.exception('Could not open the ledger')
+        return None
+    if ledger is None:
+        return None
+
+    def run():
+        import fedimg.uploader
+        try:
+            reclaim(ledger)
+            checkpoints = ledger.take_checkpoints()
+            if checkpoints:
+                log.info('Resuming {0} jobs handed off at shutdown'.format(
+                    len(checkpoints)))
+                fedimg.uploader.resume(checkpoints)
+        except Exception:
+            log.exception('Recovering from the last shutdown failed')
+
+    thread = threading.Thread(target=run, name='fedimg-recover')
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -21,18 +21,22 @@
 
 import fedmsg
 
+import fedimg.catalog
+
 """
 The latest Fedmsg meta code for Fedimg fedmsgs (what a mouthful!):
 https://github.com/fedora-infra/fedmsg_meta_fedora_infrastructure/blob/develop/fedmsg_meta_fedora_infrastructure/fedimg.py
 """
 
 
-def message(topic, image_url, dest, status, compose, extra=None):
+def message(topic, image_url, dest, status, compose, extra=None,
+            record=True):
     """ Takes a message topic, image name, an upload destination (ex.
     "EC2-eu-west-1"), and a status (ex. "failed"). Can also take an optional
     dictionary of addiitonal bits of information, such as an AMI ID for an
     image registered to AWS EC2. Emits a fedmsg appropriate
-    for each image task (an upload or a test). """
+    for each image task (an upload or a test). Completed uploads are
+    recorded in the catalog unless `record` is False. """
 
     extra = extra or dict()
 
@@ -46,3 +50,7 @@ def message(topic, image_url, dest, status, compose, extra=None):
         'extra': extra,
         'compose': compose
     })
+
+    # Keep a local record of every image that's been made available
+    if topic == 'image.upload' and status == 'completed' and record:
+        fedimg.catalog.record(image_url, dest, compose, extra)
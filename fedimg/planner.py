@@ -0,0 +1,198 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Dry runs of the upload process.
+
+A plan lists the jobs fedimg would run for a set of images, what each of
+them would do, roughly how many cloud API calls it would make and how long it
+would take, without launching anything. Stage durations come from the traces
+of earlier runs (see fedimg.trace), falling back to rough defaults for stages
+that were never traced.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import glob
+import json
+import os
+
+import fedimg
+
+# Seconds each stage is assumed to take when no run of it was traced
+DEFAULT_DURATIONS = {
+    'build snapshot': 1500,
+    'take snapshot': 300,
+    'test': 600,
+    'copy': 900,
+    'copy snapshot': 900,
+    'job': 1800,
+}
+
+# API calls each stage makes, not counting the polling while it waits
+API_CALLS = {
+    'build snapshot': 9,
+    'register': 1,
+    'test': 3,
+    'copy': 1,
+    'copy snapshot': 2,
+    'publish': 1,
+}
+
+# Seconds between the polls a stage makes while it waits
+POLL_INTERVALS = {
+    'take snapshot': 10,
+    'copy': 20,
+    'copy snapshot': 20,
+}
+
+
+def api_calls(stage, seconds=0, wait=None):
+    """ Returns the number of API calls `stage` is expected to make if it
+    spends `seconds` polling in its `wait` stage (by default, itself). """
+    wait = wait or stage
+    polls = 0
+    if wait in POLL_INTERVALS:
+        polls = int(seconds // POLL_INTERVALS[wait])
+    return API_CALLS.get(stage, 0) + polls
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class Durations(object):
+    """ Typical stage durations, as medians of the `samples` (a dict mapping
+        (stage, region or provider) pairs to lists of seconds). """
+
+    def __init__(self, samples=None):
+        self.samples = samples or {}
+
+    @classmethod
+    def load(cls, directory=None):
+        """ Reads the stage durations out of the traces in `directory` (by
+        default, the trace directory). """
+        directory = directory or fedimg.TRACE_DIR
+        samples = {}
+        if not directory:
+            return cls(samples)
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            try:
+                with open(path) as f:
+                    events = json.load(f)['traceEvents']
+            except (IOError, ValueError, KeyError):
+                log.warn('Could not read trace {0}'.format(path))
+                continue
+            for event in events:
+                if event.get('ph') != 'X':
+                    continue
+                args = event.get('args', {})
+                if event['name'] == 'job':
+                    where = args.get('job', '').split(' ')[0]
+                else:
+                    where = args.get('region')
+                samples.setdefault((event['name'], where), []).append(
+                    event['dur'] / 1000000.0)
+        return cls(samples)
+
+    def get(self, stage, where=None):
+        """ Returns how long `stage` typically takes in `where` (a region,
+        or for whole jobs, a provider), or anywhere if it never ran there,
+        in seconds. """
+        if (stage, where) in self.samples:
+            return _median(self.samples[(stage, where)])
+        anywhere = [s for (name, _), values in self.samples.items()
+                    if name == stage for s in values]
+        if anywhere:
+            return _median(anywhere)
+        return DEFAULT_DURATIONS.get(stage, DEFAULT_DURATIONS['job'])
+
+
+def plan_jobs(jobs, durations=None, concurrency=None):
+    """ Plans the (provider, label, job) triples of `jobs`, run on each
+    provider's pool of `concurrency` (by default, the configured
+    concurrency) in order. Jobs with a `plan` method describe themselves;
+    others are only timed. Returns a dict with the planned jobs, the total
+    API calls and the number of seconds until the last job is done. """
+    if durations is None:
+        durations = Durations.load()
+    concurrency = concurrency or fedimg.PROVIDER_CONCURRENCY
+
+    seen = set()
+    slots = {}
+    planned = []
+    for provider, label, job in jobs:
+        if hasattr(job, 'plan'):
+            entry = job.plan(durations, seen)
+        else:
+            seconds = durations.get('job', provider)
+            entry = {'stages': [{'stage': 'job', 'seconds': seconds}],
+                     'images': [], 'api_calls': 0, 'seconds': seconds}
+        entry.update(provider=provider, job=label)
+
+        # Jobs start as soon as a slot of their provider's pool is free
+        free = slots.setdefault(provider,
+                                [0] * concurrency.get(provider, 1))
+        slot = free.index(min(free))
+        entry['start'] = free[slot]
+        entry['end'] = free[slot] + entry['seconds']
+        free[slot] = entry['end']
+        planned.append(entry)
+
+    return {
+        'jobs': planned,
+        'api_calls': sum(e['api_calls'] for e in planned),
+        'seconds': max([e['end'] for e in planned] or [0]),
+    }
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return '{0}h{1:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+
+def format_plan(plan):
+    """ Returns `plan` as readable text. """
+    lines = []
+    for entry in plan['jobs']:
+        lines.append('{0}  (+{1} to +{2}, ~{3} API calls)'.format(
+            entry['job'], _duration(entry['start']),
+            _duration(entry['end']), entry['api_calls']))
+        for stage in entry['stages']:
+            details = [stage.get('region'), stage.get('instance_type')]
+            if stage.get('source'):
+                details.append('from ' + stage['source'])
+            if stage.get('shared'):
+                details.append('shared')
+            lines.append('    {0:<16} {1:<40} {2}'.format(
+                stage['stage'], ' '.join(d for d in details if d),
+                _duration(stage['seconds'])))
+        for image in entry['images']:
+            lines.append('    registers {0} in {1}'.format(
+                image['name'], image['region']))
+    lines.append('{0} jobs, ~{1} API calls, done in about {2}'.format(
+        len(plan['jobs']), plan['api_calls'], _duration(plan['seconds'])))
+    return '\n'.join(lines)
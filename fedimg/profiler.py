@@ -0,0 +1,174 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+A sampling profiler for the running consumer.
+
+Sending the configured signal (SIGUSR2 by default) to the fedmsg-hub process
+starts sampling the stacks of all of its threads, upload pool workers
+included; sending it again stops sampling and writes the samples out in the
+collapsed stack format that flamegraph.pl and speedscope read. While the
+profiler isn't running, it costs nothing: there's no sampling thread and no
+tracing hook.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+import fedimg
+
+
+def collapse(frame):
+    """ Returns the stack ending at `frame` as semicolon-separated
+    functions, outermost first. """
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append('{0} ({1}:{2})'.format(
+            code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+
+class Profiler(object):
+    """ Samples the stacks of every thread but its own every `interval`
+        seconds, from a thread of its own, between `start` and `stop`. """
+
+    def __init__(self, interval=None):
+        self.interval = interval or fedimg.PROFILE_INTERVAL
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.thread = None
+
+    @property
+    def active(self):
+        return self.thread is not None
+
+    def start(self):
+        """ Starts sampling, discarding any earlier samples. """
+        if self.active:
+            return
+        self.samples = collections.Counter()
+        self.running.set()
+        self.thread = threading.Thread(target=self._run,
+                                       name='fedimg-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops sampling. Returns the samples, as a Counter of collapsed
+        stacks. """
+        if not self.active:
+            return self.samples
+        self.running.clear()
+        self.thread.join()
+        self.thread = None
+        return self.samples
+
+    def _run(self):
+        me = threading.current_thread().ident
+        while self.running.is_set():
+            self.sample(skip=me)
+            time.sleep(self.interval)
+
+    def sample(self, skip=None):
+        """ Adds a sample of the stack of every thread but `skip`. Stacks
+        start with the name of their thread. """
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        frames = sys._current_frames()
+        stacks = [names.get(ident, str(ident)) + ';' + collapse(frame)
+                  for ident, frame in frames.items() if ident != skip]
+        with self.lock:
+            self.samples.update(stacks)
+
+    def write(self, fileobj, samples=None):
+        """ Writes `samples` (by default, the last ones taken) to `fileobj`
+        in the collapsed stack format. """
+        if samples is None:
+            samples = self.samples
+        for stack, count in sorted(samples.items()):
+            fileobj.write('{0} {1}\n'.format(stack, count))
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    """ Returns the profiler of this process. """
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = Profiler()
+    return _profiler
+
+
+def toggle():
+    """ Starts the profiler if it's stopped. Otherwise, stops it and writes
+    its samples to a file in PROFILE_DIR, and returns that file's path. """
+    profiler = get_profiler()
+    if not profiler.active:
+        log.info('Starting the profiler')
+        profiler.start()
+        return None
+
+    samples = profiler.stop()
+    path = os.path.join(fedimg.PROFILE_DIR, 'fedimg-{0}-{1}.folded'.format(
+        os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+    try:
+        if not os.path.isdir(fedimg.PROFILE_DIR):
+            os.makedirs(fedimg.PROFILE_DIR)
+        with open(path, 'w') as f:
+            profiler.write(f, samples)
+    except (IOError, OSError):
+        log.exception('Could not write profile {0}'.format(path))
+        return None
+    log.info('Wrote {0} profile samples to {1}'.format(
+        sum(samples.values()), path))
+    return path
+
+
+def install(name=None):
+    """ Makes the signal called `name` (by default, PROFILE_SIGNAL) toggle
+    the profiler. Only works from the main thread. Returns True if the
+    handler was installed. """
+    name = name or fedimg.PROFILE_SIGNAL
+    if not name:
+        return False
+    signum = getattr(signal, name.upper(), None)
+    if signum is None:
+        log.error('Unknown signal {0}'.format(name))
+        return False
+    try:
+        signal.signal(signum, lambda signum, frame: toggle())
+    except ValueError:
+        log.warn('The profiler can only be installed from the main thread')
+        return False
+    return True
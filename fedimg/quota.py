@@ -0,0 +1,173 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Accounting of the per-region EC2 resources upload jobs use.
+
+AWS limits how many instances, volumes, pending snapshots and concurrent
+image copies an account can have in each region. Before an upload stage
+starts, it reserves what it's going to use; if that would go over a limit,
+the stage waits until other stages release enough. That way jobs queue up
+instead of failing halfway through.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import contextlib
+import threading
+import time
+
+from libcloud.compute.types import DeploymentException
+
+import fedimg
+import fedimg.trace
+
+RESOURCES = ('instances', 'volumes', 'snapshots', 'copies')
+
+# Defaults, for regions and resources without a configured limit
+DEFAULT_LIMITS = {
+    'instances': 20,
+    'volumes': 100,
+    'snapshots': 10,
+    'copies': 50,
+}
+
+# Errors EC2 gives when a limit is hit anyway, because something other than
+# fedimg uses the same account
+LIMIT_ERRORS = (
+    'InstanceLimitExceeded',
+    'VolumeLimitExceeded',
+    'ResourceLimitExceeded',
+    'SnapshotLimitExceeded',
+    'SnapshotCreationPerVolumeRateExceeded',
+    'PendingSnapshotLimitExceeded',
+    'RequestLimitExceeded',
+)
+
+
+def parse_limits(text):
+    """ Parses limits like "instances=10 eu-west-1:copies=5" into a dict
+    mapping regions (None for every region) to dicts of limits. """
+    limits = {None: dict(DEFAULT_LIMITS)}
+    for item in (text or '').split():
+        key, value = item.split('=')
+        region, _, resource = key.rpartition(':')
+        if resource not in RESOURCES:
+            raise ValueError("Unknown resource {0!r}".format(resource))
+        limits.setdefault(region or None, {})[resource] = int(value)
+    return limits
+
+
+class Accountant(object):
+    """ Keeps track of the resources reserved in each region, and makes
+        reservations that would go over a limit wait. """
+
+    def __init__(self, limits=None):
+        if limits is None or isinstance(limits, basestring):
+            limits = parse_limits(limits or fedimg.AWS_LIMITS)
+        self.limits = limits
+        self.in_use = {}
+        self.condition = threading.Condition()
+
+    def limit(self, region, resource):
+        """ Returns the limit on `resource` in `region`. """
+        return self.limits.get(region, {}).get(
+            resource, self.limits[None].get(resource))
+
+    def _fits(self, region, amounts):
+        for resource, amount in amounts.items():
+            in_use = self.in_use.get((region, resource), 0)
+            # Something bigger than the limit can still run on its own
+            if in_use and in_use + amount > self.limit(region, resource):
+                return False
+        return True
+
+    def acquire(self, region, **amounts):
+        """ Reserves `amounts` of resources (ex. instances=1, volumes=2) in
+        `region`, waiting until they are all available at once. """
+        with self.condition:
+            if not self._fits(region, amounts):
+                log.info('Waiting for {0} in {1}'.format(
+                    ', '.join('{0} {1}'.format(n, r)
+                              for r, n in sorted(amounts.items())), region))
+                with fedimg.trace.span('wait for quota', cat='wait',
+                                       region=region):
+                    while not self._fits(region, amounts):
+                        self.condition.wait()
+            for resource, amount in amounts.items():
+                key = (region, resource)
+                self.in_use[key] = self.in_use.get(key, 0) + amount
+
+    def release(self, region, **amounts):
+        """ Gives back resources reserved with `acquire`. """
+        with self.condition:
+            for resource, amount in amounts.items():
+                key = (region, resource)
+                self.in_use[key] = max(self.in_use.get(key, 0) - amount, 0)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, region, **amounts):
+        """ Holds a reservation for the duration of a `with` block. """
+        self.acquire(region, **amounts)
+        try:
+            yield
+        finally:
+            self.release(region, **amounts)
+
+    def usage(self, region):
+        """ Returns a dict of the resources reserved in `region`. """
+        with self.condition:
+            return dict((resource, self.in_use.get((region, resource), 0))
+                        for resource in RESOURCES)
+
+
+def retry(func, *args, **kwargs):
+    """ Calls `func`, waiting and calling it again for as long as EC2 says
+    a limit was hit. """
+    delay = 30
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except DeploymentException:
+            # The node was created; calling again would create another
+            raise
+        except Exception as e:
+            if not any(err in str(e) for err in LIMIT_ERRORS):
+                raise
+            log.warn('Hit an EC2 limit, retrying in {0} seconds: {1}'.format(
+                delay, e))
+            time.sleep(delay)
+            delay = min(delay * 2, 600)
+
+
+_accountant = None
+_accountant_lock = threading.Lock()
+
+
+def get_accountant():
+    """ Returns the accountant shared by all upload jobs. """
+    global _accountant
+    with _accountant_lock:
+        if _accountant is None:
+            _accountant = Accountant()
+    return _accountant
@@ -0,0 +1,171 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Clean-up of EC2 resources that failed upload jobs left behind.
+
+Only resources carrying the `build` tag that fedimg puts on its utility and
+test nodes, utility volumes and snapshots are considered, so nothing fedimg
+didn't create is ever touched.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import datetime
+import multiprocessing.pool
+import threading
+import time
+
+from libcloud.compute.types import NodeState
+
+import fedimg
+from fedimg.util import get_aws_amis
+
+
+def _age(when):
+    """ Returns the number of seconds since `when`, which is either a
+    datetime or an EC2 timestamp string. """
+    if isinstance(when, basestring):
+        when = datetime.datetime.strptime(when[:19], '%Y-%m-%dT%H:%M:%S')
+    if when.tzinfo is not None:
+        when = when.replace(tzinfo=None) - when.utcoffset()
+    return (datetime.datetime.utcnow() - when).total_seconds()
+
+
+class Reaper(object):
+    """ Scans every region fedimg uses for leftover fedimg nodes, volumes
+        and snapshots older than `max_age` seconds, and destroys them. With
+        `dry_run`, they are only logged. """
+
+    def __init__(self, max_age=None, dry_run=False):
+        self.max_age = max_age or fedimg.AWS_REAP_MAX_AGE
+        self.dry_run = dry_run
+
+        # One driver per region; the AMI list has an entry per arch
+        self.regions = {}
+        for ami in get_aws_amis():
+            self.regions.setdefault(ami['region'], ami['driver'])
+
+    def _reap(self, region, kind, resource, destroy):
+        """ Destroys `resource` with the `destroy` callable, unless this is
+        a dry run. Returns a (region, kind, resource ID) tuple. """
+        build = resource.extra.get('tags', {}).get('build')
+        if self.dry_run:
+            log.info('Would reap {0} {1} in {2} ({3})'.format(
+                kind, resource.id, region, build))
+        else:
+            log.info('Reaping {0} {1} in {2} ({3})'.format(
+                kind, resource.id, region, build))
+            try:
+                destroy(resource)
+            except Exception:
+                log.exception('Could not reap {0} {1} in {2}'.format(
+                    kind, resource.id, region))
+        return (region, kind, resource.id)
+
+    def reap_region(self, region):
+        """ Reaps leftover resources in `region`. Returns a list of
+        (region, kind, resource ID) tuples for what was reaped. """
+        cls = self.regions[region]
+        driver = cls(fedimg.AWS_ACCESS_ID, fedimg.AWS_SECRET_KEY)
+        tagged = {'tag-key': 'build'}
+        reaped = []
+
+        for node in driver.list_nodes(ex_filters=tagged):
+            # Utility and test nodes are both named 'Fedimg AMI ...'
+            if not (node.name or '').startswith('Fedimg'):
+                continue
+            if node.state == NodeState.TERMINATED:
+                continue
+            if _age(node.extra['launch_time']) < self.max_age:
+                continue
+            reaped.append(self._reap(region, 'node', node,
+                                     driver.destroy_node))
+
+        for volume in driver.list_volumes(ex_filters=tagged):
+            # Volumes in use belong to nodes that are reaped first
+            if volume.extra.get('state') != 'available':
+                continue
+            if _age(volume.extra['create_time']) < self.max_age:
+                continue
+            reaped.append(self._reap(region, 'volume', volume,
+                                     driver.destroy_volume))
+
+        # Snapshots still backing an AMI are in use, even if fedimg made them
+        in_use = set()
+        for image in driver.list_images(ex_owner='self'):
+            for mapping in image.extra.get('block_device_mapping') or []:
+                in_use.add(mapping.get('ebs', {}).get('snapshot_id'))
+
+        for snapshot in driver.list_snapshots(owner='self'):
+            if 'build' not in snapshot.extra.get('tags', {}):
+                continue
+            if snapshot.id in in_use:
+                continue
+            if snapshot.extra.get('state') != 'completed':
+                continue
+            if _age(snapshot.created) < self.max_age:
+                continue
+            reaped.append(self._reap(region, 'snapshot', snapshot,
+                                     driver.destroy_volume_snapshot))
+
+        return reaped
+
+    def reap(self):
+        """ Reaps every region at the same time. Returns a list of
+        (region, kind, resource ID) tuples for what was reaped. """
+        if not self.regions:
+            log.warn('No EC2 regions are configured; nothing to reap')
+            return []
+        pool = multiprocessing.pool.ThreadPool(processes=len(self.regions))
+        try:
+            results = pool.map(self._reap_safely, sorted(self.regions))
+        finally:
+            pool.close()
+        return [r for result in results for r in result]
+
+    def _reap_safely(self, region):
+        """ Like `reap_region`, but a failure in one region doesn't stop the
+        others. """
+        try:
+            return self.reap_region(region)
+        except Exception:
+            log.exception('Reaping {0} failed'.format(region))
+            return []
+
+
+def schedule(interval, max_age=None, dry_run=False):
+    """ Starts a daemon thread that reaps all regions every `interval`
+    seconds. Returns the thread. A failed run is logged, and doesn't stop
+    the next. """
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                Reaper(max_age=max_age, dry_run=dry_run).reap()
+            except Exception:
+                log.exception('Reaping failed')
+
+    thread = threading.Thread(target=loop, name='fedimg-reaper')
+    thread.daemon = True
+    thread.start()
+    return thread
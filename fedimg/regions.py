@@ -0,0 +1,118 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Distances between EC2 regions.
+
+When an image is built in more than one origin region, every other region
+copies it from the origin nearest to it. The distances are rough round trip
+times in milliseconds, which track how long cross-region copies take well
+enough to pick an origin.
+"""
+
+import fedimg
+
+# Approximate round trip times between regions, in milliseconds
+DEFAULT_DISTANCES = {
+    ('us-east-1', 'us-west-1'): 70,
+    ('us-east-1', 'us-west-2'): 75,
+    ('us-east-1', 'eu-west-1'): 75,
+    ('us-east-1', 'eu-central-1'): 90,
+    ('us-east-1', 'ap-northeast-1'): 160,
+    ('us-east-1', 'ap-northeast-2'): 190,
+    ('us-east-1', 'ap-southeast-1'): 230,
+    ('us-east-1', 'ap-southeast-2'): 200,
+    ('us-east-1', 'sa-east-1'): 120,
+    ('us-west-1', 'us-west-2'): 20,
+    ('us-west-1', 'eu-west-1'): 140,
+    ('us-west-1', 'eu-central-1'): 150,
+    ('us-west-1', 'ap-northeast-1'): 110,
+    ('us-west-1', 'ap-northeast-2'): 140,
+    ('us-west-1', 'ap-southeast-1'): 170,
+    ('us-west-1', 'ap-southeast-2'): 140,
+    ('us-west-1', 'sa-east-1'): 180,
+    ('us-west-2', 'eu-west-1'): 130,
+    ('us-west-2', 'eu-central-1'): 150,
+    ('us-west-2', 'ap-northeast-1'): 100,
+    ('us-west-2', 'ap-northeast-2'): 125,
+    ('us-west-2', 'ap-southeast-1'): 165,
+    ('us-west-2', 'ap-southeast-2'): 140,
+    ('us-west-2', 'sa-east-1'): 180,
+    ('eu-west-1', 'eu-central-1'): 25,
+    ('eu-west-1', 'ap-northeast-1'): 220,
+    ('eu-west-1', 'ap-northeast-2'): 250,
+    ('eu-west-1', 'ap-southeast-1'): 180,
+    ('eu-west-1', 'ap-southeast-2'): 280,
+    ('eu-west-1', 'sa-east-1'): 185,
+    ('eu-central-1', 'ap-northeast-1'): 240,
+    ('eu-central-1', 'ap-northeast-2'): 260,
+    ('eu-central-1', 'ap-southeast-1'): 165,
+    ('eu-central-1', 'ap-southeast-2'): 290,
+    ('eu-central-1', 'sa-east-1'): 205,
+    ('ap-northeast-1', 'ap-northeast-2'): 35,
+    ('ap-northeast-1', 'ap-southeast-1'): 70,
+    ('ap-northeast-1', 'ap-southeast-2'): 105,
+    ('ap-northeast-1', 'sa-east-1'): 260,
+    ('ap-northeast-2', 'ap-southeast-1'): 75,
+    ('ap-northeast-2', 'ap-southeast-2'): 135,
+    ('ap-northeast-2', 'sa-east-1'): 290,
+    ('ap-southeast-1', 'ap-southeast-2'): 95,
+    ('ap-southeast-1', 'sa-east-1'): 330,
+    ('ap-southeast-2', 'sa-east-1'): 315,
+}
+
+
+def parse_distances(text):
+    """ Parses distances like "us-east-1:sa-east-1=120" into a dict mapping
+    pairs of regions to distances, on top of the defaults. """
+    distances = dict(DEFAULT_DISTANCES)
+    for item in (text or '').split():
+        key, value = item.split('=')
+        first, second = key.split(':')
+        distances.pop((second, first), None)
+        distances[(first, second)] = int(value)
+    return distances
+
+
+def distance(first, second, distances=None):
+    """ Returns the distance between two regions, or None if it isn't
+    known. """
+    if first == second:
+        return 0
+    if distances is None:
+        distances = parse_distances(fedimg.AWS_DISTANCES)
+    if (first, second) in distances:
+        return distances[(first, second)]
+    return distances.get((second, first))
+
+
+def nearest(region, origins, distances=None):
+    """ Returns the one of the `origins` regions nearest to `region`. Ties,
+    and regions with no known distance, go to the earliest origin. """
+    if distances is None:
+        distances = parse_distances(fedimg.AWS_DISTANCES)
+
+    def key(item):
+        index, origin = item
+        d = distance(region, origin, distances)
+        return (d is None, d, index)
+
+    return min(enumerate(origins), key=key)[1]
@@ -18,3 +18,58 @@
 #
 # Authors:  David Gay <dgay@redhat.com>
 #
+
+"""
+Upload providers.
+
+A provider is a callable that takes the URL of a .raw.xz image and returns
+the upload jobs to run for it, or an empty list if it has nothing to do with
+that image. A job is any object with an `upload(compose_meta)` method that
+returns 0 on success.
+
+Providers are registered under the `fedimg.services` entry point, so other
+packages can add their own. Which ones run is set by the `providers` option.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import pkg_resources
+
+import fedimg
+
+ENTRY_POINT = 'fedimg.services'
+
+# Providers that ship with fedimg, for when it isn't installed
+BUILTIN = {
+    'ec2': 'fedimg.services.ec2:jobs',
+    'ftp': 'fedimg.services.ftp:jobs',
+    'gce': 'fedimg.services.gce:jobs',
+    'hp': 'fedimg.services.hp:jobs',
+    'rackspace': 'fedimg.services.rackspace:jobs',
+}
+
+
+def get_providers(names=None):
+    """ Returns a dict mapping the names of the enabled providers (by
+    default, the configured ones) to their callables. Providers that can't
+    be loaded are logged and left out. """
+    if names is None:
+        names = fedimg.PROVIDERS
+
+    entry_points = dict(
+        (name, pkg_resources.EntryPoint.parse('{0} = {1}'.format(name, spec)))
+        for name, spec in BUILTIN.items())
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT):
+        entry_points[entry_point.name] = entry_point
+
+    providers = {}
+    for name in names:
+        if name not in entry_points:
+            log.error('Unknown provider {0}'.format(name))
+            continue
+        try:
+            providers[name] = entry_points[name].resolve()
+        except Exception:
+            log.exception('Could not load provider {0}'.format(name))
+    return providers
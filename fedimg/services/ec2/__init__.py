@@ -0,0 +1,362 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#           Ralph Bean <rbean@redhat.com>
+#
+
+"""
+The EC2 upload process. An EC2Service job builds the AMI of one variant of an
+image in an origin region and replicates it to every other region; its
+stages live in modules of their own:
+
+- nodes: deploying nodes, on spot capacity where possible
+- build: writing the image with a utility node and registering the AMI
+- boot: boot tests of the AMI and of its copies
+- replicate: building in extra origins, copying and publishing
+- reuse: reusing the AMIs of identical images uploaded before
+- plan: dry runs of the process
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+from time import sleep
+
+from libcloud.compute.types import DeploymentException
+
+import fedimg
+import fedimg.cancel
+import fedimg.catalog
+import fedimg.messenger
+import fedimg.quota
+import fedimg.tester
+import fedimg.trace
+from fedimg.services.ec2.boot import BootTests
+from fedimg.services.ec2.build import Build, write_pipeline
+from fedimg.services.ec2.exceptions import EC2AMITestException
+from fedimg.services.ec2.exceptions import EC2ServiceException
+from fedimg.services.ec2.exceptions import EC2SpotInterruption
+from fedimg.services.ec2.exceptions import EC2UtilityException
+from fedimg.services.ec2.nodes import Nodes, SpotConnection, spot_market
+from fedimg.services.ec2.plan import Planning
+from fedimg.services.ec2.replicate import Replication, SharedSnapshots
+from fedimg.services.ec2.reuse import Reuse
+from fedimg.util import get_aws_amis, get_file_arch, ssh_connection_works
+from fedimg.util import virt_types_from_url
+
+
+class EC2Service(Nodes, Build, BootTests, Replication, Reuse, Planning):
+    """ An object for interacting with an EC2 upload process.
+        Takes a URL to a raw.xz image. With `share`, a SharedSnapshots
+        object, snapshots rather than AMIs are copied to other regions, and
+        the jobs for the other variants of the image reuse them. With
+        `checksum`, the SHA256 of the image file, the AMIs of an identical
+        image uploaded before are reused. """
+    def __init__(self, raw_url, virt_type='hvm', vol_type='standard',
+                 tester=None, quota=None, share=None, checksum=None):
+
+        self.raw_url = raw_url
+        self.virt_type = virt_type
+        self.vol_type = vol_type
+        # Boot tests are run through a scheduler shared by all jobs, so
+        # that they can proceed alongside replication.
+        self.tester = tester or fedimg.tester.get_scheduler()
+        # Every stage reserves the EC2 resources it uses in its region
+        # first, so that jobs wait for capacity rather than hit a limit.
+        self.quota = quota or fedimg.quota.get_accountant()
+        self.share = share
+        self.checksum = checksum
+        # Replaced by the uploader's, which cancels superseded jobs
+        self.cancel = fedimg.cancel.Token()
+        # All of these are set to appropriate values throughout
+        # the upload process.
+        self.util_node = None
+        self.util_volume = None
+        self.images = []
+        self.snapshot = None
+        # IDs of the snapshots the AMIs were registered from, by region
+        self.snapshots = {}
+        self.test_nodes = []
+        self.test_result = None
+        # (ami, image) pairs for every copy made to another region, and for
+        # the images built in extra origin regions
+        self.copies = []
+        # IDs of the copies made public, and of those that failed their
+        # regional test, and whether the regional tests were run
+        self.published = set()
+        self.failed = set()
+        self.tested = False
+        # (ami, async result) pairs for the extra origin regions still being
+        # built, by region
+        self.origin_builds = {}
+        # IDs of the nodes that run on spot capacity
+        self.spot_nodes = set()
+        # Set once spot nodes got interrupted too often
+        self.on_demand_only = False
+
+        self.destination = ''
+
+        # It's possible that these values will never change
+        self.test_success = False
+        self.dup_count = 0  # counter: helps avoid duplicate AMI names
+
+        # Populate list of AMIs by reading the AMI details from the config file
+        # For now, read in all AMIs to these lists, and narrow
+        # down later. TODO: This could be made a bit nicer...
+        self.util_amis = get_aws_amis()
+        self.test_amis = get_aws_amis()
+
+        # Get file name, build name, a description, and the image arch
+        # all from the .raw.xz file name.
+        self.file_name = self.raw_url.split('/')[-1]
+        self.build_name = self.file_name.replace('.raw.xz', '')
+        self.image_desc = "Created from build {0}".format(self.build_name)
+        self.image_arch = get_file_arch(self.file_name)
+
+        # Filter the AMI lists appropriately
+        # (no EBS-enabled instance types offer a 32 bit architecture, and we
+        # need EBS for registration on the utility instance, so they must be
+        # x86_64)
+        self.util_amis = [a for a in self.util_amis
+                          if a['arch'] == 'x86_64']
+        self.test_amis = [a for a in self.test_amis
+                          if a['arch'] == self.image_arch]
+
+    def _connect(self, ami):
+        """ Returns a libcloud driver for the region described by `ami`. """
+        cls = ami['driver']
+        return fedimg.trace.driver(
+            cls(fedimg.AWS_ACCESS_ID, fedimg.AWS_SECRET_KEY), ami['region'])
+
+    def _image_name(self, region):
+        """ Returns the name an AMI of this variant gets in `region`. """
+        if self.virt_type == 'paravirtual':
+            return "{0}-{1}-PV-{2}-0".format(self.build_name, region,
+                                             self.vol_type)
+        else:  # HVM
+            return "{0}-{1}-HVM-{2}-0".format(self.build_name, region,
+                                              self.vol_type)
+
+    def _registration_details(self, region):
+        """ Returns the test node size, the AKI and the root device name to
+        use for this variant in `region`. """
+        if self.virt_type == 'paravirtual':
+            test_size_id = 'm1.xlarge'
+            # test_amis will include AKIs of the appropriate arch
+            registration_aki = [a['aki'] for a in self.test_amis
+                                if a['region'] == region][0]
+            reg_root_device_name = '/dev/sda'
+        else:  # HVM
+            test_size_id = 'm3.2xlarge'
+            # Can't supply a kernel image with HVM
+            registration_aki = None
+            reg_root_device_name = '/dev/sda1'
+        return test_size_id, registration_aki, reg_root_device_name
+
+    def _extra(self, image, **kwargs):
+        """ Returns the 'extra' dict for fedmsgs about `image`. """
+        extra = {'id': image.id,
+                 'virt_type': self.virt_type,
+                 'vol_type': self.vol_type}
+        extra.update(kwargs)
+        return extra
+
+    def _clean_up(self, driver, delete_images=False):
+        """ Cleans up resources via a libcloud driver. """
+        log.info('Cleaning up resources')
+
+        # A boot test may still be running in the background; let it
+        # finish and destroy its own node first.
+        if self.test_result is not None:
+            self.test_result.wait()
+
+        # So do builds in the extra origin regions; what they registered is
+        # cleaned up along with the copies.
+        for region in list(self.origin_builds):
+            self._wait_for_origin(region)
+
+        if delete_images and len(self.images) > 0:
+            for image in self.images:
+                driver.delete_image(image)
+
+        if delete_images and len(self.copies) > 0:
+            for ami, image in self.copies:
+                try:
+                    alt_driver = self._connect(ami)
+                    # Deregistering a copy still in progress would leave
+                    # its snapshot behind
+                    self._settle(alt_driver, image)
+                    alt_driver.delete_image(image)
+                except Exception:
+                    log.exception('Could not delete copy {0} in {1}'.format(
+                        image.id, ami['region']))
+            self.copies = []
+
+        if self.snapshot and len(self.images) == 0:
+            driver.destroy_volume_snapshot(self.snapshot)
+            self.snapshot = None
+
+        if self.util_node:
+            driver.destroy_node(self.util_node)
+            self._untrack(self.util_node.id)
+            # Wait for node to be terminated
+            while ssh_connection_works(fedimg.AWS_UTIL_USER,
+                                       self.util_node.public_ips[0],
+                                       fedimg.AWS_KEYPATH):
+                sleep(10)
+            self.util_node = None
+        if self.util_volume:
+            # Destroy /dev/sdb or whatever
+            driver.destroy_volume(self.util_volume)
+            self._untrack(self.util_volume.id)
+            self.util_volume = None
+        for node in list(self.test_nodes):
+            node.destroy()
+            self._untrack(node.id)
+            self.test_nodes.remove(node)
+
+    def upload(self, compose_meta):
+        """ Registers the image in each EC2 region. """
+
+        log.info('EC2 upload process started')
+
+        # Get a starting utility AMI in some region to use as an origin.
+        # Any extra origins are built alongside it.
+        origins = self._origin_amis()
+        ami = origins[0]
+        self.destination = 'EC2 ({region})'.format(region=ami['region'])
+
+        fedimg.messenger.message('image.upload', self.raw_url,
+                                 self.destination, 'started',
+                                 compose=compose_meta)
+
+        try:
+            # Connect to the region through the appropriate libcloud driver
+            driver = self._connect(ami)
+
+            # An identical image uploaded before needs no building or
+            # copying
+            if self._reuse(compose_meta):
+                return 0
+
+            self._start_origins(origins, compose_meta)
+
+            snap_id = self._origin_snapshot(driver, ami, compose_meta)
+            self.cancel.check()
+
+            # Actually register image
+            self.images.append(self._register_image(driver, ami, snap_id))
+
+            # Emit success fedmsg. The images only go in the catalog once
+            # they have passed their test and been made public.
+            for image in self.images:
+                fedimg.messenger.message('image.upload', self.raw_url,
+                                         self.destination, 'completed',
+                                         extra=self._extra(image),
+                                         compose=compose_meta, record=False)
+
+            # Now, we'll spin up a node of the AMI to test. The test runs
+            # in the background while the AMI is being copied to the other
+            # regions; only making the AMIs public has to wait for it.
+            self.test_result = self.tester.submit(
+                self._with_restarts, self._test_image, ami, self.images[0],
+                self.destination, compose_meta)
+
+            self.cancel.check()
+            self._copy_images(compose_meta, origins)
+
+            # Re-raises EC2AMITestException if the test failed
+            self.test_result.get()
+            # A cancelled job makes nothing public
+            self.cancel.check()
+
+            # Let this EC2Service know that the AMI test passed, so
+            # it knows how to proceed.
+            self.test_success = True
+
+            # Make AMIs public
+            for image in self.images:
+                driver.ex_modify_image_attribute(
+                    image,
+                    {'LaunchPermission.Add.1.Group': 'all'})
+                self._remember(ami['region'], image)
+                fedimg.catalog.record(self.raw_url, self.destination,
+                                      compose_meta, self._extra(image))
+
+        except fedimg.cancel.JobCancelled as e:
+            log.info('EC2 upload of {0} cancelled: {1}'.format(
+                self.build_name, e))
+            # Nothing a superseded job registered is worth keeping
+            self._clean_up(driver, delete_images=True)
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination, 'failed',
+                                     extra={'cancelled': str(e)},
+                                     compose=compose_meta)
+            return 1
+
+        except EC2UtilityException as e:
+            log.exception("Failure")
+            if fedimg.CLEAN_UP_ON_FAILURE:
+                self._clean_up(driver,
+                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
+            return 1
+
+        except EC2AMITestException as e:
+            log.exception("Failure")
+            if fedimg.CLEAN_UP_ON_FAILURE:
+                self._clean_up(driver,
+                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
+            return 1
+
+        except DeploymentException as e:
+            log.exception("Problem deploying node: {0}".format(e.value))
+            if fedimg.CLEAN_UP_ON_FAILURE:
+                self._clean_up(driver,
+                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
+            return 1
+
+        except Exception as e:
+            # Just give a general failure message.
+            log.exception("Unexpected exception")
+            if fedimg.CLEAN_UP_ON_FAILURE:
+                self._clean_up(driver,
+                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
+            return 1
+
+        else:
+            self._clean_up(driver)
+
+        if self.test_success:
+            # Optionally test some of the copies where they landed, and
+            # make them public
+            self._publish_copies(compose_meta)
+
+            return 0
+
+
+def jobs(raw_url):
+    """ Returns the EC2 upload jobs for an image: one per virtualization
+    type and volume type. When snapshots are replicated, the jobs share
+    them. """
+    share = None
+    if fedimg.AWS_REPLICATE == 'snapshot':
+        share = SharedSnapshots()
+    return [EC2Service(raw_url, virt_type=vt, vol_type=vol, share=share)
+            for vt in virt_types_from_url(raw_url)
+            for vol in ('standard', 'gp2')]
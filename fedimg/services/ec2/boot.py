@@ -0,0 +1,205 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+The boot tests of the EC2 upload process, of the AMI built in the first
+origin and of a sample of its copies, run through the test scheduler (see
+fedimg.tester).
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import paramiko
+
+import fedimg
+import fedimg.cancel
+import fedimg.messenger
+import fedimg.trace
+from fedimg.services.ec2.exceptions import EC2AMITestException
+from fedimg.services.ec2.exceptions import EC2SpotInterruption
+
+
+class BootTests(object):
+    """ Boot tests the AMIs of an EC2Service. """
+
+    def _test_image(self, ami, image, destination, compose_meta):
+        """ Boots a node of `image` in the region described by `ami`, runs the
+        configured test script on it and destroys the node again. Raises
+        EC2AMITestException if the node doesn't boot or the test fails.
+        This is run through the test scheduler. """
+        with self.quota.reserve(ami['region'], instances=1, volumes=1), \
+                fedimg.trace.span('test', region=ami['region']):
+            self._boot_test(ami, image, destination, compose_meta)
+
+    def _boot_test(self, ami, image, destination, compose_meta):
+        """ Does the work of `_test_image`. """
+        driver = self._connect(ami)
+
+        test_size_id, registration_aki, _ = self._registration_details(
+            ami['region'])
+
+        # Select the appropriate size for the instance
+        size = [s for s in driver.list_sizes() if s.id == test_size_id][0]
+
+        # Device becomes /dev/xvdb on instance
+        msd = self._deployment()
+
+        log.info('Deploying test node in {0}'.format(ami['region']))
+
+        # Pick a name for the test instance
+        name = 'Fedimg AMI tester'
+
+        # Alert the fedmsg bus that an image test is starting
+        fedimg.messenger.message('image.test', self.raw_url,
+                                 destination, 'started',
+                                 extra=self._extra(image),
+                                 compose=compose_meta)
+
+        # Actually deploy the test instance
+        try:
+            test_node = self._deploy_node(
+                driver,
+                name=name, image=image, size=size,
+                ssh_username=fedimg.AWS_TEST_USER,
+                ssh_alternate_usernames=['root'],
+                ssh_key=fedimg.AWS_KEYPATH,
+                deploy=msd,
+                kernel_id=registration_aki,
+                ex_metadata={'build': self.build_name},
+                ex_keyname=fedimg.AWS_KEYNAME,
+                ex_security_groups=['ssh'],
+                )
+        except EC2SpotInterruption:
+            raise
+        except Exception as e:
+            fedimg.messenger.message('image.test', self.raw_url,
+                                     destination, 'failed',
+                                     extra=self._extra(image),
+                                     compose=compose_meta)
+
+            raise EC2AMITestException("Failed to boot test node %r." % e)
+
+        self.test_nodes.append(test_node)
+
+        try:
+            # Wait until the test node has SSH running
+            self._wait_for_ssh(driver, test_node, fedimg.AWS_TEST_USER)
+
+            log.info('Starting AMI tests')
+
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(test_node.public_ips[0],
+                           username=fedimg.AWS_TEST_USER,
+                           key_filename=fedimg.AWS_KEYPATH)
+
+            # Run the configured test script (by default /bin/true, as a
+            # simple "does it work" test)
+            cmd = fedimg.AWS_TEST
+            chan = client.get_transport().open_session()
+            chan.get_pty()  # Request a pseudo-term to get around requiretty
+
+            log.info('Running AMI test script')
+
+            chan.exec_command(cmd)
+
+            # Again, wait for the test command's exit status
+            status = chan.recv_exit_status()
+            if status != 0 and self._interrupted(driver, test_node):
+                raise EC2SpotInterruption(
+                    "Spot node {0} was interrupted while testing".format(
+                        test_node.id))
+            if status != 0:
+                # There was a problem with the SSH command
+                log.error('Problem testing new AMI')
+
+                data = "(no data)"
+                if chan.recv_ready():
+                    data = chan.recv(1024 * 32)
+
+                fedimg.messenger.message('image.test', self.raw_url,
+                                         destination, 'failed',
+                                         extra=self._extra(image, data=data),
+                                         compose=compose_meta)
+
+                raise EC2AMITestException("Tests on AMI failed.\n"
+                                          "output: %s" % data)
+
+            client.close()
+
+            log.info('AMI test completed')
+            fedimg.messenger.message('image.test', self.raw_url,
+                                     destination, 'completed',
+                                     extra=self._extra(image),
+                                     compose=compose_meta)
+        finally:
+            log.info('Destroying test node')
+            driver.destroy_node(test_node)
+            self._untrack(test_node.id)
+            self.test_nodes.remove(test_node)
+
+    def _test_copy(self, ami, image, compose_meta):
+        """ Boot tests the copy `image`, which must be available, in the
+        region described by `ami`. """
+        alt_dest = 'EC2 ({region})'.format(region=ami['region'])
+        self._with_restarts(self._test_image, ami, image, alt_dest,
+                            compose_meta)
+
+    def _test_copies(self, compose_meta):
+        """ Boot tests a sample of the copied AMIs in their own regions,
+        recording those that fail in `self.failed`. """
+
+        # Each test is submitted once its copy is complete, so that slow
+        # copies don't hold test slots the origin tests of other jobs need;
+        # the copies complete alongside each other, and so do the tests.
+        tests = []
+        cancelled = False
+        for ami, image in self.tester.sample(self.copies):
+            try:
+                self._wait_for_image(self._connect(ami), image)
+            except fedimg.cancel.JobCancelled:
+                cancelled = True
+                break
+            except Exception as e:
+                tests.append((ami, image, None, e))
+                continue
+            tests.append((ami, image,
+                          self.tester.submit(self._test_copy, ami, image,
+                                             compose_meta), None))
+
+        for ami, image, result, error in tests:
+            try:
+                if error is not None:
+                    raise error
+                result.get()
+            except fedimg.cancel.JobCancelled:
+                # The other tests destroy their nodes before giving up too
+                cancelled = True
+            except Exception:
+                log.exception('Regional test of {0} in {1} failed'.format(
+                    image.id, ami['region']))
+                self.failed.add(image.id)
+                if fedimg.DELETE_IMAGES_ON_FAILURE:
+                    self._connect(ami).delete_image(image)
+        if cancelled:
+            self.cancel.check()
+        self.tested = True
@@ -0,0 +1,514 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+The build stage of the EC2 upload process: writing the image to a volume with
+a utility node, snapshotting it and registering the snapshot as an AMI.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import os
+import sqlite3
+from time import sleep, time
+
+import paramiko
+from libcloud.compute.base import NodeImage, StorageVolume
+from libcloud.compute.types import KeyPairDoesNotExistError
+
+import fedimg
+import fedimg.benchmark
+import fedimg.catalog
+import fedimg.delta
+import fedimg.fetch
+import fedimg.messenger
+import fedimg.quota
+import fedimg.trace
+from fedimg.services.ec2.exceptions import EC2ServiceException
+from fedimg.services.ec2.exceptions import EC2SpotInterruption
+from fedimg.services.ec2.exceptions import EC2UtilityException
+from fedimg.util import build_series, ssh_connection_works
+
+# Runs fedimg's scripts on the utility node, whichever Python it has
+UTIL_PYTHON = '$(command -v python3 || command -v python)'
+
+
+def write_pipeline(fetch, target, block_size=None, delta_script=None):
+    """ Returns the shell pipeline that decompresses the .raw.xz image
+    `fetch` outputs onto `target`: with `delta_script` (see fedimg.delta),
+    only the blocks that changed, with `block_size`, with `dd`, and
+    otherwise through a plain redirect. It has to run under `bash -o
+    pipefail`, so that a download cut off halfway fails it rather than
+    leaving a truncated volume that looks written. """
+    if delta_script:
+        return '{0} | xzcat | {1} {2} {3} {4}'.format(
+            fetch, UTIL_PYTHON, delta_script, target, block_size or '1M')
+    if block_size:
+        return ('{0} | xzcat | dd of={1} bs={2} iflag=fullblock '
+                'oflag=direct'.format(fetch, target, block_size))
+    return '{0} | xzcat > {1}'.format(fetch, target)
+
+
+class Build(object):
+    """ Builds the AMIs of an EC2Service in its origin regions. """
+
+    def _util_size(self, region, sizes):
+        """ Returns the node size and the block size to write the image with
+        for a utility node in `region`, based on the benchmark results
+        recorded for that region. """
+        size_id, block_size = fedimg.benchmark.best_util_size(region)
+        matches = [s for s in sizes if s.id == size_id]
+        if not matches:
+            size_id, block_size = fedimg.AWS_UTIL_SIZE, None
+            # TODO: Add try/except if for some reason the size isn't
+            # available?
+            matches = [s for s in sizes if s.id == size_id]
+        log.info('Using {0} utility node in {1}'.format(size_id, region))
+        return matches[0], block_size
+
+    def _util_volume_id(self):
+        """ Returns the ID of the volume the utility node writes to. """
+        return [x['ebs']['volume_id'] for x in
+                self.util_node.extra['block_device_mapping'] if
+                x['device_name'] == '/dev/sdb'][0]
+
+    def _deploy_util_node(self, driver, ami, size, delete_volume=False,
+                          snapshot_id=None):
+        """ Deploys a utility node of `size` in the region described by
+        `ami`, with a secondary volume to write the image to, blank or
+        created from `snapshot_id`. The volume is kept when the node is
+        destroyed, unless `delete_volume` is True. """
+        base_image = NodeImage(id=ami['ami'], name=None, driver=driver)
+
+        # Name the utility node
+        name = 'Fedimg AMI builder'
+
+        # Block device mapping for the utility node
+        # (Requires this second volume to write the image to for
+        # future registration.)
+        mappings = [{'VirtualName': None,  # cannot specify with Ebs
+                     'Ebs': {'VolumeSize': fedimg.AWS_UTIL_VOL_SIZE,
+                             'VolumeType': self.vol_type,
+                             'DeleteOnTermination':
+                                 str(delete_volume).lower()},
+                     'DeviceName': '/dev/sdb'}]
+        if snapshot_id:
+            mappings[0]['Ebs']['SnapshotId'] = snapshot_id
+
+        # Device becomes /dev/xvdb on instance
+        # (the script isn't so important for the util inst.)
+        msd = self._deployment()
+
+        log.info('Deploying utility instance')
+
+        while True:
+            try:
+                self.util_node = self._deploy_node(
+                    driver,
+                    name=name,
+                    image=base_image,
+                    size=size,
+                    ssh_username=fedimg.AWS_UTIL_USER,
+                    ssh_alternate_usernames=[''],
+                    ssh_key=fedimg.AWS_KEYPATH,
+                    deploy=msd,
+                    kernel_id=ami['aki'],
+                    ex_metadata={'build':
+                                 self.build_name},
+                    ex_keyname=fedimg.AWS_KEYNAME,
+                    ex_security_groups=['ssh'],
+                    ex_ebs_optimized=True,
+                    ex_blockdevicemappings=mappings)
+
+            except KeyPairDoesNotExistError:
+                # The keypair is missing from the current region.
+                # Let's install it and try again.
+                log.exception('Adding missing keypair to region')
+                driver.ex_import_keypair(fedimg.AWS_KEYNAME,
+                                         fedimg.AWS_PUBKEYPATH)
+                continue
+
+            except Exception as e:
+                # We might have an invalid security group, aka the 'ssh'
+                # security group doesn't exist in the current region. The
+                # reason this is caught here is because the related
+                # exception that prints`InvalidGroup.NotFound is, for
+                # some reason, a base exception.
+                if 'InvalidGroup.NotFound' in e.message:
+                    log.exception('Adding missing security'
+                                  'group to region')
+                    # Create the ssh security group
+                    driver.ex_create_security_group('ssh', 'ssh only')
+                    driver.ex_authorize_security_group('ssh', '22', '22',
+                                                       '0.0.0.0/0')
+                    continue
+                else:
+                    raise
+            break
+
+        # Tag the image volume like the node, so that it can be told apart
+        # from volumes fedimg didn't create if it's ever left behind.
+        volume = StorageVolume(self._util_volume_id(), None, None, driver)
+        driver.ex_create_tags(volume, {'build': self.build_name})
+
+    def _put_script(self, client, module):
+        """ Copies the script `module` (one of fedimg's standalone modules)
+        to the utility node `client` is connected to. Returns its path
+        there. """
+        path = '/tmp/fedimg-{0}.py'.format(module.__name__.split('.')[-1])
+        sftp = client.open_sftp()
+        try:
+            sftp.put(os.path.splitext(module.__file__)[0] + '.py', path)
+        finally:
+            sftp.close()
+        return path
+
+    def _write_image(self, driver, compose_meta, block_size=None,
+                     delta=False):
+        """ Writes the image to the secondary volume of the utility node.
+        If `block_size` is given, the volume is written with `dd` using
+        blocks of that size. With `delta`, the volume holds an earlier build
+        of the image, and only the blocks that changed are written (see
+        fedimg.delta). Returns the number of seconds the write took and the
+        command output. """
+
+        # Wait until the utility node has SSH running
+        self._wait_for_ssh(driver, self.util_node, fedimg.AWS_UTIL_USER)
+
+        log.info('Utility node started with SSH running')
+
+        # Connect to the utility node via SSH
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self.util_node.public_ips[0],
+                       username=fedimg.AWS_UTIL_USER,
+                       key_filename=fedimg.AWS_KEYPATH)
+
+        # Curl the .raw.xz file down from the web, decompressing it
+        # and writing it to the secondary volume defined earlier by
+        # the block device mapping.
+        # curl with -L option, so we follow redirects, -f to fail on HTTP
+        # errors, and -sS to keep progress out of the output
+        fetch = 'curl -fsSL {0}'.format(self.raw_url)
+        if fedimg.AWS_FETCH_CONNECTIONS > 1:
+            # Fetched in ranges over several connections (see fedimg.fetch)
+            fetch = '{0} {1} {2} {3}'.format(
+                UTIL_PYTHON, self._put_script(client, fedimg.fetch),
+                self.raw_url, fedimg.AWS_FETCH_CONNECTIONS)
+        delta_script = None
+        if delta:
+            delta_script = self._put_script(client, fedimg.delta)
+        cmd = "sudo bash -o pipefail -c '{0}'".format(write_pipeline(
+            fetch, '/dev/xvdb', block_size, delta_script))
+        chan = client.get_transport().open_session()
+        chan.get_pty()  # Request a pseudo-term to get around requiretty
+
+        log.info('Executing utility script')
+
+        # Run the above command and wait for its exit status. Closing the
+        # channel if the job is cancelled stops the wait.
+        started = time()
+        with self.cancel.hook(chan.close):
+            chan.exec_command(cmd)
+            status = chan.recv_exit_status()
+        elapsed = time() - started
+        if self.cancel.cancelled:
+            client.close()
+            self.cancel.check()
+        if status != 0 and self._interrupted(driver, self.util_node):
+            raise EC2SpotInterruption(
+                "Spot node {0} was interrupted while writing the "
+                "image".format(self.util_node.id))
+
+        # Read the output to the end; dd's summary comes last
+        chunks = []
+        while True:
+            chunk = chan.recv(1024 * 32)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = ''.join(chunks) or "(no data)"
+
+        if status != 0:
+            # There was a problem with the SSH command
+            log.error('Problem writing volume with utility instance')
+
+            # Benchmark runs aren't part of a compose, and don't need
+            # announcing.
+            if compose_meta is not None:
+                fedimg.messenger.message('image.upload', self.raw_url,
+                                         self.destination, 'failed',
+                                         extra={'data': data},
+                                         compose=compose_meta)
+
+            raise EC2UtilityException(
+                "Problem writing image to utility instance volume. "
+                "Command exited with status {0}.\n"
+                "command: {1}\n"
+                "output: {2}".format(status, cmd, data))
+
+        client.close()
+
+        log.info('Utility script output: {0}'.format(data.strip()))
+        return elapsed, data
+
+    def _previous_snapshot(self, driver, region):
+        """ Returns the ID of the snapshot behind the latest AMI of an
+        earlier build of this image for the same release, arch and variant
+        in `region`, going by the catalog, or None. """
+        catalog = fedimg.catalog.get_catalog()
+        series = build_series(self.build_name)
+        if catalog is None or series is None:
+            return None
+        prefix, suffix = series
+        try:
+            previous = catalog.latest(prefix, region, self.virt_type,
+                                      self.vol_type, suffix=suffix)
+        except sqlite3.Error:
+            log.exception('Could not look up the previous build of '
+                          '{0}'.format(self.build_name))
+            return None
+        if previous is None or previous['build'] == self.build_name:
+            return None
+        try:
+            image = driver.get_image(previous['id'])
+            for mapping in image.extra.get('block_device_mapping') or []:
+                snap_id = mapping.get('ebs', {}).get('snapshot_id')
+                if snap_id:
+                    log.info('Writing {0} onto {1} of {2}'.format(
+                        self.build_name, snap_id, previous['build']))
+                    return snap_id
+        except Exception:
+            log.exception('Could not find the snapshot of {0}'.format(
+                previous['id']))
+        return None
+
+    def _origin_snapshot(self, driver, ami, compose_meta):
+        """ Returns the ID of a snapshot of the image in the region described
+        by `ami`, building it unless another variant's job already has. """
+        def build():
+            # Restarted from scratch if the utility node is interrupted
+            snap_id = self._with_restarts(self._build_snapshot, driver, ami,
+                                          driver.list_sizes(), compose_meta)
+            if self.share is not None:
+                # The snapshot is shared now, so it mustn't be cleaned up if
+                # this job fails
+                self.snapshot = None
+            return snap_id
+
+        if self.share is None:
+            return build()
+        return self.share.get(ami['region'], build)
+
+    def _build_snapshot(self, driver, ami, sizes, compose_meta):
+        """ Writes the image to a volume with a utility node in the region
+        described by `ami` and snapshots it. Returns the snapshot ID. """
+
+        # select the desired node attributes
+        size, block_size = self._util_size(ami['region'], sizes)
+
+        # The utility node has a root volume as well as the image volume,
+        # which outlives it until it's been snapshotted.
+        region = ami['region']
+        self.quota.acquire(region, instances=1, volumes=2)
+        held = {'instances': 1, 'volumes': 2}
+        try:
+            with fedimg.trace.span('build snapshot', region=region):
+                return self._snapshot_image(driver, ami, size, block_size,
+                                            compose_meta, held)
+        finally:
+            self.quota.release(region, **held)
+
+    def _snapshot_image(self, driver, ami, size, block_size, compose_meta,
+                        held):
+        """ Does the work of `_build_snapshot`, releasing the resources in
+        `held` as they are given up. """
+        region = ami['region']
+
+        # The volume starts out as the previous build, if there's one to
+        # write the changes onto
+        base = None
+        if fedimg.AWS_DELTA:
+            base = self._previous_snapshot(driver, region)
+
+        self._deploy_util_node(driver, ami, size, snapshot_id=base)
+
+        try:
+            with fedimg.trace.span('write image', region=region,
+                                   delta=base is not None):
+                self._write_image(driver, compose_meta,
+                                  block_size=block_size,
+                                  delta=base is not None)
+        except EC2SpotInterruption:
+            # The image volume outlives the node; it's only partially
+            # written, so throw it away along with the node.
+            vol_id = self._util_volume_id()
+            self._untrack(self.util_node.id)
+            self.util_node = None
+            try:
+                driver.destroy_volume([v for v in driver.list_volumes()
+                                       if v.id == vol_id][0])
+                self._untrack(vol_id)
+            except Exception:
+                log.exception('Could not destroy volume {0}'.format(vol_id))
+            raise
+
+        # Get volume name that image was written to
+        vol_id = self._util_volume_id()
+
+        log.info('Destroying utility node')
+
+        # Terminate the utility instance
+        driver.destroy_node(self.util_node)
+        self._untrack(self.util_node.id)
+
+        # Wait for utility node to be terminated
+        while ssh_connection_works(fedimg.AWS_UTIL_USER,
+                                   self.util_node.public_ips[0],
+                                   fedimg.AWS_KEYPATH):
+            sleep(10)
+
+        # Wait a little longer since loss of SSH connectivity doesn't mean
+        # that the node's destroyed
+        # TODO: Check instance state rather than this lame sleep thing
+        sleep(45)
+        self.util_node = None
+        self.quota.release(region, instances=1, volumes=1)
+        held.update(instances=0, volumes=1)
+
+        # Take a snapshot of the volume the image was written to
+        self.util_volume = [v for v in driver.list_volumes()
+                            if v.id == vol_id][0]
+        snap_name = 'fedimg-snap-{0}'.format(self.build_name)
+
+        log.info('Taking a snapshot of the written volume')
+
+        with self.quota.reserve(region, snapshots=1), \
+                fedimg.trace.span('take snapshot', region=region):
+            self.snapshot = fedimg.quota.retry(
+                driver.create_volume_snapshot, self.util_volume,
+                name=snap_name, ex_metadata={'build': self.build_name})
+            snap_id = str(self.snapshot.id)
+
+            while self.snapshot.extra['state'] != 'completed':
+                # Re-obtain snapshot object to get updates on its state
+                self.snapshot = [s for s in driver.list_snapshots()
+                                 if s.id == snap_id][0]
+                self.cancel.sleep(10)
+
+        log.info('Snapshot taken')
+
+        # Delete the volume now that we've got the snapshot
+        driver.destroy_volume(self.util_volume)
+        self._untrack(vol_id)
+        # make sure Fedimg knows that the vol is gone
+        self.util_volume = None
+        self.quota.release(region, volumes=1)
+        held.update(volumes=0)
+
+        log.info('Destroyed volume')
+
+        return snap_id
+
+    def _register_image(self, driver, ami, snap_id):
+        """ Registers the snapshot `snap_id` as an AMI in the region
+        described by `ami`. Returns the registered image. """
+        log.info('Registering image as an AMI')
+
+        image_name = self._image_name(ami['region'])
+        _, registration_aki, reg_root_device_name = \
+            self._registration_details(ami['region'])
+
+        # For this block device mapping, we have our volume be
+        # based on the snapshot's ID
+        mapping = [{'DeviceName': reg_root_device_name,
+                    'Ebs': {'SnapshotId': snap_id,
+                            'VolumeSize': fedimg.AWS_TEST_VOL_SIZE,
+                            'VolumeType': self.vol_type,
+                            'DeleteOnTermination': 'true'}}]
+
+        # Avoid duplicate image name by incrementing the number at the
+        # end of the image name if there is already an AMI with that name.
+        # TODO: This process could be written nicer.
+        while True:
+            try:
+                if self.dup_count > 0:
+                    # Remove trailing '-0' or '-1' or '-2' or...
+                    image_name = '-'.join(image_name.split('-')[:-1])
+                    # Re-add trailing dup number with new count
+                    image_name += '-{0}'.format(self.dup_count)
+                # Try to register with that name
+                image = driver.ex_register_image(
+                    image_name,
+                    description=self.image_desc,
+                    root_device_name=reg_root_device_name,
+                    block_device_mapping=mapping,
+                    virtualization_type=self.virt_type,
+                    kernel_id=registration_aki,
+                    architecture=self.image_arch)
+            except Exception as e:
+                # Check if the problem was a duplicate name
+                if 'InvalidAMIName.Duplicate' in e.message:
+                    # Keep trying until an unused name is found
+                    self.dup_count += 1
+                    continue
+                else:
+                    raise
+            break
+
+        self.snapshots[ami['region']] = snap_id
+        log.info('Completed image registration')
+        return image
+
+    def benchmark(self, region, size_ids, block_sizes):
+        """ Runs the download/decompress/write step of the upload process
+        with a utility node of each of `size_ids` in `region`, once for each
+        of `block_sizes`. Returns a list of dicts describing the throughput
+        and cost of each run. Nothing gets registered. """
+
+        ami = [a for a in self.util_amis if a['region'] == region][0]
+        driver = self._connect(ami)
+        sizes = driver.list_sizes()
+        results = []
+
+        for size_id in size_ids:
+            matches = [s for s in sizes if s.id == size_id]
+            if not matches:
+                log.warn('{0} is not available in {1}'.format(size_id,
+                                                              region))
+                continue
+            size = matches[0]
+
+            try:
+                self._deploy_util_node(driver, ami, size, delete_volume=True)
+                for block_size in block_sizes:
+                    seconds, output = self._write_image(
+                        driver, None, block_size=block_size)
+                    results.append(fedimg.benchmark.result(
+                        region, size, block_size, seconds, output))
+            except EC2ServiceException:
+                log.exception('Benchmark of {0} in {1} failed'.format(
+                    size_id, region))
+            finally:
+                self._clean_up(driver)
+
+        return results
@@ -0,0 +1,44 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+""" Exceptions raised by the EC2 upload process. """
+
+
+class EC2ServiceException(Exception):
+    """ Custom exception for EC2Service. """
+    pass
+
+
+class EC2UtilityException(EC2ServiceException):
+    """ Something went wrong with writing the image file to a volume with the
+        utility instance. """
+    pass
+
+
+class EC2AMITestException(EC2ServiceException):
+    """ Something went wrong when a newly-registered AMI was tested. """
+    pass
+
+
+class EC2SpotInterruption(EC2ServiceException):
+    """ A spot node used by the upload process was reclaimed by EC2 before
+        its stage was done. """
+    pass
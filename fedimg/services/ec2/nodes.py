@@ -0,0 +1,247 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+The nodes of the EC2 upload process: deploying them, on spot capacity where
+possible, and keeping track of them in the ledger.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import contextlib
+import uuid
+from time import time
+
+from libcloud.compute.deployment import MultiStepDeployment
+from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
+from libcloud.compute.types import DeploymentException, NodeState
+
+import fedimg
+import fedimg.ledger
+import fedimg.quota
+import fedimg.trace
+from fedimg.services.ec2.exceptions import EC2SpotInterruption
+from fedimg.util import ssh_connection_works
+
+# Error codes that mean no spot capacity can be had right now, as opposed to
+# something being wrong with the request itself.
+SPOT_CAPACITY_ERRORS = ('InsufficientInstanceCapacity',
+                        'MaxSpotInstanceCountExceeded',
+                        'SpotMaxPriceTooLow',
+                        'Unsupported')
+
+
+class SpotConnection(object):
+    """ Wraps the connection of a libcloud EC2 driver so that the instances
+        it runs are spot instances: libcloud's `create_node` has no
+        arguments for that, so the spot market options are added to its
+        RunInstances requests. """
+
+    def __init__(self, connection, max_price=None):
+        self.connection = connection
+        self.options = {
+            'InstanceMarketOptions.MarketType': 'spot',
+            'InstanceMarketOptions.SpotOptions.SpotInstanceType':
+                'one-time',
+            'InstanceMarketOptions.SpotOptions.'
+            'InstanceInterruptionBehavior': 'terminate',
+        }
+        if max_price:
+            self.options['InstanceMarketOptions.SpotOptions.MaxPrice'] = (
+                str(max_price))
+
+    def request(self, action, params=None, *args, **kwargs):
+        if params and params.get('Action') == 'RunInstances':
+            params = dict(params)
+            params.update(self.options)
+        return self.connection.request(action, params, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+@contextlib.contextmanager
+def spot_market(driver, max_price=None):
+    """ Makes the instances `driver` runs in the `with` block spot
+    instances, paying at most `max_price` an hour for them. """
+    # Traced drivers wrap the one that makes the requests
+    if isinstance(driver, fedimg.trace.TracedDriver):
+        driver = driver._driver
+    connection = driver.connection
+    driver.connection = SpotConnection(connection, max_price)
+    try:
+        yield
+    finally:
+        driver.connection = connection
+
+
+class Nodes(object):
+    """ Deploys the nodes of an EC2Service and keeps track of them. """
+
+    def _track(self, driver, kind, id):
+        """ Records the node or volume `id` in the ledger until it's
+        destroyed, so that it's never left behind unaccounted for. """
+        fedimg.ledger.track(kind, id, getattr(driver, 'region_name', None),
+                            self.build_name)
+
+    def _untrack(self, id):
+        """ Records that the node or volume `id` is gone. """
+        fedimg.ledger.untrack(id)
+
+    def _deployment(self, script="touch test"):
+        """ Returns a deployment that installs our SSH key on a new node and
+        runs `script` on it. """
+        # Read in the SSH key
+        with open(fedimg.AWS_PUBKEYPATH, 'rb') as f:
+            key_content = f.read()
+
+        # Add key to authorized keys for root user
+        step_1 = SSHKeyDeployment(key_content)
+
+        # Add script for deployment
+        step_2 = ScriptDeployment(script)
+
+        # Create deployment object (will set up SSH key and run script)
+        return MultiStepDeployment([step_1, step_2])
+
+    def _deploy_node(self, driver, **kwargs):
+        """ Creates a node and deploys to it with the given libcloud
+        `deploy_node` arguments. If spot nodes are enabled, spot capacity is
+        asked for first, and an on-demand node is only created when none
+        could be had before the configured deadline. Until `deploy_node`
+        returns, the node is recorded in the ledger by a tag of its own;
+        after, by its ID, along with the volumes it keeps once terminated.
+        It's destroyed (if clean up is on) if deploying fails. """
+        token = uuid.uuid4().hex
+        kwargs['ex_metadata'] = dict(kwargs.get('ex_metadata') or {})
+        kwargs['ex_metadata'][fedimg.ledger.DEPLOY_TAG] = token
+        self._track(driver, 'deploy', token)
+
+        try:
+            node = self._deploy_spot_node(driver, **kwargs)
+            if node is None:
+                node = fedimg.quota.retry(driver.deploy_node, **kwargs)
+        except DeploymentException as e:
+            node = e.node
+            self._track_node(driver, node, kwargs)
+            self._untrack(token)
+            interrupted = self._interrupted(driver, node)
+            if fedimg.CLEAN_UP_ON_FAILURE:
+                try:
+                    driver.destroy_node(node)
+                    self._untrack(node.id)
+                except Exception:
+                    log.exception('Could not destroy {0}'.format(node.id))
+            if interrupted:
+                raise EC2SpotInterruption(
+                    "Spot node {0} was interrupted during "
+                    "deployment".format(node.id))
+            raise
+        except Exception:
+            # No node was created
+            self._untrack(token)
+            raise
+
+        self._track_node(driver, node, kwargs)
+        self._untrack(token)
+        return node
+
+    def _deploy_spot_node(self, driver, **kwargs):
+        """ Deploys a spot node as `_deploy_node` would, retrying until the
+        spot deadline. Returns None if spot nodes are disabled or no spot
+        capacity could be had. """
+        if not fedimg.AWS_SPOT or self.on_demand_only:
+            return None
+        deadline = time() + fedimg.AWS_SPOT_DEADLINE
+        while time() < deadline:
+            try:
+                with spot_market(driver, fedimg.AWS_SPOT_MAX_PRICE):
+                    node = driver.deploy_node(**kwargs)
+            except DeploymentException as e:
+                self.spot_nodes.add(e.node.id)
+                raise
+            except Exception as e:
+                if not any(err in e.message
+                           for err in SPOT_CAPACITY_ERRORS):
+                    raise
+                log.info('No spot capacity for {0}: {1}'.format(
+                    kwargs['size'].id, e.message))
+                self.cancel.sleep(15)
+                continue
+            self.spot_nodes.add(node.id)
+            return node
+        log.info('Deploying an on-demand {0} node instead'.format(
+            kwargs['size'].id))
+        return None
+
+    def _track_node(self, driver, node, kwargs):
+        """ Records `node`, created with the `create_node` arguments
+        `kwargs`, in the ledger, with the volumes it was asked to keep once
+        terminated. """
+        self._track(driver, 'node', node.id)
+        kept = [m['DeviceName'] for m in
+                kwargs.get('ex_blockdevicemappings') or []
+                if m.get('Ebs', {}).get('DeleteOnTermination') == 'false']
+        if not kept:
+            return
+        mappings = node.extra.get('block_device_mapping') or []
+        if not any(m['device_name'] in kept for m in mappings):
+            # As RunInstances returns it, before the volumes are attached
+            nodes = driver.list_nodes(ex_node_ids=[node.id])
+            mappings = nodes[0].extra['block_device_mapping'] if nodes else []
+        for mapping in mappings:
+            if mapping['device_name'] in kept:
+                self._track(driver, 'volume', mapping['ebs']['volume_id'])
+
+    def _interrupted(self, driver, node):
+        """ Returns True if `node` is a spot node that EC2 took back. """
+        if node.id not in self.spot_nodes:
+            return False
+        nodes = driver.list_nodes(ex_node_ids=[node.id])
+        return not nodes or nodes[0].state not in (NodeState.PENDING,
+                                                   NodeState.RUNNING)
+
+    def _wait_for_ssh(self, driver, node, username):
+        """ Blocks until SSH works on `node`. Raises EC2SpotInterruption if
+        the node goes away in the meantime. """
+        while not ssh_connection_works(username,
+                                       node.public_ips[0],
+                                       fedimg.AWS_KEYPATH):
+            if self._interrupted(driver, node):
+                raise EC2SpotInterruption(
+                    "Spot node {0} was interrupted".format(node.id))
+            self.cancel.sleep(10)
+
+    def _with_restarts(self, stage, *args):
+        """ Runs the `stage` callable with `args`, running it again from the
+        start when one of its spot nodes gets interrupted. After
+        AWS_SPOT_RESTARTS interruptions, on-demand nodes are used. """
+        interruptions = 0
+        while True:
+            try:
+                return stage(*args)
+            except EC2SpotInterruption:
+                interruptions += 1
+                log.exception('Restarting {0} ({1} interruptions)'.format(
+                    stage.__name__, interruptions))
+                if interruptions >= fedimg.AWS_SPOT_RESTARTS:
+                    self.on_demand_only = True
@@ -0,0 +1,124 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+""" Dry runs of the EC2 upload process (see fedimg.planner). """
+
+import fedimg
+import fedimg.benchmark
+import fedimg.planner
+import fedimg.regions
+
+
+class Planning(object):
+    """ Plans the upload of an EC2Service without running it. """
+
+    def plan(self, durations, seen=None):
+        """ Returns what `upload` would do, without doing any of it: a dict
+        with the stages it would run, the AMIs it would register, and
+        estimates of its API calls and of how long it would take, in seconds,
+        based on `durations` (a fedimg.planner.Durations). Snapshots shared
+        with the jobs planned before, recorded in `seen`, aren't counted
+        twice. """
+        seen = set() if seen is None else seen
+        origins = self._origin_amis()
+        regions = [a['region'] for a in origins]
+        distances = fedimg.regions.parse_distances(fedimg.AWS_DISTANCES)
+        stages = []
+        images = []
+        calls = 0
+
+        def shared(region):
+            if self.share is None:
+                return False
+            if (id(self.share), region) in seen:
+                return True
+            seen.add((id(self.share), region))
+            return False
+
+        # Every origin builds and registers the image
+        ready = {}
+        for ami in origins:
+            region = ami['region']
+            size_id = (fedimg.benchmark.best_util_size(region)[0] or
+                       fedimg.AWS_UTIL_SIZE)
+            reused = shared(region)
+            seconds = 0 if reused else durations.get('build snapshot',
+                                                     region)
+            stages.append({'stage': 'build snapshot', 'region': region,
+                           'instance_type': size_id, 'shared': reused,
+                           'seconds': seconds})
+            if not reused:
+                calls += fedimg.planner.api_calls(
+                    'build snapshot', durations.get('take snapshot', region),
+                    wait='take snapshot')
+            calls += fedimg.planner.api_calls('register')
+            images.append({'region': region, 'source': None,
+                           'name': self._image_name(region)})
+            ready[region] = seconds
+
+        test_size_id = self._registration_details(regions[0])[0]
+        test = durations.get('test', regions[0])
+        stages.append({'stage': 'test', 'region': regions[0],
+                       'instance_type': test_size_id, 'seconds': test})
+        calls += fedimg.planner.api_calls('test')
+        # The job waits for the other origins to be built
+        done = max([ready[regions[0]] + test] + ready.values())
+
+        # The other regions get copies from their nearest origin
+        copies = 0
+        for ami in self.test_amis:
+            region = ami['region']
+            if region in regions:
+                continue
+            source = fedimg.regions.nearest(region, regions, distances)
+            if self.share is not None:
+                stage = 'copy snapshot'
+                reused = shared(region)
+                seconds = 0 if reused else durations.get(stage, region)
+                if not reused:
+                    calls += fedimg.planner.api_calls(stage, seconds)
+                calls += fedimg.planner.api_calls('register')
+            else:
+                stage = 'copy'
+                reused = False
+                seconds = durations.get(stage, region)
+                calls += fedimg.planner.api_calls(stage, seconds)
+            stages.append({'stage': stage, 'region': region,
+                           'source': source, 'shared': reused,
+                           'seconds': seconds})
+            images.append({'region': region, 'source': source,
+                           'name': self._image_name(region)})
+            done = max(done, ready[source] + seconds)
+            copies += 1
+
+        # The first AMI and the copies are made public; some copies may be
+        # tested in their regions first, all at once
+        calls += fedimg.planner.api_calls('publish') * (copies + 1)
+        regional = min(fedimg.AWS_REGIONAL_TESTS, copies)
+        if regional:
+            done += durations.get('test')
+            calls += fedimg.planner.api_calls('test') * regional
+            stages.append({'stage': 'test', 'region': '{0} regions'.format(
+                regional), 'instance_type': test_size_id,
+                'seconds': durations.get('test')})
+
+        return {'stages': stages, 'images': images, 'api_calls': calls,
+                'seconds': done}
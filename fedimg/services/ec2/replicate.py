@@ -0,0 +1,476 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+The replication stage of the EC2 upload process: building the image in the
+extra origin regions, copying it from them to every other region, and making
+the copies public.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import multiprocessing.pool
+import threading
+from time import sleep
+
+from libcloud.compute.base import NodeImage, VolumeSnapshot
+from libcloud.compute.drivers.ec2 import NAMESPACE
+from libcloud.utils.xml import findtext
+
+import fedimg
+import fedimg.messenger
+import fedimg.quota
+import fedimg.regions
+import fedimg.trace
+from fedimg.services.ec2.exceptions import EC2ServiceException
+
+
+class SharedSnapshots(object):
+    """ The snapshots of one image in each region, shared by the upload jobs
+        of all of its variants, so that the image is only written once and
+        copied to each region once. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+
+    def get(self, region, make):
+        """ Returns the ID of the snapshot in `region`. The first job to ask
+        calls `make` to create it, while the others wait for it to. If that
+        fails, the next job to ask tries again. """
+        with self.lock:
+            entry = self.snapshots.get(region)
+            if entry is None:
+                entry = self.snapshots[region] = {'done': threading.Event()}
+                owner = True
+            else:
+                owner = False
+
+        if owner:
+            try:
+                entry['id'] = make()
+            except Exception:
+                with self.lock:
+                    del self.snapshots[region]
+                raise
+            finally:
+                entry['done'].set()
+
+        return self._result(region, entry)
+
+    def wait(self, region):
+        """ Returns the ID of the snapshot some job is making, or has made,
+        in `region`. """
+        with self.lock:
+            entry = self.snapshots[region]
+        return self._result(region, entry)
+
+    def _result(self, region, entry):
+        entry['done'].wait()
+        if 'id' not in entry:
+            raise EC2ServiceException(
+                "No snapshot could be made in {0}".format(region))
+        return entry['id']
+
+
+class Replication(object):
+    """ Replicates the AMIs of an EC2Service to every region. """
+
+    def _origin_amis(self):
+        """ Returns the utility AMIs of the regions the image is built in,
+        the one the rest of the upload process runs in first. """
+        origins = []
+        for region in fedimg.AWS_ORIGINS:
+            matches = [a for a in self.util_amis if a['region'] == region]
+            if not matches:
+                log.warn('No utility AMI for origin {0}'.format(region))
+            elif matches[0] not in origins:
+                origins.append(matches[0])
+        return origins or self.util_amis[:1]
+
+    def _start_origins(self, origins, compose_meta):
+        """ Starts building the image in each of the extra `origins` (all
+        but the first), at the same time and in the background. """
+        if len(origins) < 2:
+            return
+        pool = multiprocessing.pool.ThreadPool(processes=len(origins) - 1)
+        for ami in origins[1:]:
+            self.origin_builds[ami['region']] = (
+                ami, pool.apply_async(
+                    fedimg.trace.propagate(self._build_origin),
+                    (ami, compose_meta)))
+        pool.close()
+
+    def _build_origin(self, ami, compose_meta):
+        """ Builds and registers the image in the extra origin region
+        described by `ami`, with an upload process of its own. Returns the
+        registered images. """
+        dest = 'EC2 ({region})'.format(region=ami['region'])
+        fedimg.messenger.message('image.upload', self.raw_url, dest,
+                                 'started', compose=compose_meta)
+
+        origin = type(self)(self.raw_url, virt_type=self.virt_type,
+                            vol_type=self.vol_type, tester=self.tester,
+                            quota=self.quota, share=self.share)
+        origin.cancel = self.cancel
+        driver = origin._connect(ami)
+        try:
+            snap_id = origin._origin_snapshot(driver, ami, compose_meta)
+            origin.images.append(
+                origin._register_image(driver, ami, snap_id))
+        except Exception:
+            log.exception('Building the image in {0} failed'.format(
+                ami['region']))
+            if fedimg.CLEAN_UP_ON_FAILURE:
+                origin._clean_up(driver, delete_images=True)
+            raise
+
+        origin._clean_up(driver)
+        self.snapshots.update(origin.snapshots)
+        return origin.images
+
+    def _wait_for_origin(self, region):
+        """ Waits for the image to be built in the extra origin `region`.
+        The images registered there are recorded with the copies, so that
+        they are tested, made public and cleaned up like them. Returns them,
+        or None if the build failed. """
+        ami, result = self.origin_builds.pop(region)
+        try:
+            images = result.get()
+        except Exception:
+            # _build_origin logged why
+            return None
+        self.copies.extend((ami, image) for image in images)
+        return images
+
+    def _copy_images(self, compose_meta, origins=None):
+        """ Starts copying the registered AMIs to every region that isn't an
+        origin, each from the origin nearest to it. The copies are recorded
+        in `self.copies`; they complete in the background on the EC2 side. """
+        origins = origins or self.util_amis[:1]
+        regions = [a['region'] for a in origins]
+        distances = fedimg.regions.parse_distances(fedimg.AWS_DISTANCES)
+
+        served = dict((region, []) for region in regions)
+        for ami in self.test_amis:
+            if ami['region'] not in served:
+                nearest = fedimg.regions.nearest(ami['region'], regions,
+                                                 distances)
+                served[nearest].append(ami)
+
+        # Snapshots are copied to every region at once, and an AMI is
+        # registered from each copy as soon as it's complete.
+        pool = None
+        if self.share is not None:
+            pool = multiprocessing.pool.ThreadPool(
+                processes=max(len(self.test_amis), 1))
+
+        def copy(ami, images, region):
+            if self.cancel.cancelled:
+                # The job gives up once the copies started are cleaned up
+                return
+            if pool is None:
+                self._copy_to(ami, images, region, compose_meta)
+            else:
+                pool.apply_async(fedimg.trace.propagate(self._replicate_to),
+                                 (ami, region, compose_meta))
+
+        # The regions nearest to the first origin are copied to right away;
+        # the others wait for their origin to be built. If that fails, they
+        # (and the origin itself) get copies from the first origin instead.
+        fallback = []
+        for region in regions:
+            if region == regions[0]:
+                images = self.images
+            else:
+                images = self._wait_for_origin(region)
+            if images is None:
+                fallback.extend(a for a in self.test_amis
+                                if a['region'] == region)
+                fallback.extend(served[region])
+                continue
+            for ami in served[region]:
+                copy(ami, images, region)
+
+        for ami in fallback:
+            copy(ami, self.images, regions[0])
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _copy_to(self, ami, images, source_region, compose_meta):
+        """ Starts copying `images` from `source_region` to the region
+        described by `ami`. """
+
+        # Choose an appropriate destination name for the copy
+        alt_dest = 'EC2 ({region})'.format(
+            region=ami['region'])
+
+        fedimg.messenger.message('image.upload',
+                                 self.raw_url,
+                                 alt_dest, 'started',
+                                 compose=compose_meta)
+
+        # Connect to the libcloud EC2 driver for the region we
+        # want to copy into
+        alt_driver = self._connect(ami)
+
+        # Construct the full name for the image copy
+        image_name = self._image_name(ami['region'])
+
+        log.info('AMI copy to {0} from {1} started'.format(ami['region'],
+                                                           source_region))
+
+        # Avoid duplicate image name by incrementing the number at the
+        # end of the image name if there is already an AMI with
+        # that name.
+        # TODO: Again, this could be written better
+        while True:
+            try:
+                if self.dup_count > 0:
+                    # Remove trailing '-0' or '-1' or '-2' or...
+                    image_name = '-'.join(image_name.split('-')[:-1])
+                    # Re-add trailing dup number with new count
+                    image_name += '-{0}'.format(self.dup_count)
+
+                # Actually run the image copy from the origin region
+                # to the current region.
+                for image in images:
+                    # Copies in progress count towards a limit in the
+                    # destination region.
+                    self.quota.acquire(ami['region'], copies=1)
+                    try:
+                        image_copy = fedimg.quota.retry(
+                            alt_driver.copy_image,
+                            image,
+                            source_region,
+                            name=image_name,
+                            description=self.image_desc)
+                    except Exception:
+                        self.quota.release(ami['region'], copies=1)
+                        raise
+                    self._release_when_copied(ami, image_copy)
+                    # Add the image copy to a list so we can work with
+                    # it later.
+                    self.copies.append((ami, image_copy))
+
+                    log.info('AMI {0} copied to AMI {1}'.format(
+                        image, image_name))
+
+            except Exception as e:
+                # Check if the problem was a duplicate name
+                if 'InvalidAMIName.Duplicate' in e.message:
+                    # Keep trying until an unused name is found.
+                    # This probably won't trigger, since it seems
+                    # like EC2 doesn't mind duplicate AMI names
+                    # when they are being copied, only registered.
+                    # Strange, but apprently true.
+                    self.dup_count += 1
+                    continue
+                else:
+                    # TODO: Catch a more specific exception
+                    log.exception(
+                        'Image copy to {0} failed'.format(
+                            ami['region']))
+                    fedimg.messenger.message('image.upload',
+                                             self.raw_url,
+                                             alt_dest, 'failed',
+                                             compose=compose_meta)
+            break
+
+    def _copy_snapshot(self, driver, ami, snap_id, source_region):
+        """ Copies the snapshot `snap_id` from `source_region` to the region
+        described by `ami`, and waits for the copy to complete. Returns the
+        ID of the copy. """
+        log.info('Snapshot copy to {0} from {1} started'.format(
+            ami['region'], source_region))
+
+        with self.quota.reserve(ami['region'], copies=1), \
+                fedimg.trace.span('copy snapshot', region=ami['region']):
+            # libcloud has no call for this
+            params = {'Action': 'CopySnapshot',
+                      'SourceRegion': source_region,
+                      'SourceSnapshotId': snap_id,
+                      'Description': 'fedimg-snap-{0}'.format(
+                          self.build_name)}
+            response = fedimg.quota.retry(driver.connection.request,
+                                          driver.path, params=params)
+            copy_id = findtext(element=response.object, xpath='snapshotId',
+                               namespace=NAMESPACE)
+            snapshot = VolumeSnapshot(copy_id, driver)
+            # Tagged like the original, so the reaper can find it
+            driver.ex_create_tags(snapshot, {'build': self.build_name})
+
+            while True:
+                state = driver.list_snapshots(snapshot)[0].extra['state']
+                if state == 'completed':
+                    break
+                if state == 'error':
+                    raise EC2ServiceException(
+                        "Snapshot copy {0} failed".format(copy_id))
+                self.cancel.sleep(20)
+
+        log.info('Snapshot {0} copied to {1}'.format(snap_id, ami['region']))
+        return copy_id
+
+    def _replicate_to(self, ami, source_region, compose_meta):
+        """ Registers this variant in the region described by `ami`, from
+        a copy of the snapshot in `source_region` that is shared with the
+        other variants' jobs. """
+        alt_dest = 'EC2 ({region})'.format(region=ami['region'])
+        fedimg.messenger.message('image.upload', self.raw_url, alt_dest,
+                                 'started', compose=compose_meta)
+
+        alt_driver = self._connect(ami)
+        try:
+            source_id = self.share.wait(source_region)
+            snap_id = self.share.get(
+                ami['region'],
+                lambda: self._copy_snapshot(alt_driver, ami, source_id,
+                                            source_region))
+            image = self._register_image(alt_driver, ami, snap_id)
+        except Exception:
+            log.exception('Replication to {0} failed'.format(ami['region']))
+            fedimg.messenger.message('image.upload', self.raw_url, alt_dest,
+                                     'failed', compose=compose_meta)
+            return
+
+        self.copies.append((ami, image))
+
+    def _release_when_copied(self, ami, image):
+        """ Releases the copy reserved for `image` once it has finished
+        copying (or failed to), from a thread of its own. """
+        def wait():
+            try:
+                with fedimg.trace.span('copy', cat='wait',
+                                       region=ami['region']):
+                    self._wait_for_image(self._connect(ami), image)
+            except Exception:
+                log.exception('Copy {0} to {1} did not complete'.format(
+                    image.id, ami['region']))
+            finally:
+                self.quota.release(ami['region'], copies=1)
+
+        thread = threading.Thread(target=fedimg.trace.propagate(wait))
+        thread.daemon = True
+        thread.start()
+
+    def _wait_for_image(self, driver, image):
+        """ Blocks until `image` (usually a copy that's still in progress)
+        is available in the region `driver` is connected to. """
+        while True:
+            state = driver.get_image(image.id).extra.get('state')
+            if state == 'available':
+                return
+            if state == 'failed':
+                raise EC2ServiceException(
+                    "Image {0} entered the failed state".format(image.id))
+            self.cancel.sleep(20)
+
+    def _settle(self, driver, image):
+        """ Blocks until `image` is no longer pending, whether the job was
+        cancelled or not, for it to be cleaned up. """
+        while driver.get_image(image.id).extra.get('state') == 'pending':
+            sleep(20)
+
+    def _publish_copies(self, compose_meta, tests=True):
+        """ Boot tests a sample of the copied AMIs in their own regions,
+        unless `tests` is False, then makes every copy that didn't fail
+        public. """
+
+        if tests:
+            self._test_copies(compose_meta)
+
+        for ami, image in self.copies:
+            if image.id in self.failed or image.id in self.published:
+                continue
+
+            alt_driver = self._connect(ami)
+
+            # Get an appropriate name for the region in question
+            alt_dest = 'EC2 ({region})'.format(region=ami['region'])
+
+            # Need to wait until the copy finishes in order to make
+            # the AMI public.
+            while True:
+                try:
+                    # Make the image public
+                    alt_driver.ex_modify_image_attribute(
+                        image,
+                        {'LaunchPermission.Add.1.Group': 'all'})
+                except Exception as e:
+                    if 'InvalidAMIID.Unavailable' in e.message:
+                        # The copy isn't done, so wait 20 seconds
+                        # and try again.
+                        self.cancel.sleep(20)
+                        continue
+                break
+            self.published.add(image.id)
+
+            log.info('Made {0} public ({1}, {2}, {3})'.format(image.id,
+                                                              self.build_name,
+                                                              self.virt_type,
+                                                              self.vol_type))
+            self._remember(ami['region'], image)
+
+            fedimg.messenger.message('image.upload',
+                                     self.raw_url,
+                                     alt_dest, 'completed',
+                                     extra=self._extra(image),
+                                     compose=compose_meta)
+
+    def checkpoint(self):
+        """ Returns what `resume` needs to carry on with the job after it
+        was cancelled, or None if it has to run again from the start. Only
+        jobs whose AMI passed its test and that were waiting on copies to
+        publish can be resumed. """
+        if not self.test_success:
+            return None
+        copies = [[ami['region'], image.id] for ami, image in self.copies
+                  if image.id not in self.published]
+        if not copies:
+            return None
+        return {'copies': copies, 'failed': sorted(self.failed),
+                'tested': self.tested}
+
+    def resume(self, state, compose_meta):
+        """ Carries on with a job from its `checkpoint` state: tests the
+        copies if that wasn't done yet, and makes them public once they're
+        complete. """
+        log.info('Resuming EC2 upload of {0} with {1} copies'.format(
+            self.build_name, len(state['copies'])))
+        amis = dict((a['region'], a)
+                    for a in self.util_amis + self.test_amis)
+        for region, image_id in state['copies']:
+            if region not in amis:
+                log.warn('Cannot resume copy {0} in unknown region '
+                         '{1}'.format(image_id, region))
+                continue
+            ami = amis[region]
+            image = NodeImage(id=image_id, name=self._image_name(region),
+                              driver=self._connect(ami))
+            self.copies.append((ami, image))
+        self.failed.update(state['failed'])
+        self.test_success = True
+        self._publish_copies(compose_meta, tests=not state['tested'])
+        return 0
@@ -0,0 +1,150 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Reuse of the AMIs of identical images uploaded before, found in the catalog
+by the checksum of the image file.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import sqlite3
+
+import fedimg
+import fedimg.catalog
+import fedimg.messenger
+import fedimg.trace
+from fedimg.services.ec2.exceptions import EC2ServiceException
+
+
+class Reuse(object):
+    """ Reuses the AMIs of an identical image for an EC2Service. """
+
+    def _remember(self, region, image):
+        """ Records `image`, registered in `region`, in the catalog under
+        the checksum of the image file, for later composes to reuse. """
+        catalog = fedimg.catalog.get_catalog()
+        if catalog is None or not self.checksum:
+            return
+        try:
+            catalog.add_checksum(self.checksum, region, self.virt_type,
+                                 self.vol_type, image.id,
+                                 self.snapshots.get(region))
+        except Exception:
+            log.exception('Could not record the checksum of {0}'.format(
+                image.id))
+
+    def _known_snapshot(self, driver, rows):
+        """ Returns the ID of a snapshot of the image in the region `driver`
+        is connected to, from what the catalog has on it (`rows`). AMIs
+        copied whole have their own snapshot, which is looked up. """
+        for row in rows:
+            if row['snapshot_id']:
+                return row['snapshot_id']
+        for row in rows:
+            image = driver.get_image(row['ami_id'])
+            for mapping in image.extra.get('block_device_mapping') or []:
+                snap_id = mapping.get('ebs', {}).get('snapshot_id')
+                if snap_id:
+                    return snap_id
+        raise EC2ServiceException("No snapshot of {0} in {1}".format(
+            self.checksum, rows[0]['region']))
+
+    def _reuse(self, compose_meta):
+        """ If an image with the same checksum was uploaded to every region
+        before, makes its AMIs available for this image instead of building
+        and copying it again, and returns True. Depending on AWS_REUSE, this
+        image is either registered again from the same snapshots under its
+        own name ('register'), or the earlier AMIs are announced as they are
+        ('reference'). Returns False if the image has to be built. """
+        if (not self.checksum or
+                fedimg.AWS_REUSE not in ('register', 'reference')):
+            return False
+        catalog = fedimg.catalog.get_catalog()
+        if catalog is None:
+            return False
+
+        amis = []
+        for ami in self._origin_amis() + self.test_amis:
+            if ami['region'] not in [a['region'] for a in amis]:
+                amis.append(ami)
+
+        # Any variant's snapshot will do to register this one from
+        variant = (self.virt_type, self.vol_type)
+        try:
+            rows = catalog.find_checksum(self.checksum)
+        except sqlite3.Error:
+            log.exception('Could not look up {0} in the catalog'.format(
+                self.checksum))
+            return False
+        known = {}
+        for row in rows:
+            if (fedimg.AWS_REUSE == 'register' or
+                    (row['virt_type'], row['vol_type']) == variant):
+                known.setdefault(row['region'], []).append(row)
+        missing = [a['region'] for a in amis if a['region'] not in known]
+        if missing:
+            if known:
+                log.info('{0} is not known in {1}; building it'.format(
+                    self.file_name, ', '.join(missing)))
+            return False
+
+        reused = []
+        registered = []
+        try:
+            with fedimg.trace.span('reuse'):
+                for ami in amis:
+                    region = ami['region']
+                    driver = self._connect(ami)
+                    rows = known[region]
+                    if fedimg.AWS_REUSE == 'reference':
+                        # Raises if the AMI was deleted since
+                        image = driver.get_image(rows[0]['ami_id'])
+                    else:
+                        image = self._register_image(
+                            driver, ami, self._known_snapshot(driver, rows))
+                        registered.append((ami, image))
+                    reused.append((ami, image))
+        except Exception:
+            log.exception('Could not reuse the AMIs of {0} in {1}; '
+                          'building it'.format(self.file_name, region))
+            catalog.forget_checksum(self.checksum, region)
+            for ami, image in registered:
+                try:
+                    self._connect(ami).delete_image(image)
+                except Exception:
+                    log.exception('Could not delete {0} in {1}'.format(
+                        image.id, ami['region']))
+            return False
+
+        for ami, image in reused:
+            if fedimg.AWS_REUSE == 'register':
+                self._connect(ami).ex_modify_image_attribute(
+                    image, {'LaunchPermission.Add.1.Group': 'all'})
+                self._remember(ami['region'], image)
+            log.info('Reused {0} in {1} for {2}'.format(
+                image.id, ami['region'], self.file_name))
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     'EC2 ({0})'.format(ami['region']),
+                                     'completed', extra=self._extra(image),
+                                     compose=compose_meta)
+        return True
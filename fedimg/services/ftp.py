@@ -19,15 +19,302 @@
 # Authors:  David Gay <dgay@redhat.com>
 #
 
+
 """
-This file might contain some code later, but since this service will likely
-be running on a machine that can write files to the NFS share behind our FTP
-server, the local download code in downloader.py is sufficient, at least for
-now.
+Publishing of images to the NFS share behind the internal Fedora FTP server.
+
+Images are downloaded in parallel parts straight into the share, and stored
+by content under a `.objects` directory. Each compose's copy of an image is a
+hardlink to the stored object, so an image that hasn't changed between
+composes takes no more space, and when its checksum is known up front, isn't
+even downloaded again. Every file is put in place with a rename, so readers
+of the share never see a partly written image.
+
+Images can also be published converted to other disk formats, which are
+stored next to the image they were converted from. Stored files that are no
+longer linked from any compose are pruned once they have been unlinked for a
+while.
 """
 
+import logging
+log = logging.getLogger("fedmsg")
+
+import errno
+import hashlib
+import multiprocessing.pool
+import os
+import tempfile
+import time
+import uuid
+
+import requests
 
-def upload(image):
-    """ Takes an image location provided by Koji and uploads it
-        to the internal Fedora FTP server."""
+import fedimg
+import fedimg.convert
+import fedimg.messenger
+import fedimg.stream
+import fedimg.trace
+
+# Images smaller than this many bytes per connection are downloaded in one go
+MIN_PART_SIZE = 64 * 1024 * 1024
+
+
+class FTPServiceException(Exception):
+    """ Custom exception for FTPService. """
     pass
+
+
+class FTPService(object):
+    """ Publishes an image to a local directory tree, along with its
+        conversions to `formats` (see fedimg.convert.FORMATS). `checksum`
+        is the image's SHA-256, if known. """
+
+    def __init__(self, raw_url, checksum=None, target_dir=None,
+                 connections=None, formats=None):
+        self.raw_url = raw_url
+        self.checksum = checksum
+        self.target_dir = target_dir or fedimg.FTP_TARGET_DIR
+        self.connections = connections or fedimg.FTP_CONNECTIONS
+        if formats is None:
+            formats = fedimg.FTP_FORMATS
+        self.formats = formats
+        self.file_name = self.raw_url.split('/')[-1]
+        self.objects_dir = os.path.join(self.target_dir, '.objects')
+        self.destination = 'FTP'
+
+    def _path(self, compose_meta):
+        """ Returns where the image is published, under a directory named
+        after the compose if there is one. """
+        compose_id = (compose_meta or {}).get('compose_id')
+        if compose_id:
+            return os.path.join(self.target_dir, compose_id, self.file_name)
+        return os.path.join(self.target_dir, self.file_name)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    def _link(self, source, dest):
+        """ Atomically makes `dest` a hardlink to `source`. """
+        tmp = '{0}.{1}.tmp'.format(dest, uuid.uuid4().hex)
+        os.link(source, tmp)
+        try:
+            os.rename(tmp, dest)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    def _fetch_part(self, args):
+        """ Downloads bytes `start` to `end` (inclusive) of the image into
+        the same place in the file at `path`. """
+        path, start, end = args
+        response = requests.get(
+            self.raw_url, stream=True,
+            headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise FTPServiceException(
+                "{0} ignored the range request".format(self.raw_url))
+
+        written = 0
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(fedimg.stream.CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+        if written != end - start + 1:
+            raise FTPServiceException(
+                "Got {0} bytes of {1}-{2} of {3}".format(
+                    written, start, end, self.raw_url))
+
+    def _download(self, path):
+        """ Downloads the image to `path`, in parallel parts if the server
+        allows it and the image is big enough. """
+        response = requests.head(self.raw_url, allow_redirects=True)
+        response.raise_for_status()
+        size = int(response.headers.get('Content-Length', 0))
+        ranges = response.headers.get('Accept-Ranges') == 'bytes'
+        connections = min(self.connections, size // MIN_PART_SIZE)
+
+        if not ranges or connections < 2:
+            with open(path, 'wb') as f:
+                fedimg.stream.fetch(self.raw_url, f)
+            return
+
+        log.info('Downloading {0} in {1} parts'.format(self.file_name,
+                                                       connections))
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        part = -(-size // connections)
+        parts = [(path, start, min(start + part, size) - 1)
+                 for start in range(0, size, part)]
+        pool = multiprocessing.pool.ThreadPool(processes=len(parts))
+        try:
+            pool.map(self._fetch_part, parts)
+        finally:
+            pool.close()
+
+    def _digest(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(fedimg.stream.CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _store(self, tmp, obj):
+        """ Moves the file `tmp` into the object store as `obj`, unless
+        that object is already stored. """
+        if os.path.exists(obj):
+            log.info('{0} is already stored'.format(os.path.basename(obj)))
+            os.unlink(tmp)
+            return
+        self._makedirs(os.path.dirname(obj))
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, obj)
+
+    def _publish_image(self, dest):
+        """ Puts the image in place as `dest`. Returns its stored object. """
+        if self.checksum and os.path.exists(self._object_path(self.checksum)):
+            log.info('{0} is unchanged, linking it'.format(self.file_name))
+            obj = self._object_path(self.checksum)
+            try:
+                self._link(obj, dest)
+                return obj
+            except OSError as e:
+                # Pruned since, so it has to be downloaded after all
+                if e.errno != errno.ENOENT:
+                    raise
+
+        self._makedirs(self.objects_dir)
+        fd, tmp = tempfile.mkstemp(prefix='.fedimg-', dir=self.objects_dir)
+        os.close(fd)
+        try:
+            self._download(tmp)
+            digest = self._digest(tmp)
+            if self.checksum and digest != self.checksum:
+                raise FTPServiceException(
+                    "{0} has checksum {1}, expected {2}".format(
+                        self.file_name, digest, self.checksum))
+            obj = self._object_path(digest)
+            self._store(tmp, obj)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        self._link(obj, dest)
+        return obj
+
+    def _publish_formats(self, obj, dest):
+        """ Puts the image in place in each of the configured formats, next
+        to `dest`. Conversions are stored alongside the image's object, so
+        an unchanged image is only converted once. Returns their paths. """
+        build_name = self.file_name.replace('.raw.xz', '')
+        missing = dict((fmt, '{0}.{1}'.format(obj, fmt))
+                       for fmt in self.formats
+                       if not os.path.exists('{0}.{1}'.format(obj, fmt)))
+
+        if missing:
+            tmps = {}
+            try:
+                for fmt in missing:
+                    fd, tmps[fmt] = tempfile.mkstemp(prefix='.fedimg-',
+                                                     dir=self.objects_dir)
+                    os.close(fd)
+                # One decompression feeds every format
+                with open(obj, 'rb') as f:
+                    fedimg.convert.convert_files(
+                        fedimg.stream.xz_decompress(f), tmps,
+                        name=build_name)
+                for fmt, tmp in tmps.items():
+                    self._store(tmp, missing[fmt])
+            finally:
+                for tmp in tmps.values():
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+
+        paths = []
+        for fmt in self.formats:
+            path = os.path.join(os.path.dirname(dest),
+                                '{0}.{1}'.format(build_name, fmt))
+            self._link('{0}.{1}'.format(obj, fmt), path)
+            paths.append(path)
+        return paths
+
+    def publish(self, compose_meta):
+        """ Puts the image, and its conversions to other formats, in place.
+        Returns their paths, the image's first. """
+        dest = self._path(compose_meta)
+        self._makedirs(os.path.dirname(dest))
+        with fedimg.trace.span('publish image'):
+            obj = self._publish_image(dest)
+        with fedimg.trace.span('convert'):
+            return [dest] + self._publish_formats(obj, dest)
+
+    def prune(self, age=None):
+        """ Deletes the files in the object store that no compose has linked
+        to for `age` seconds (FTP_PRUNE_AGE by default), along with any
+        temporary files left behind that long. Returns their paths. """
+        if age is None:
+            age = fedimg.FTP_PRUNE_AGE
+        # The link count changing updates the ctime, so an object's ctime
+        # is no later than when its last compose was removed.
+        cutoff = time.time() - age
+        pruned = []
+        for root, dirs, files in os.walk(self.objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                    if st.st_nlink == 1 and st.st_ctime < cutoff:
+                        os.unlink(path)
+                        pruned.append(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        for path in pruned:
+            log.info('Pruned {0}'.format(path))
+        return pruned
+
+    def upload(self, compose_meta):
+        """ Takes a URL to a .raw.xz file and publishes it to the FTP
+        server's share. """
+
+        fedimg.messenger.message('image.upload', self.raw_url,
+                                 self.destination, 'started',
+                                 compose=compose_meta)
+        try:
+            paths = self.publish(compose_meta)
+        except Exception:
+            log.exception('Publishing {0} failed'.format(self.file_name))
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination, 'failed',
+                                     compose=compose_meta)
+            return 1
+
+        log.info('Published {0}'.format(', '.join(paths)))
+        if fedimg.FTP_PRUNE_AGE:
+            try:
+                self.prune()
+            except Exception:
+                log.exception('Could not prune {0}'.format(
+                    self.objects_dir))
+        fedimg.messenger.message('image.upload', self.raw_url,
+                                 self.destination, 'completed',
+                                 extra={'path': paths[0],
+                                        'converted': paths[1:]},
+                                 compose=compose_meta)
+        return 0
+
+
+def jobs(raw_url):
+    """ Returns the job publishing an image to the FTP server's share, if
+    there is a share configured. """
+    if not fedimg.FTP_TARGET_DIR:
+        return []
+    return [FTPService(raw_url)]
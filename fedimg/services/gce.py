@@ -19,16 +19,22 @@
 # Authors:  David Gay <dgay@redhat.com>
 #
 
-import os
-import subprocess
 
-from libcloud.compute.base import NodeImage
-from libcloud.compute.deployment import MultiStepDeployment
-from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
+import logging
+log = logging.getLogger("fedmsg")
+
+import re
+import tempfile
+from time import sleep, time
+
+import requests
 from libcloud.compute.providers import get_driver
-from libcloud.compute.types import Provider, DeploymentException
+from libcloud.compute.types import Provider
 
 import fedimg
+import fedimg.messenger
+import fedimg.stream
+import fedimg.trace
 
 
 class GCEServiceException(Exception):
@@ -36,21 +42,238 @@ class GCEServiceException(Exception):
     pass
 
 
+class ResumableUploadException(GCEServiceException):
+    """ An upload to object storage failed and couldn't be resumed. """
+    pass
+
+
+def gce_image_name(build_name):
+    """ Turns a build name into a valid GCE image name (lowercase letters,
+    digits and dashes, starting with a letter, at most 63 characters). """
+    name = re.sub(r'[^a-z0-9-]', '-', build_name.lower())
+    if not name[:1].isalpha():
+        name = 'fedora-' + name
+    return name[:63].rstrip('-')
+
+
+class ResumableUpload(object):
+    """ Uploads a stream of unknown length to a Google Cloud Storage bucket
+        using the resumable upload protocol. Data is sent in chunks of
+        `chunk_size` bytes (a multiple of 256 KiB); if sending a chunk fails,
+        the upload carries on from the last byte the server acknowledged.
+        `auth` is a callable returning the headers to authenticate with. """
+
+    def __init__(self, base_url, bucket, name, auth=None,
+                 chunk_size=8 * 1024 * 1024, retries=5,
+                 content_type='application/x-tar'):
+        self.base_url = base_url.rstrip('/')
+        self.bucket = bucket
+        self.name = name
+        self.auth = auth or (lambda: {})
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.content_type = content_type
+        self.session = requests.Session()
+        self.session_url = None
+
+    def start(self):
+        """ Starts an upload session. """
+        headers = self.auth()
+        headers.update({'X-Upload-Content-Type': self.content_type,
+                        'Content-Type': 'application/json'})
+        response = self.session.post(
+            '{0}/b/{1}/o'.format(self.base_url, self.bucket),
+            params={'uploadType': 'resumable', 'name': self.name},
+            headers=headers, data='{}')
+        response.raise_for_status()
+        self.session_url = response.headers['Location']
+
+    def _committed(self, response):
+        """ Returns the number of bytes the server says it has, from the
+        Range header of a 308 response. """
+        match = re.match(r'bytes=0-(\d+)', response.headers.get('Range', ''))
+        return int(match.group(1)) + 1 if match else 0
+
+    def status(self, total=None):
+        """ Asks the server how many bytes of the upload it has. Returns
+        None if the upload is already complete. """
+        headers = self.auth()
+        headers['Content-Range'] = 'bytes */{0}'.format(
+            '*' if total is None else total)
+        response = self.session.put(self.session_url, headers=headers)
+        if response.status_code in (200, 201):
+            return None
+        if response.status_code != 308:
+            response.raise_for_status()
+        return self._committed(response)
+
+    def _send(self, data, start, total=None):
+        """ Sends `data`, which begins at byte `start` of the upload. `total`
+        is the size of the whole upload if this is the last chunk. """
+        size = '*' if total is None else total
+        failures = 0
+        while True:
+            headers = self.auth()
+            if data:
+                headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                    start, start + len(data) - 1, size)
+            else:
+                headers['Content-Range'] = 'bytes */{0}'.format(size)
+
+            try:
+                response = self.session.put(self.session_url, data=data,
+                                            headers=headers)
+                if response.status_code in (200, 201):
+                    return
+                if response.status_code == 308:
+                    committed = self._committed(response)
+                    if committed >= start + len(data):
+                        return
+                    # Only part of the chunk made it; send the rest
+                    data = data[committed - start:]
+                    start = committed
+                    continue
+                if response.status_code < 500 and \
+                        response.status_code != 429:
+                    response.raise_for_status()
+                log.warn('Upload of {0} got status {1}'.format(
+                    self.name, response.status_code))
+            except requests.ConnectionError:
+                log.exception('Upload of {0} was interrupted'.format(
+                    self.name))
+
+            failures += 1
+            if failures > self.retries:
+                raise ResumableUploadException(
+                    "Upload of {0} failed at byte {1}".format(self.name,
+                                                              start))
+            sleep(2 ** failures)
+
+            # Find out where to carry on from; the whole chunk may have
+            # made it before the connection broke
+            committed = self.status(total)
+            if committed is None or committed >= start + len(data):
+                return
+            data = data[committed - start:]
+            start = committed
+
+    def upload(self, chunks):
+        """ Uploads the byte strings in `chunks`. Returns the size of the
+        upload. """
+        self.start()
+
+        offset = 0
+        pending = []
+        pending_len = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            pending_len += len(chunk)
+            # Hold on to at least one byte, so that the last chunk can be
+            # sent along with the total size.
+            if pending_len <= self.chunk_size:
+                continue
+            data = b''.join(pending)
+            sent = 0
+            while len(data) - sent > self.chunk_size:
+                self._send(data[sent:sent + self.chunk_size], offset)
+                sent += self.chunk_size
+                offset += self.chunk_size
+            pending = [data[sent:]]
+            pending_len = len(pending[0])
+
+        data = b''.join(pending)
+        self._send(data, offset, total=offset + len(data))
+        return offset + len(data)
+
+
 class GCEService(object):
     """ A class for interacting with a GCE connection. """
 
-    def __init__(self):
+    def __init__(self, raw_url):
+        self.raw_url = raw_url
         self.datacenters = ['us-central1-a']
 
-    def upload(self, raw_url):
+        self.file_name = self.raw_url.split('/')[-1]
+        self.build_name = self.file_name.replace('.raw.xz', '')
+        self.image_name = gce_image_name(self.build_name)
+        self.image_desc = "Created from build {0}".format(self.build_name)
+        self.object_name = '{0}.tar.gz'.format(self.image_name)
+        self.destination = 'GCE ({0})'.format(self.datacenters[0])
+
+    def _tarball(self, compressed):
+        """ Yields the gzipped tarball holding the image as a sparse
+        disk.raw, which is what GCE imports images from. `compressed` is a
+        file holding the .raw.xz image. The image is decompressed twice: once
+        to find its holes, which the tar header lists up front, and once to
+        write the data. """
+        compressed.seek(0)
+        extents, size = fedimg.stream.scan_extents(
+            fedimg.stream.xz_decompress(compressed))
+        log.info('{0} is {1} bytes, {2} of them data'.format(
+            self.file_name, size, sum(length for _, length in extents)))
+
+        compressed.seek(0)
+        tar = fedimg.stream.sparse_tar(
+            fedimg.stream.xz_decompress(compressed), 'disk.raw', extents,
+            size, mtime=time())
+        return fedimg.stream.gzip_compress(tar)
+
+    def upload(self, compose_meta):
         """ Takes a URL to a .raw.xz file and registers it as an image
-        in each Rackspace region. """
+        in GCE. """
+
+        fedimg.messenger.message('image.upload', self.raw_url,
+                                 self.destination, 'started',
+                                 compose=compose_meta)
+
+        try:
+            cls = get_driver(Provider.GCE)
+            driver = fedimg.trace.driver(
+                cls(fedimg.GCE_EMAIL, fedimg.GCE_KEYPATH,
+                    project=fedimg.GCE_PROJECT_ID,
+                    datacenter=self.datacenters[0]),
+                self.datacenters[0])
+
+            def auth():
+                token = driver.connection.oauth2_credential.access_token
+                return {'Authorization': 'Bearer ' + token}
+
+            upload = ResumableUpload(fedimg.GCE_STORAGE_URL,
+                                     fedimg.GCE_BUCKET, self.object_name,
+                                     auth=auth)
+
+            # Only the compressed image is kept on disk; the raw image and
+            # the tarball are streamed.
+            with tempfile.TemporaryFile() as compressed:
+                log.info('Downloading {0}'.format(self.raw_url))
+                fedimg.stream.fetch(self.raw_url, compressed)
+
+                log.info('Uploading {0} to {1}'.format(self.object_name,
+                                                       fedimg.GCE_BUCKET))
+                size = upload.upload(self._tarball(compressed))
+                log.info('Uploaded {0} bytes'.format(size))
+
+            log.info('Creating GCE image {0}'.format(self.image_name))
+            image = driver.ex_create_image(
+                self.image_name,
+                'https://storage.googleapis.com/{0}/{1}'.format(
+                    fedimg.GCE_BUCKET, self.object_name),
+                description=self.image_desc)
+
+        except Exception:
+            log.exception('GCE upload of {0} failed'.format(self.build_name))
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination, 'failed',
+                                     compose=compose_meta)
+            return 1
 
-        cls = get_driver(Provider.GCE)
-        driver = cls(fedimg.GCE_EMAIL, fedimg.GCE_KEYPATH,
-                     project=fedimg.GCE_PROJECT_ID,
-                     datacenter=self.datacenters[0])
+        fedimg.messenger.message('image.upload', self.raw_url,
+                                 self.destination, 'completed',
+                                 extra={'id': image.name},
+                                 compose=compose_meta)
+        return 0
 
-        # create image from official Fedora image on GCE
 
-        # emit a fedmsg, etc
+def jobs(raw_url):
+    """ Returns the GCE upload job for an image. """
+    return [GCEService(raw_url)]
@@ -19,38 +19,34 @@
 # Authors:  David Gay <dgay@redhat.com>
 #
 
-import os
-import subprocess
-
-from libcloud.compute.base import NodeImage
-from libcloud.compute.deployment import MultiStepDeployment
-from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
-from libcloud.compute.providers import get_driver
-from libcloud.compute.types import Provider, DeploymentException
 
 import fedimg
+from fedimg.services.openstack import OpenStackService
 
 
-class HPServiceException(Exception):
-    """ Custom exception for HP. """
-    pass
+class HPService(OpenStackService):
+    """ Registers images in the Glance service of each HP region. """
 
+    name = 'HP'
+    regions = ['region-b.geo-1']
 
-class HPService(object):
-    """ A class for interacting with an HP connection. """
+    @property
+    def auth_url(self):
+        return fedimg.HP_AUTH_URL
 
-    def __init__(self):
-        self.regions = ['region-b.geo-1']
+    @property
+    def user(self):
+        return fedimg.HP_USER
 
-    def upload(self, raw_url):
-        """ Takes a URL to a .raw.xz file and registers it as an image
-        in each Rackspace region. """
+    @property
+    def password(self):
+        return fedimg.HP_PASSWORD
 
-        cls = get_driver(Provider.HPCLOUD)
-        driver = cls(fedimg.HP_USER, fedimg.HP_PASSWORD,
-                     tenant_name=fedimg.HP_TENANT,
-                     region=self.regions[0])
+    @property
+    def tenant(self):
+        return fedimg.HP_TENANT
 
-        # create image from official Fedora image on HP
 
-        # emit a fedmsg, etc
+def jobs(raw_url):
+    """ Returns the HP upload job for an image. """
+    return [HPService(raw_url)]
@@ -0,0 +1,300 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+A Glance image upload engine shared by the OpenStack based services.
+
+The image is downloaded and decompressed once, and the raw data is fed to one
+upload per region at the same time. Each upload streams its data into Glance
+with chunked transfer encoding, so the raw image is never held in memory or
+written to disk. Images are created private, and only made public once their
+data is in and Glance has made them active.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import json
+import Queue
+import re
+import threading
+from time import sleep, time
+
+import requests
+
+import fedimg
+import fedimg.messenger
+import fedimg.stream
+
+# Number of chunks each region's upload may fall behind the decompression
+QUEUE_CHUNKS = 16
+
+
+class OpenStackServiceException(Exception):
+    """ Custom exception for OpenStack services. """
+    pass
+
+
+class _RegionUpload(object):
+    """ Uploads the chunks put on its queue to an image in one region's
+        Glance, from a thread of its own. """
+
+    def __init__(self, service, region, endpoint):
+        self.service = service
+        self.region = region
+        self.endpoint = endpoint
+        self.queue = Queue.Queue(maxsize=QUEUE_CHUNKS)
+        self.image_id = None
+        self.error = None
+        self.drained = False
+        self.thread = threading.Thread(target=self.run,
+                                       name='glance-' + region)
+        self.thread.daemon = True
+
+    def chunks(self):
+        """ Yields the chunks put on the queue until the end of the image.
+        An exception on the queue means the image couldn't be read, and is
+        raised to abort the upload. """
+        while not self.drained:
+            chunk = self.queue.get()
+            if chunk is None or isinstance(chunk, Exception):
+                self.drained = True
+                if chunk is not None:
+                    raise chunk
+                return
+            yield chunk
+
+    def run(self):
+        try:
+            self.image_id = self.service.create_image(self.endpoint)
+            self.service.upload_data(self.endpoint, self.image_id,
+                                     self.chunks())
+            self.service.wait_for_image(self.endpoint, self.image_id)
+            self.service.publish_image(self.endpoint, self.image_id)
+        except Exception as e:
+            log.exception('Glance upload to {0} failed'.format(self.region))
+            self.error = e
+            # Keep taking chunks so that the other regions aren't held up
+            try:
+                for chunk in self.chunks():
+                    pass
+            except Exception:
+                pass
+            if self.image_id and fedimg.DELETE_IMAGES_ON_FAILURE:
+                try:
+                    self.service.delete_image(self.endpoint, self.image_id)
+                except Exception:
+                    log.exception('Could not delete {0} in {1}'.format(
+                        self.image_id, self.region))
+
+
+class OpenStackService(object):
+    """ Registers an image in the Glance service of several regions of an
+        OpenStack cloud. Subclasses set `name` (used in message
+        destinations), `auth_url` and `regions`, and either `user`,
+        `password` and `tenant`, or `credentials` if the cloud takes
+        something other than a password. """
+
+    name = 'OpenStack'
+    auth_url = None
+    regions = []
+    user = None
+    password = None
+    tenant = None
+
+    def __init__(self, raw_url, timeout=3600):
+        self.raw_url = raw_url
+        self.timeout = timeout
+        self.file_name = self.raw_url.split('/')[-1]
+        self.build_name = self.file_name.replace('.raw.xz', '')
+        self.token = None
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """ The requests session of the calling thread. Each region is
+        uploaded to from a thread of its own, so no connection pool is
+        shared between them. """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        if self.token:
+            session.headers['X-Auth-Token'] = self.token
+        return session
+
+    def credentials(self):
+        """ Returns the `auth` part of a Keystone v2 token request. """
+        return {'passwordCredentials': {'username': self.user,
+                                        'password': self.password},
+                'tenantName': self.tenant}
+
+    def authenticate(self):
+        """ Gets a token from Keystone, and returns a dict mapping each
+        region (in lower case) to its Glance v2 endpoint. """
+        response = self.session.post(
+            self.auth_url.rstrip('/') + '/tokens',
+            data=json.dumps({'auth': self.credentials()}),
+            headers={'Content-Type': 'application/json',
+                     'Accept': 'application/json'})
+        response.raise_for_status()
+        access = response.json()['access']
+        self.token = access['token']['id']
+
+        endpoints = {}
+        for service in access['serviceCatalog']:
+            if service['type'] != 'image':
+                continue
+            for endpoint in service['endpoints']:
+                url = endpoint['publicURL'].rstrip('/')
+                if not re.search(r'/v2(/|$)', url):
+                    url += '/v2'
+                endpoints[endpoint['region'].lower()] = url
+        return endpoints
+
+    def destination(self, region):
+        return '{0} ({1})'.format(self.name, region)
+
+    def create_image(self, endpoint):
+        """ Creates an empty image record. Returns its ID. """
+        response = self.session.post(
+            endpoint + '/images',
+            data=json.dumps({'name': self.build_name,
+                             'disk_format': 'raw',
+                             'container_format': 'bare',
+                             'visibility': 'private'}),
+            headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+        return response.json()['id']
+
+    def publish_image(self, endpoint, image_id):
+        """ Makes the image public. """
+        response = self.session.patch(
+            '{0}/images/{1}'.format(endpoint, image_id),
+            data=json.dumps([{'op': 'replace', 'path': '/visibility',
+                              'value': 'public'}]),
+            headers={'Content-Type':
+                     'application/openstack-images-v2.1-json-patch'})
+        response.raise_for_status()
+
+    def upload_data(self, endpoint, image_id, chunks):
+        """ Streams the byte strings in `chunks` into the image. Since the
+        length isn't known up front, requests sends them with chunked
+        transfer encoding. """
+        response = self.session.put(
+            '{0}/images/{1}/file'.format(endpoint, image_id), data=chunks,
+            headers={'Content-Type': 'application/octet-stream'})
+        response.raise_for_status()
+
+    def delete_image(self, endpoint, image_id):
+        response = self.session.delete(
+            '{0}/images/{1}'.format(endpoint, image_id))
+        response.raise_for_status()
+
+    def wait_for_image(self, endpoint, image_id):
+        """ Polls the image, backing off between polls, until Glance has made
+        it active. """
+        deadline = time() + self.timeout
+        delay = 1
+        while True:
+            response = self.session.get(
+                '{0}/images/{1}'.format(endpoint, image_id))
+            response.raise_for_status()
+            status = response.json()['status']
+            if status == 'active':
+                return
+            if status in ('killed', 'deleted'):
+                raise OpenStackServiceException(
+                    "Image {0} is {1}".format(image_id, status))
+            if time() > deadline:
+                raise OpenStackServiceException(
+                    "Image {0} still {1} after {2} seconds".format(
+                        image_id, status, self.timeout))
+            sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _feed(self, uploads):
+        """ Decompresses the image once, putting every chunk on the queue of
+        each upload. """
+        try:
+            for chunk in fedimg.stream.xz_decompress(
+                    fedimg.stream.iter_url(self.raw_url)):
+                for upload in uploads:
+                    upload.queue.put(chunk)
+        except Exception as e:
+            log.exception('Could not read {0}'.format(self.raw_url))
+            for upload in uploads:
+                upload.queue.put(e)
+        else:
+            for upload in uploads:
+                upload.queue.put(None)
+
+    def upload(self, compose_meta):
+        """ Takes a URL to a .raw.xz file and registers it as an image
+        in each region. """
+
+        for region in self.regions:
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination(region), 'started',
+                                     compose=compose_meta)
+
+        try:
+            endpoints = self.authenticate()
+        except Exception:
+            log.exception('{0} authentication failed'.format(self.name))
+            endpoints = {}
+
+        uploads = []
+        failed = []
+        for region in self.regions:
+            if region.lower() in endpoints:
+                uploads.append(_RegionUpload(self, region,
+                                             endpoints[region.lower()]))
+            else:
+                log.error('No {0} image endpoint for {1}'.format(self.name,
+                                                                 region))
+                failed.append(region)
+
+        for upload in uploads:
+            upload.thread.start()
+        if uploads:
+            self._feed(uploads)
+        for upload in uploads:
+            upload.thread.join()
+
+        for upload in uploads:
+            if upload.error is None:
+                log.info('Registered {0} in {1}'.format(upload.image_id,
+                                                        upload.region))
+                fedimg.messenger.message('image.upload', self.raw_url,
+                                         self.destination(upload.region),
+                                         'completed',
+                                         extra={'id': upload.image_id},
+                                         compose=compose_meta)
+            else:
+                failed.append(upload.region)
+
+        for region in failed:
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination(region), 'failed',
+                                     compose=compose_meta)
+
+        return 1 if failed else 0
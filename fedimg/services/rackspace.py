@@ -19,38 +19,27 @@
 # Authors:  David Gay <dgay@redhat.com>
 #
 
-import os
-import subprocess
-
-from libcloud.compute.base import NodeImage
-from libcloud.compute.deployment import MultiStepDeployment
-from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
-from libcloud.compute.providers import get_driver
-from libcloud.compute.types import Provider, DeploymentException
 
 import fedimg
+from fedimg.services.openstack import OpenStackService
 
 
-class RackspaceServiceException(Exception):
-    """ Custom exception for RackspaceService. """
-    pass
-
-
-class RackspaceService(object):
-    """ A class for interacting with a Rackspace connection. """
-
-    def __init__(self):
+class RackspaceService(OpenStackService):
+    """ Registers images in the Glance service of each Rackspace region. """
 
-        self.regions = ['dfw', 'ord', 'iad', 'lon', 'syd', 'hkg']
+    name = 'Rackspace'
+    regions = ['dfw', 'ord', 'iad', 'lon', 'syd', 'hkg']
 
-    def upload(self, raw_url):
-        """ Takes a URL to a .raw.xz file and registers it as an image
-        in each Rackspace region. """
+    @property
+    def auth_url(self):
+        return fedimg.RACKSPACE_AUTH_URL
 
-        cls = get_driver(Provider.RACKSPACE)
-        driver = cls(fedimg.RACKSPACE_USER, fedimg.RACKSPACE_API_KEY,
-                     region=self.regions[0])
+    def credentials(self):
+        return {'RAX-KSKEY:apiKeyCredentials': {
+            'username': fedimg.RACKSPACE_USER,
+            'apiKey': fedimg.RACKSPACE_API_KEY}}
 
-        # create image from official Fedora image on Rackspace
 
-        # emit a fedmsg, etc
+def jobs(raw_url):
+    """ Returns the Rackspace upload job for an image. """
+    return [RackspaceService(raw_url)]
@@ -0,0 +1,247 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Streaming helpers for services that process images locally.
+
+Images are handled as iterators of byte strings, so that a multi-gigabyte raw
+image is never held in memory or written out to disk in full.
+"""
+
+import subprocess
+import threading
+import zlib
+
+import requests
+
+# Size of the chunks read from the network and from decompressors
+CHUNK_SIZE = 1024 * 1024
+
+# Granularity at which runs of zeros are turned into holes
+HOLE_SIZE = 64 * 1024
+
+TAR_BLOCK = 512
+TAR_RECORD = 20 * TAR_BLOCK
+
+
+def fetch(url, fileobj, chunk_size=CHUNK_SIZE):
+    """ Streams the file at `url` into `fileobj`. """
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    for chunk in response.iter_content(chunk_size):
+        fileobj.write(chunk)
+    fileobj.flush()
+
+
+def iter_url(url, chunk_size=CHUNK_SIZE):
+    """ Yields the file at `url` in chunks. """
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    for chunk in response.iter_content(chunk_size):
+        yield chunk
+
+
+def xz_decompress(source, chunk_size=CHUNK_SIZE):
+    """ Yields the decompressed contents of `source`, which is either a real
+    file or an iterable of chunks of .xz data. Decompression is done by an
+    `xz` process, just like on the EC2 utility nodes. """
+    if hasattr(source, 'fileno'):
+        proc = subprocess.Popen(['xz', '--decompress', '--stdout'],
+                                stdin=source, stdout=subprocess.PIPE)
+        feeder = None
+    else:
+        proc = subprocess.Popen(['xz', '--decompress', '--stdout'],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+
+        def feed():
+            try:
+                for chunk in source:
+                    proc.stdin.write(chunk)
+            except IOError:
+                # xz went away; its exit status tells why
+                pass
+            finally:
+                proc.stdin.close()
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+    try:
+        while True:
+            data = proc.stdout.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        proc.stdout.close()
+        if feeder is not None:
+            feeder.join()
+        status = proc.wait()
+
+    if status != 0:
+        raise IOError("xz exited with status {0}".format(status))
+
+
+def blocks(chunks, size):
+    """ Re-chunks the byte strings of `chunks` into blocks of exactly `size`
+    bytes. Only the last block may be shorter. """
+    pending = []
+    pending_len = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_len += len(chunk)
+        if pending_len < size:
+            continue
+        data = b''.join(pending)
+        offset = 0
+        while len(data) - offset >= size:
+            yield data[offset:offset + size]
+            offset += size
+        pending = [data[offset:]]
+        pending_len = len(pending[0])
+    if pending_len:
+        yield b''.join(pending)
+
+
+def is_zero(block, _zeros=b'\0' * HOLE_SIZE):
+    """ Returns True if `block` only contains zero bytes. """
+    if len(block) <= len(_zeros):
+        return block == _zeros[:len(block)]
+    return block.count(b'\0') == len(block)
+
+
+def scan_extents(chunks, hole_size=HOLE_SIZE):
+    """ Reads a whole raw image from `chunks` and returns a list of
+    [offset, length] pairs for the parts of it that aren't all zeros,
+    along with the size of the image. """
+    extents = []
+    offset = 0
+    for block in blocks(chunks, hole_size):
+        if not is_zero(block):
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1][1] += len(block)
+            else:
+                extents.append([offset, len(block)])
+        offset += len(block)
+    return extents, offset
+
+
+def _number(value, width):
+    """ Formats `value` as a tar header number field of `width` bytes: octal
+    if it fits, GNU base-256 otherwise. """
+    digits = width - 1
+    if value < 8 ** digits:
+        return ('%0*o' % (digits, value)).encode('ascii') + b'\0'
+    field = bytearray(width)
+    field[0] = 0x80
+    for i in range(width - 1, 0, -1):
+        field[i] = value & 0xff
+        value >>= 8
+    return bytes(field)
+
+
+def _sparse_entries(extents):
+    """ Returns the sparse map entries (offset + numbytes) for `extents`. """
+    return b''.join(_number(offset, 12) + _number(length, 12)
+                    for offset, length in extents)
+
+
+def sparse_tar_header(name, extents, size, mtime=0):
+    """ Returns the old GNU format ('S' type) tar header, and any extension
+    headers, for a sparse file called `name` of `size` bytes whose data is
+    in `extents`. This is the format `tar --format=oldgnu -S` writes. """
+    extents = [list(e) for e in extents]
+    # GNU tar always ends the map with the end of the file
+    if not extents or extents[-1][0] + extents[-1][1] < size:
+        extents.append([size, 0])
+    stored = sum(length for offset, length in extents)
+
+    header = bytearray(TAR_BLOCK)
+    header[0:len(name)] = name.encode('ascii')
+    header[100:108] = _number(0o644, 8)
+    header[108:116] = _number(0, 8)
+    header[116:124] = _number(0, 8)
+    header[124:136] = _number(stored, 12)
+    header[136:148] = _number(int(mtime), 12)
+    header[156:157] = b'S'
+    header[257:263] = b'ustar '
+    header[263:265] = b' \0'
+    header[265:269] = b'root'
+    header[297:301] = b'root'
+    header[386:386 + 24 * min(4, len(extents))] = _sparse_entries(
+        extents[:4])
+    header[482:483] = b'\1' if len(extents) > 4 else b'\0'
+    header[483:495] = _number(size, 12)
+
+    # The checksum is computed with the checksum field set to spaces
+    header[148:156] = b' ' * 8
+    header[148:156] = ('%06o' % sum(header)).encode('ascii') + b'\0 '
+
+    result = [bytes(header)]
+
+    # Extension headers hold 21 more entries each
+    rest = extents[4:]
+    while rest:
+        ext = bytearray(TAR_BLOCK)
+        entries, rest = rest[:21], rest[21:]
+        ext[0:24 * len(entries)] = _sparse_entries(entries)
+        ext[504:505] = b'\1' if rest else b'\0'
+        result.append(bytes(ext))
+
+    return b''.join(result)
+
+
+def sparse_tar(chunks, name, extents, size, mtime=0, hole_size=HOLE_SIZE):
+    """ Yields a tar archive holding a single sparse file called `name`,
+    with the contents read from `chunks`. `extents` and `size` must come
+    from `scan_extents` on the same contents, with the same `hole_size`. """
+    header = sparse_tar_header(name, extents, size, mtime)
+    yield header
+
+    written = 0
+    extents = iter(extents)
+    current = next(extents, None)
+    offset = 0
+    for block in blocks(chunks, hole_size):
+        while current is not None and offset >= current[0] + current[1]:
+            current = next(extents, None)
+        if current is not None and offset >= current[0]:
+            yield block
+            written += len(block)
+        offset += len(block)
+
+    # Pad the file data to a full block, then end the archive with two
+    # zero blocks, padded to a full record
+    padding = -written % TAR_BLOCK
+    total = len(header) + written + padding + 2 * TAR_BLOCK
+    yield b'\0' * (padding + 2 * TAR_BLOCK + (-total % TAR_RECORD))
+
+
+def gzip_compress(chunks, level=6):
+    """ Yields the gzip-compressed form of `chunks`. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
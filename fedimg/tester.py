@@ -0,0 +1,76 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Scheduling of image boot tests.
+
+Tests run on a threadpool of their own rather than on the upload pool, so the
+test nodes for every variant of a compose can boot at the same time while the
+upload jobs carry on with replication.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import multiprocessing.pool
+import random
+import threading
+
+import fedimg
+import fedimg.trace
+
+
+class TestScheduler(object):
+    """ Runs test callables concurrently and hands back results that can be
+        waited on once the caller actually needs to know the outcome. """
+
+    def __init__(self, processes=None):
+        processes = processes or fedimg.AWS_TEST_CONCURRENCY
+        self.pool = multiprocessing.pool.ThreadPool(processes=processes)
+
+    def submit(self, func, *args, **kwargs):
+        """ Schedules `func` to be called with the given arguments and returns
+        an AsyncResult. Calling `get()` on the result re-raises any exception
+        raised by the test. """
+        return self.pool.apply_async(
+            fedimg.trace.propagate(func, queued='queued for test'), args,
+            kwargs)
+
+    def sample(self, population, count=None):
+        """ Picks `count` items (by default, the configured number of
+        regional tests) at random out of `population`. """
+        if count is None:
+            count = fedimg.AWS_REGIONAL_TESTS
+        count = min(count, len(population))
+        return random.sample(population, count)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """ Returns the test scheduler shared by all upload jobs. """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TestScheduler()
+    return _scheduler
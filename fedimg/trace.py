@@ -0,0 +1,264 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Timelines of upload jobs.
+
+With a trace directory configured, the stages of every upload job and the
+cloud API calls they make are recorded as spans, tagged with the thread, job
+and region they ran in. Once all the jobs started for a compose are done, its
+spans are written out in the Chrome trace event format, which
+chrome://tracing and https://ui.perfetto.dev can open.
+
+Spans are only recorded in threads running a traced job (see `job`), and
+threads started by a job only carry its tags if their callable went through
+`propagate`.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+import fedimg
+
+_local = threading.local()
+
+
+def _tags():
+    return getattr(_local, 'tags', {})
+
+
+@contextlib.contextmanager
+def tags(**kwargs):
+    """ Adds `kwargs` to the tags of the spans recorded by this thread for
+    the duration of a `with` block. """
+    old = _tags()
+    new = dict(old)
+    new.update(kwargs)
+    _local.tags = new
+    try:
+        yield
+    finally:
+        _local.tags = old
+
+
+@contextlib.contextmanager
+def span(name, cat='stage', **args):
+    """ Records the `with` block as a span called `name`, with `args`, if
+    this thread is running a traced job. """
+    current = _tags()
+    tracer = get_tracer()
+    if tracer is None or 'trace' not in current:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        tracer.add(current, name, cat, start, time.time(), args)
+
+
+def propagate(func, queued=None):
+    """ Returns a callable that runs `func` with the calling thread's tags,
+    for handing to another thread. If `queued` is given, the time between
+    now and when `func` starts is recorded as a span by that name. """
+    current = _tags()
+    submitted = time.time()
+
+    def wrapper(*args, **kwargs):
+        old = _tags()
+        _local.tags = current
+        try:
+            tracer = get_tracer()
+            if queued and tracer is not None and 'trace' in current:
+                tracer.add(current, queued, 'queue', submitted, time.time(),
+                           {})
+            return func(*args, **kwargs)
+        finally:
+            _local.tags = old
+
+    wrapper.__name__ = getattr(func, '__name__', 'wrapper')
+    return wrapper
+
+
+class TracedDriver(object):
+    """ Wraps a libcloud driver so that every call to one of its methods
+        is recorded as a span in `region`. """
+
+    def __init__(self, driver, region):
+        self._driver = driver
+        self._region = region
+
+    def __getattr__(self, name):
+        attr = getattr(self._driver, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with span(name, cat='api', region=self._region):
+                return attr(*args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+
+def driver(driver, region):
+    """ Returns `driver`, wrapped so that its calls are traced if tracing
+    is enabled. """
+    if get_tracer() is None:
+        return driver
+    return TracedDriver(driver, region)
+
+
+def chrome_events(events, pid=None):
+    """ Turns recorded spans into a list of Chrome trace events. """
+    pid = pid or os.getpid()
+    threads = {}
+    result = []
+    for event in events:
+        threads[event['tid']] = event['thread']
+        result.append({
+            'name': event['name'],
+            'cat': event['cat'],
+            'ph': 'X',
+            'ts': int(event['start'] * 1000000),
+            'dur': int((event['end'] - event['start']) * 1000000),
+            'pid': pid,
+            'tid': event['tid'],
+            'args': event['args'],
+        })
+    for tid, name in sorted(threads.items()):
+        result.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}})
+    return result
+
+
+class Tracer(object):
+    """ Collects the spans of the jobs started for each trace (usually a
+        compose), and writes them to `directory` once the last of those jobs
+        is done. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.events = {}
+        self.pending = {}
+        self.started = {}
+
+    def begin(self, key, jobs=1):
+        """ Notes that `jobs` more jobs are part of the trace `key`. """
+        with self.lock:
+            if key not in self.pending:
+                self.pending[key] = 0
+                self.events[key] = []
+                self.started[key] = time.time()
+            self.pending[key] += jobs
+
+    def add(self, tags, name, cat, start, end, args):
+        """ Records a span for the trace in `tags`. """
+        thread = threading.current_thread()
+        args = dict(args)
+        args.update((k, v) for k, v in tags.items() if k != 'trace')
+        event = {'name': name, 'cat': cat, 'start': start, 'end': end,
+                 'tid': thread.ident, 'thread': thread.name, 'args': args}
+        with self.lock:
+            if tags['trace'] in self.events:
+                self.events[tags['trace']].append(event)
+
+    def end(self, key):
+        """ Notes that a job of the trace `key` is done, and writes out the
+        trace if it was the last one. Returns the path written to, if any.
+        Traces that were never begun are ignored. """
+        with self.lock:
+            pending = self.pending.pop(key, None)
+            if pending is None:
+                return None
+            if pending > 1:
+                self.pending[key] = pending - 1
+                return None
+            events = self.events.pop(key)
+            started = self.started.pop(key)
+
+        name = '{0}-{1}.json'.format(
+            key, time.strftime('%Y%m%d%H%M%S', time.gmtime(started)))
+        path = os.path.join(self.directory, name)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': chrome_events(events),
+                           'displayTimeUnit': 'ms'}, f)
+        except (IOError, OSError):
+            log.exception('Could not write trace {0}'.format(path))
+            return None
+        log.info('Wrote trace {0}'.format(path))
+        return path
+
+
+@contextlib.contextmanager
+def job(key, name):
+    """ Runs the `with` block as the job `name` of the trace `key`, which
+    must have been started with `Tracer.begin`. """
+    tracer = get_tracer()
+    if tracer is None or key is None:
+        yield
+        return
+    try:
+        with tags(trace=key, job=name):
+            with span('job'):
+                yield
+    finally:
+        tracer.end(key)
+
+
+def skip(key):
+    """ Notes that a job of the trace `key` won't run after all, because it
+    was cancelled before it started or handed off. """
+    tracer = get_tracer()
+    if tracer is not None and key is not None:
+        tracer.end(key)
+
+
+def trace_key(compose_meta):
+    """ Returns the key of the trace for uploads of `compose_meta`. """
+    compose_id = (compose_meta or {}).get('compose_id')
+    return compose_id or 'uploads'
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """ Returns the tracer configured for fedimg, or None if tracing is
+    disabled. """
+    global _tracer
+    if not fedimg.TRACE_DIR:
+        return None
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer(fedimg.TRACE_DIR)
+    return _tracer
@@ -22,26 +22,415 @@
 import logging
 log = logging.getLogger("fedmsg")
 
-from fedimg.services.ec2 import EC2Service
-from fedimg.util import virt_types_from_url
+import multiprocessing.pool
+import threading
+import time
 
+import fedimg
+import fedimg.cancel
+import fedimg.jobqueue
+import fedimg.ledger
+import fedimg.planner
+import fedimg.services
+import fedimg.trace
+from fedimg.util import build_key, build_series
 
-def upload(pool, urls, compose_meta):
-    """ Takes a list (urls) of one or more .raw.xz image files and
-    sends them off to cloud services for registration. The upload
-    jobs threadpool must be passed as `pool`."""
+_pools = {}
+_pools_lock = threading.Lock()
 
-    log.info('Starting upload process')
+# (build, cancellation token) pairs for the jobs queued or running for each
+# image series (see fedimg.util.build_series)
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# (provider, url, job, compose_meta) for the jobs queued or running, by
+# cancellation token, until they finish or are handed off to the next
+# process; the condition is notified as each one goes
+_running = {}
+_running_cond = threading.Condition()
+
+# Set once the uploader stops taking jobs (see `drain`)
+_draining = threading.Event()
+
+# The jobs made for each image that jobs were picked up for one at a time
+# (see `find_job`), by provider and URL, so that they share what the jobs of
+# an image share when they are made together, like EC2 snapshots. Each job
+# is handed out once; groups are dropped after GROUP_TTL seconds.
+GROUP_TTL = 60 * 60
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def get_pool(provider):
+    """ Returns the threadpool that `provider`'s upload jobs run on. Each
+    provider has its own, so a slow cloud doesn't hold up the others. """
+    with _pools_lock:
+        if provider not in _pools:
+            _pools[provider] = multiprocessing.pool.ThreadPool(
+                processes=fedimg.PROVIDER_CONCURRENCY.get(provider, 1))
+        return _pools[provider]
+
+
+def _label(provider, job):
+    """ Returns a name for `job` in traces. """
+    parts = [provider, getattr(job, 'file_name', None),
+             getattr(job, 'virt_type', None), getattr(job, 'vol_type', None)]
+    return ' '.join(p for p in parts if p)
+
+
+def _cancel_superseded(token, build):
+    """ Cancels the job of `token`, superseded by `build`, as the
+    `supersede` option says. """
+    reason = 'superseded by {0}'.format(build)
+    if fedimg.SUPERSEDE == 'cancel':
+        token.cancel(reason)
+    elif fedimg.SUPERSEDE == 'queued':
+        token.cancel(reason, pending_only=True)
+
+
+def _supersede(url, token):
+    """ Records `token` as that of a job for the image at `url`, and
+    cancels the jobs in flight for older builds of the same image. If a
+    newer build is already in flight, this job is the one cancelled.
+    Returns the image's series, or None. """
+    build = url.split('/')[-1].replace('.raw.xz', '')
+    series = build_series(build)
+    if series is None:
+        return None
+    key = build_key(build)
+    with _in_flight_lock:
+        entries = _in_flight.setdefault(series, [])
+        for other_build, other in entries:
+            other_key = build_key(other_build)
+            if other_key < key:
+                _cancel_superseded(other, build)
+            elif other_key > key:
+                _cancel_superseded(token, other_build)
+        entries.append((build, token))
+    return series
 
-    services = []
+
+def _supersede_queued(queue, url):
+    """ Takes the jobs for older builds of the image at `url` off the job
+    `queue`, as the `supersede` option says. Returns False if a newer build
+    is queued, which supersedes this one. """
+    if fedimg.SUPERSEDE not in ('cancel', 'queued'):
+        return True
+    build = url.split('/')[-1].replace('.raw.xz', '')
+    series = build_series(build)
+    if series is None:
+        return True
+    key = build_key(build)
+    newer = False
+    for id, other_url, leased in queue.entries():
+        other_build = other_url.split('/')[-1].replace('.raw.xz', '')
+        if build_series(other_build) != series:
+            continue
+        other_key = build_key(other_build)
+        if other_key > key:
+            newer = True
+        elif other_key < key and (fedimg.SUPERSEDE == 'cancel' or
+                                  not leased):
+            if queue.remove(id, pending_only=fedimg.SUPERSEDE == 'queued'):
+                log.info('Took job {0} for {1} off the queue: superseded '
+                         'by {2}'.format(id, other_build, build))
+    return not newer
+
+
+def _finished(series, token):
+    """ Forgets `token` once its job is done. """
+    with _in_flight_lock:
+        entries = _in_flight.get(series, [])
+        entries[:] = [e for e in entries if e[1] is not token]
+        if not entries:
+            _in_flight.pop(series, None)
+
+
+def _forget(token):
+    """ Forgets the job of `token` once it's done or handed off. Returns
+    what was recorded about it, or None if it was already forgotten. """
+    with _running_cond:
+        entry = _running.pop(token, None)
+        _running_cond.notify_all()
+    return entry
+
+
+def _hand_off(token, state=None):
+    """ Records the job of `token` in the ledger for the next process to
+    run again, or with `state`, to resume. Returns False if the job was
+    already handed off or done, or there's no ledger to record it in. """
+    entry = _forget(token)
+    if entry is None:
+        return False
+    provider, url, job, compose_meta = entry
+    label = _label(provider, job)
+    try:
+        ledger = fedimg.ledger.get_ledger()
+        if ledger is None:
+            log.warn('No ledger to hand {0} off to; it is lost'.format(
+                label))
+            return False
+        ledger.checkpoint(provider, url, label, compose_meta,
+                          getattr(job, 'checksum', None), state)
+    except Exception:
+        log.exception('Could not hand off {0}'.format(label))
+        return False
+    log.info('Handed off {0} to be {1}'.format(
+        label, 'run again' if state is None else 'resumed'))
+    return True
+
+
+def _run(provider, job, compose_meta, key=None, token=None, series=None,
+         state=None):
+    """ Runs an upload job, or with `state`, resumes it, turning exceptions
+    into failures. Jobs cancelled before they start are skipped. Jobs
+    cancelled by a shutdown are handed off. """
+    try:
+        if token is not None and not token.start():
+            log.info('{0} was cancelled before it started: {1}'.format(
+                _label(provider, job), token.reason))
+            fedimg.trace.skip(key)
+            return 1
+        with fedimg.trace.job(key, _label(provider, job)):
+            try:
+                if state is not None:
+                    result = job.resume(state, compose_meta)
+                else:
+                    result = job.upload(compose_meta)
+            except fedimg.cancel.JobCancelled as e:
+                log.info('{0} was cancelled: {1}'.format(
+                    _label(provider, job), e))
+                result = 1
+            except Exception:
+                log.exception('{0} upload job failed'.format(provider))
+                return 1
+            if (result != 0 and token is not None and
+                    token.reason == fedimg.cancel.SHUTDOWN):
+                checkpoint = getattr(job, 'checkpoint', None)
+                _hand_off(token, checkpoint() if checkpoint else None)
+            return result
+    finally:
+        if series is not None:
+            _finished(series, token)
+        if token is not None:
+            _forget(token)
+
+
+def _jobs(urls, checksums=None):
+    """ Returns (provider, url, job) triples for every job of every enabled
+    provider for each of `urls`. Jobs with a `checksum` attribute are given
+    their image's checksum from `checksums`, a dict by URL. """
+    providers = fedimg.services.get_providers()
+    checksums = checksums or {}
+    jobs = []
 
     for url in urls:
-        # EC2 upload
         log.info("  Preparing to upload %r" % url)
-        for vt in virt_types_from_url(url):
-            services.append(EC2Service(url, virt_type=vt,
-                                       vol_type='standard'))
-            services.append(EC2Service(url, virt_type=vt,
-                                       vol_type='gp2'))
+        for name, provider in sorted(providers.items()):
+            try:
+                new = provider(url)
+            except Exception:
+                log.exception('{0} has no jobs for {1}'.format(name, url))
+                continue
+            for job in new:
+                if url in checksums and hasattr(job, 'checksum'):
+                    job.checksum = checksums[url]
+                jobs.append((name, url, job))
+
+    return jobs
+
+
+def _submit(name, url, job, compose_meta, key, state=None):
+    """ Queues `job` of the provider `name`, for the image at `url`, on the
+    provider's pool, to be resumed with `state` if it's given. Returns an
+    AsyncResult for it, or once the uploader is draining, hands the job off
+    and returns None. With a job queue, the job is put on it for a worker
+    to run instead, once the jobs it supersedes are taken off, and None is
+    returned too. """
+    queue = fedimg.jobqueue.get_queue()
+    if queue is not None:
+        if not _supersede_queued(queue, url):
+            log.info('Not queueing {0}: a newer build is queued'.format(
+                _label(name, job)))
+            return None
+        queue.put(name, url, _label(name, job), compose_meta,
+                  getattr(job, 'checksum', None), state)
+        return None
+
+    # Jobs with a `cancel` attribute check the token as they go
+    token = fedimg.cancel.Token()
+    if hasattr(job, 'cancel'):
+        job.cancel = token
+    with _running_cond:
+        _running[token] = (name, url, job, compose_meta)
+    if _draining.is_set():
+        token.cancel(fedimg.cancel.SHUTDOWN)
+        _hand_off(token, state)
+        fedimg.trace.skip(key)
+        return None
+    series = _supersede(url, token)
+    with fedimg.trace.tags(trace=key, job=_label(name, job)):
+        run = fedimg.trace.propagate(_run, queued='queued')
+    return get_pool(name).apply_async(
+        run, (name, job, compose_meta, key, token, series, state))
+
+
+def plan(urls, durations=None):
+    """ Returns the plan of what `upload` would do with `urls`, without
+    doing any of it (see fedimg.planner). """
+    jobs = [(name, _label(name, job), job)
+            for name, url, job in _jobs(urls)]
+    return fedimg.planner.plan_jobs(jobs, durations)
+
+
+def upload(urls, compose_meta, wait=True, checksums=None):
+    """ Takes a list (urls) of one or more .raw.xz image files and
+    sends them off to every enabled provider for registration. Each
+    provider's jobs run on its own pool. `checksums` has the SHA256 of
+    the images, by URL, where known. Jobs for older builds of the same
+    images may be cancelled (see `_supersede`). Returns a list of the jobs'
+    results, or with `wait=False`, of AsyncResults for them. Once the
+    uploader is draining, or there's a job queue for workers to take jobs
+    from, jobs are handed off rather than run, and left out of the
+    results. """
+
+    log.info('Starting upload process')
+
+    jobs = _jobs(urls, checksums)
+
+    # All the jobs for a compose make up one trace
+    key = fedimg.trace.trace_key(compose_meta)
+    tracer = fedimg.trace.get_tracer()
+    if (tracer is not None and jobs and not _draining.is_set() and
+            fedimg.jobqueue.get_queue() is None):
+        tracer.begin(key, len(jobs))
+    else:
+        # Jobs that aren't run here are no part of any trace
+        key = None
+
+    results = [_submit(name, url, job, compose_meta, key)
+               for name, url, job in jobs]
+    results = [r for r in results if r is not None]
+
+    if not wait:
+        return results
+    return [r.get() for r in results]
+
+
+def find_job(provider, url, label, checksum=None):
+    """ Returns the job named `label` (see `_label`) of `provider` for the
+    image at `url`, given the image's `checksum` if it takes one, or None if
+    there's no such job here. The jobs of an image picked up within
+    GROUP_TTL seconds of each other are made together. """
+    providers = fedimg.services.get_providers()
+    if provider not in providers:
+        log.warn('Cannot pick up {0}: {1} is not enabled'.format(
+            label, provider))
+        return None
+    now = time.time()
+    with _groups_lock:
+        for key, group in _groups.items():
+            if group['made'] < now - GROUP_TTL:
+                del _groups[key]
+        group = _groups.get((provider, url))
+        if group is None or label not in group['jobs']:
+            try:
+                jobs = providers[provider](url)
+            except Exception:
+                log.exception('{0} has no jobs for {1}'.format(provider,
+                                                               url))
+                return None
+            group = {'made': now, 'jobs': dict(
+                (_label(provider, job), job) for job in jobs)}
+            _groups[(provider, url)] = group
+        job = group['jobs'].pop(label, None)
+        if not group['jobs']:
+            del _groups[(provider, url)]
+    if job is None:
+        log.warn('Cannot pick up {0}: no such job'.format(label))
+        return None
+    if checksum and hasattr(job, 'checksum'):
+        job.checksum = checksum
+    return job
+
+
+def resume(checkpoints):
+    """ Picks up the jobs an earlier process handed off (see
+    fedimg.ledger): those with a state are resumed where they stopped, the
+    others run again from the start. Returns AsyncResults for them. """
+    tracer = fedimg.trace.get_tracer()
+    results = []
+
+    for checkpoint in checkpoints:
+        name = checkpoint['provider']
+        job = find_job(name, checkpoint['url'], checkpoint['label'],
+                       checkpoint['checksum'])
+        if job is None:
+            continue
+
+        key = fedimg.trace.trace_key(checkpoint['compose'])
+        if (tracer is not None and not _draining.is_set() and
+                fedimg.jobqueue.get_queue() is None):
+            tracer.begin(key)
+        else:
+            key = None
+        result = _submit(name, checkpoint['url'], job,
+                         checkpoint['compose'], key,
+                         state=checkpoint['state'])
+        if result is not None:
+            results.append(result)
+
+    return results
+
+
+def drain(grace=None):
+    """ Stops taking jobs, and hands off those still queued to the next
+    process. Running jobs get `grace` seconds (by default, the
+    `shutdown_grace` option) to finish; the rest are cancelled, clean up
+    after themselves and are handed off too, to be resumed where possible.
+    Jobs still cleaning up after another `grace` seconds are handed off as
+    they are; the ledger accounts for what they leave running. """
+    if grace is None:
+        grace = fedimg.SHUTDOWN_GRACE
+    _draining.set()
+
+    with _running_cond:
+        tokens = list(_running)
+    for token in tokens:
+        if token.cancel(fedimg.cancel.SHUTDOWN, pending_only=True):
+            _hand_off(token)
+        elif not token.started:
+            # Superseded before it started; there's nothing to hand off
+            _forget(token)
+
+    if not _wait_running(grace):
+        with _running_cond:
+            tokens = list(_running)
+        log.info('Cancelling {0} upload jobs still running'.format(
+            len(tokens)))
+        for token in tokens:
+            token.cancel(fedimg.cancel.SHUTDOWN)
+        if not _wait_running(grace):
+            with _running_cond:
+                tokens = list(_running)
+            for token in tokens:
+                _hand_off(token)
+
+    # Workers still stuck in a job are left to the process exiting
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
 
-    results = pool.map(lambda s: s.upload(compose_meta), services)
+def _wait_running(timeout):
+    """ Waits up to `timeout` seconds for the running jobs to finish or be
+    handed off. Returns True if they all did. """
+    deadline = time.time() + timeout
+    with _running_cond:
+        while _running:
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            _running_cond.wait(left)
+        return True
@@ -24,7 +24,9 @@
 Utility functions for fedimg.
 """
 
+import fnmatch
 import functools
+import re
 import socket
 import subprocess
 
@@ -34,6 +36,11 @@ from libcloud.compute.providers import get_driver
 
 import fedimg
 
+try:
+    import koji
+except ImportError:
+    koji = None
+
 
 def get_file_arch(file_name):
     """ Takes a file name (probably of a .raw.xz image file) and returns
@@ -58,6 +65,63 @@ def get_rawxz_urls(location, images):
     return map((lambda path: '{}/{}'.format(location, path)), rawxz_list)
 
 
+def compose_id_from_image(file_name):
+    """ Takes an image file name (ex.
+    Fedora-Cloud-Base-25-20170101.n.0.x86_64.raw.xz) and returns the ID of
+    the compose it was built for (ex. Fedora-25-20170101.n.0), or None. """
+    match = re.search(r'-(\d+|Rawhide)-(\d{8}(?:\.[a-z]+)?\.\d+)\.[^.]+\.raw',
+                      file_name)
+    if match is None:
+        return None
+    return 'Fedora-{0}-{1}'.format(*match.groups())
+
+
+def build_series(build_name):
+    """ Takes a build name (ex. Fedora-Cloud-Base-25-20170101.n.0.x86_64)
+    and returns the prefix and suffix that every build of the same image
+    for the same release and arch shares (ex. "Fedora-Cloud-Base-25-" and
+    ".x86_64"), or None. """
+    match = re.match(r'^(.+-(?:\d+|Rawhide)-)[^-]+(\.[^.]+)$', build_name)
+    if match is None:
+        return None
+    return match.groups()
+
+
+def build_key(build_name):
+    """ Takes a build name (ex. Fedora-Cloud-Base-25-20170101.n.1.x86_64)
+    and returns a tuple of the numbers that identify it in its series (ex.
+    (20170101, 1)), which orders the builds of a series by date and respin,
+    or None. """
+    series = build_series(build_name)
+    if series is None:
+        return None
+    prefix, suffix = series
+    build_id = build_name[len(prefix):len(build_name) - len(suffix)]
+    return tuple(int(n) for n in re.findall(r'\d+', build_id))
+
+
+def early_image(file_name):
+    """ Returns True if `file_name` matches one of the patterns of images
+    that are uploaded as soon as they are built. """
+    return any(fnmatch.fnmatch(file_name, pattern)
+               for pattern in fedimg.EARLY_INTAKE_PATTERNS)
+
+
+def get_task_images(task_id):
+    """ Returns a dict mapping the URLs of the .raw.xz files a Koji task
+    produced to their sizes. """
+    if koji is None:
+        raise ValueError('The koji package is needed for early intake; it '
+                         'is installed with fedimg[early_intake]')
+    session = koji.ClientSession(fedimg.KOJI_SERVER)
+    output = session.listTaskOutput(task_id, stat=True)
+    base = '{0}/{1}/{2}'.format(fedimg.BASE_KOJI_TASK_URL.rstrip('/'),
+                                task_id % 10000, task_id)
+    return dict(('{0}/{1}'.format(base, name), int(info['st_size']))
+                for name, info in output.items()
+                if name.endswith('.raw.xz'))
+
+
 def virt_types_from_url(url):
     """ Takes a URL to a .raw.xz image file) and returns the suspected
         virtualization type that the image file should be registered as. """
@@ -70,6 +134,46 @@ def virt_types_from_url(url):
         return ['hvm', 'paravirtual']
 
 
+def get_aws_amis():
+    """ Returns a list of dicts describing the utility AMIs listed in the
+    `amis` option of the fedimg config, along with a libcloud driver for
+    their region. """
+    amis = []
+    for line in fedimg.AWS_AMIS.split('\n'):
+        """ AWS_AMIS lines have pipe-delimited attrs at these indicies:
+        0: region (ex. eu-west-1)
+        1: OS (ex. RHEL)
+        2: version (ex. 5.7)
+        3: arch (ex. x86_64)
+        4: ami name (ex. ami-68e3d32d) """
+
+        # strip line to avoid any newlines or spaces from sneaking in
+        attrs = line.strip().split('|')
+
+        # old configuration
+        if len(attrs)==6:
+
+            info = {'region': attrs[0],
+                    'driver': region_to_driver(attrs[0]),
+                    'os': attrs[1],
+                    'ver': attrs[2],
+                    'arch': attrs[3],
+                    'ami': attrs[4],
+                    'aki': attrs[5]}
+
+        # new configuration
+        elif len(attrs)==4:
+
+            info = {'region': attrs[0],
+                    'driver': region_to_driver(attrs[0]),
+                    'arch': attrs[1],
+                    'ami': attrs[2],
+                    'aki': attrs[3]}
+
+        amis.append(info)
+    return amis
+
+
 def region_to_driver(region):
     """ Takes a region name (ex. 'eu-west-1') and returns
     the appropriate libcloud provider value. """
@@ -39,12 +39,26 @@ setup(
     zip_safe=False,
     install_requires=["fedmsg",
                       "apache-libcloud",
-                      "paramiko"],
+                      "paramiko",
+                      # 3.x no longer imports on Python 2
+                      "ijson<3",
+                      "requests"],
+    extras_require={
+        # Only needed to look up the images of Koji tasks
+        'early_intake': ['koji'],
+    },
     tests_require=['nose',
                    'mock'],
     packages=find_packages(),
     entry_points="""
     [moksha.consumer]
     fedimgconsumer = fedimg.consumers:FedimgConsumer
+
+    [fedimg.services]
+    ec2 = fedimg.services.ec2:jobs
+    ftp = fedimg.services.ftp:jobs
+    gce = fedimg.services.gce:jobs
+    hp = fedimg.services.hp:jobs
+    rackspace = fedimg.services.rackspace:jobs
     """,
 )
@@ -0,0 +1,91 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import fedimg.benchmark
+
+
+def run(region, size, block_size, mbps, cost):
+    return {'region': region, 'size': size, 'block_size': block_size,
+            'seconds': 60.0, 'bytes': 1, 'mbps': mbps, 'cost': cost,
+            'time': 0}
+
+
+class TestBenchmark(unittest.TestCase):
+    """ This tests fedimg/benchmark.py. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'benchmarks.json')
+        self.results = [
+            run('us-east-1', 'm1.xlarge', '1M', 40.0, 0.010),
+            run('us-east-1', 'm1.xlarge', '1M', 60.0, 0.006),
+            run('us-east-1', 'c4.xlarge', '4M', 90.0, 0.007),
+            run('us-east-1', 'm4.xlarge', '4M', 70.0, 0.005),
+            run('eu-west-1', 'm1.xlarge', '1M', 200.0, 0.001),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_result(self):
+        size = mock.Mock(id='m4.xlarge', price=0.36)
+        output = '4294967296 bytes (4.3 GB) copied, 64 s, 67.1 MB/s'
+        r = fedimg.benchmark.result('us-east-1', size, '4M', 64.0, output)
+        self.assertEqual(r['bytes'], 4294967296)
+        self.assertAlmostEqual(r['mbps'], 64.0)
+        self.assertAlmostEqual(r['cost'], 0.0064)
+
+    def test_result_after_progress(self):
+        size = mock.Mock(id='m4.xlarge', price=None)
+        output = ('100 2048 bytes received\r\n'
+                  '4294967296 bytes (4.3 GB) copied, 64 s, 67.1 MB/s\r\n')
+        r = fedimg.benchmark.result('us-east-1', size, '4M', 64.0, output)
+        self.assertEqual(r['bytes'], 4294967296)
+
+    def test_summarize(self):
+        summary = fedimg.benchmark.summarize(self.results, 'us-east-1')
+        self.assertEqual(len(summary), 3)
+        self.assertAlmostEqual(summary[('m1.xlarge', '1M')]['mbps'], 50.0)
+        self.assertAlmostEqual(summary[('m1.xlarge', '1M')]['cost'], 0.008)
+
+    def test_best_util_size(self):
+        best = fedimg.benchmark.best_util_size
+        self.assertEqual(best('us-east-1', self.results, 'speed'),
+                         ('c4.xlarge', '4M'))
+        self.assertEqual(best('us-east-1', self.results, 'cost'),
+                         ('m4.xlarge', '4M'))
+        self.assertEqual(best('sa-east-1', self.results, 'speed'),
+                         (None, None))
+
+    def test_record_results(self):
+        fedimg.benchmark.record_results(self.results[:2], self.path)
+        fedimg.benchmark.record_results(self.results[2:], self.path)
+        self.assertEqual(fedimg.benchmark.load_results(self.path),
+                         self.results)
+
+if __name__ == '__main__':
+    unittest.main()
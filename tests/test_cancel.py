@@ -0,0 +1,187 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import threading
+import time
+import unittest
+
+import mock
+
+import fedimg.cancel
+import fedimg.services.ec2
+import fedimg.uploader
+
+RAWHIDE = 'https://x/Fedora-Cloud-Base-Rawhide-{0}.n.0.x86_64.raw.xz'
+
+
+class TestToken(unittest.TestCase):
+    """ This tests fedimg/cancel.py. """
+
+    def test_cancel(self):
+        token = fedimg.cancel.Token()
+        token.check()
+        self.assertTrue(token.cancel('superseded'))
+        self.assertFalse(token.cancel('again'))
+        self.assertRaises(fedimg.cancel.JobCancelled, token.check)
+        self.assertFalse(token.start())
+        self.assertEqual(token.reason, 'superseded')
+
+    def test_pending_only(self):
+        token = fedimg.cancel.Token()
+        self.assertTrue(token.start())
+        self.assertFalse(token.cancel('superseded', pending_only=True))
+        self.assertFalse(token.cancelled)
+
+    def test_sleep(self):
+        token = fedimg.cancel.Token()
+        threading.Timer(0.05, token.cancel, ('superseded',)).start()
+        started = time.time()
+        self.assertRaises(fedimg.cancel.JobCancelled, token.sleep, 30)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_hook(self):
+        token = fedimg.cancel.Token()
+        callback = mock.Mock()
+        with token.hook(callback):
+            token.cancel('superseded')
+        self.assertEqual(callback.call_count, 1)
+        # Hooks run right away if the job is already cancelled
+        with token.hook(callback):
+            pass
+        self.assertEqual(callback.call_count, 2)
+        self.assertEqual(token.hooks, [])
+
+
+class SlowJob(object):
+
+    def __init__(self, url, gate):
+        self.url = url
+        self.gate = gate
+        self.cancel = None
+        self.ran = False
+
+    def upload(self, compose_meta):
+        self.ran = True
+        while not self.gate.is_set():
+            self.cancel.sleep(0.01)
+        return 0
+
+
+class TestSupersede(unittest.TestCase):
+    """ This tests how the uploader cancels superseded jobs. """
+
+    def setUp(self):
+        self.gate = threading.Event()
+        self.jobs = []
+
+        def provider(url):
+            job = SlowJob(url, self.gate)
+            self.jobs.append(job)
+            return [job]
+
+        patchers = [
+            mock.patch('fedimg.services.get_providers',
+                       return_value={'slow': provider}),
+            mock.patch('fedimg.PROVIDER_CONCURRENCY', {'slow': 1}),
+            mock.patch('fedimg.uploader._pools', {}),
+            mock.patch('fedimg.uploader._in_flight', {}),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.gate.set)
+
+    def upload(self, *builds):
+        return fedimg.uploader.upload([RAWHIDE.format(b) for b in builds],
+                                      None, wait=False)
+
+    def wait_for_start(self):
+        while not self.jobs[0].ran:
+            time.sleep(0.01)
+
+    @mock.patch('fedimg.SUPERSEDE', 'cancel')
+    def test_cancel(self):
+        old = self.upload('20170601', '20170601')
+        self.wait_for_start()
+        new = self.upload('20170602')
+        self.gate.set()
+        self.assertEqual([r.get(5) for r in old + new], [1, 1, 0])
+        # The second old job never started
+        self.assertFalse(self.jobs[1].ran)
+        self.assertEqual(fedimg.uploader._in_flight, {})
+
+    @mock.patch('fedimg.SUPERSEDE', 'cancel')
+    def test_out_of_order(self):
+        """ An older build coming in late cancels nothing, and doesn't run
+        itself. """
+        new = self.upload('20170602')
+        self.wait_for_start()
+        old = self.upload('20170601')
+        self.gate.set()
+        self.assertEqual([r.get(5) for r in new + old], [0, 1])
+        self.assertFalse(self.jobs[1].ran)
+        self.assertEqual(fedimg.uploader._in_flight, {})
+
+    @mock.patch('fedimg.SUPERSEDE', 'cancel')
+    def test_respin(self):
+        old = self.upload('20170601')
+        self.wait_for_start()
+        results = fedimg.uploader.upload(
+            [RAWHIDE.format('20170601').replace('.n.0.', '.n.1.'),
+             RAWHIDE.format('20170601')], None, wait=False)
+        self.gate.set()
+        # Only the respin survives; its build of the same day is no newer
+        self.assertEqual([r.get(5) for r in old + results], [1, 0, 1])
+
+    @mock.patch('fedimg.SUPERSEDE', 'queued')
+    def test_queued(self):
+        old = self.upload('20170601', '20170601')
+        self.wait_for_start()
+        new = self.upload('20170602')
+        self.gate.set()
+        self.assertEqual([r.get(5) for r in old + new], [0, 1, 0])
+
+    @mock.patch('fedimg.SUPERSEDE', 'none')
+    def test_none(self):
+        results = self.upload('20170601', '20170602')
+        self.gate.set()
+        self.assertEqual([r.get(5) for r in results], [0, 0])
+
+
+class TestEC2Cancel(unittest.TestCase):
+    """ This tests how EC2Service stops when its job is cancelled. """
+
+    def test_wait_for_image(self):
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=[]):
+            service = fedimg.services.ec2.EC2Service(
+                RAWHIDE.format('20170601'), tester=mock.Mock(),
+                quota=mock.Mock())
+        driver = mock.Mock()
+        driver.get_image.return_value.extra = {'state': 'pending'}
+        threading.Timer(0.05, service.cancel.cancel, ('superseded',)).start()
+        self.assertRaises(fedimg.cancel.JobCancelled,
+                          service._wait_for_image, driver, mock.Mock())
+
+
+if __name__ == '__main__':
+    unittest.main()
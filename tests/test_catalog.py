@@ -0,0 +1,135 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import mock
+import tempfile
+import unittest
+
+import fedimg.catalog
+import fedimg.messenger
+
+
+class TestCatalog(unittest.TestCase):
+    """ This tests fedimg/catalog.py. """
+
+    def setUp(self):
+        self.catalog = fedimg.catalog.Catalog(':memory:')
+        add = self.catalog.add
+        add('ami-1', 'Fedora-Cloud-Base-25-20170101.0.x86_64', 'eu-west-1',
+            'hvm', 'gp2', 'Fedora-25-20170101.0', created=1)
+        add('ami-2', 'Fedora-Cloud-Base-25-20170102.0.x86_64', 'eu-west-1',
+            'hvm', 'gp2', 'Fedora-25-20170102.0', created=2)
+        add('ami-3', 'Fedora-Cloud-Base-25-20170102.0.x86_64', 'eu-west-1',
+            'hvm', 'standard', 'Fedora-25-20170102.0', created=3)
+        add('ami-4', 'Fedora-Cloud-Base-25-20170102.0.x86_64', 'us-east-1',
+            'hvm', 'gp2', 'Fedora-25-20170102.0', created=4)
+
+    def test_region_from_destination(self):
+        region = fedimg.catalog.region_from_destination('EC2 (eu-west-1)')
+        self.assertEqual(region, 'eu-west-1')
+
+    def test_find(self):
+        amis = self.catalog.find(compose_id='Fedora-25-20170102.0')
+        self.assertEqual([a['id'] for a in amis], ['ami-4', 'ami-3', 'ami-2'])
+        amis = self.catalog.find(region='eu-west-1', vol_type='gp2')
+        self.assertEqual([a['id'] for a in amis], ['ami-2', 'ami-1'])
+
+    def test_latest(self):
+        ami = self.catalog.latest('Fedora-Cloud-Base-25', 'eu-west-1',
+                                  'hvm', 'gp2')
+        self.assertEqual(ami['id'], 'ami-2')
+        self.assertEqual(ami['build'],
+                         'Fedora-Cloud-Base-25-20170102.0.x86_64')
+        ami = self.catalog.latest('Fedora-Cloud-Atomic-25', 'eu-west-1',
+                                  'hvm', 'gp2')
+        self.assertEqual(ami, None)
+
+    def test_latest_suffix(self):
+        self.catalog.add('ami-i386', 'Fedora-Cloud-Base-25-1.9.i386',
+                         'eu-west-1', 'hvm', 'gp2', created=5)
+        ami = self.catalog.latest('Fedora-Cloud-Base-25-', 'eu-west-1',
+                                  None, None, suffix='.x86_64')
+        self.assertEqual(ami['id'], 'ami-3')
+
+    @mock.patch('fedimg.catalog.get_catalog')
+    def test_record(self, get_catalog):
+        get_catalog.return_value = self.catalog
+        fedimg.catalog.record(
+            'https://x/Fedora-Cloud-Base-26-1.1.x86_64.raw.xz',
+            'EC2 (ap-south-1)', {'compose_id': 'Fedora-26-20170601.0'},
+            {'id': 'ami-5', 'virt_type': 'paravirtual',
+             'vol_type': 'standard'})
+        ami = self.catalog.find(region='ap-south-1')[0]
+        self.assertEqual(ami['build'], 'Fedora-Cloud-Base-26-1.1.x86_64')
+        self.assertEqual(ami['compose_id'], 'Fedora-26-20170601.0')
+
+    @mock.patch('fedimg.catalog.get_catalog')
+    def test_record_errors(self, get_catalog):
+        """ Nothing about recording an upload raises. """
+        fedimg.catalog.record('https://x/y.raw.xz', 'EC2 (eu-west-1)', None,
+                              None)
+        get_catalog.side_effect = IOError('No such directory')
+        fedimg.catalog.record('https://x/y.raw.xz', 'EC2 (eu-west-1)', None,
+                              {'id': 'ami-5'})
+
+    @mock.patch('fedimg.catalog._catalog', None)
+    def test_unusable(self):
+        """ A catalog that can't be opened is as good as none. """
+        with tempfile.NamedTemporaryFile() as f:
+            with mock.patch('fedimg.CATALOG', f.name + '/sub/catalog.db'):
+                self.assertIsNone(fedimg.catalog.get_catalog())
+
+    @mock.patch('fedimg.catalog.record')
+    @mock.patch('fedimg.messenger.fedmsg.publish')
+    def test_message_unrecorded(self, publish, record):
+        """ A completed upload sent with record=False, like an AMI that is
+        yet to be tested, stays out of the catalog. """
+        fedimg.messenger.message('image.upload', 'https://x/y.raw.xz',
+                                 'EC2 (eu-west-1)', 'completed', None,
+                                 extra={'id': 'ami-5'}, record=False)
+        self.assertTrue(publish.called)
+        self.assertFalse(record.called)
+        fedimg.messenger.message('image.upload', 'https://x/y.raw.xz',
+                                 'EC2 (eu-west-1)', 'completed', None,
+                                 extra={'id': 'ami-5'})
+        self.assertTrue(record.called)
+
+    def test_checksums(self):
+        add = self.catalog.add_checksum
+        add('abc', 'eu-west-1', 'hvm', 'gp2', 'ami-1', 'snap-1')
+        add('abc', 'eu-west-1', 'hvm', 'standard', 'ami-2', 'snap-1')
+        add('abc', 'us-east-1', 'hvm', 'gp2', 'ami-3')
+        # A later upload of the same variant replaces the earlier one
+        add('abc', 'eu-west-1', 'hvm', 'gp2', 'ami-4', 'snap-2')
+
+        rows = self.catalog.find_checksum('abc', vol_type='gp2')
+        self.assertEqual(sorted((r['region'], r['ami_id'], r['snapshot_id'])
+                                for r in rows),
+                         [('eu-west-1', 'ami-4', 'snap-2'),
+                          ('us-east-1', 'ami-3', None)])
+        self.assertEqual(self.catalog.find_checksum('def'), [])
+
+        self.catalog.forget_checksum('abc', 'eu-west-1')
+        self.assertEqual([r['region'] for r in
+                          self.catalog.find_checksum('abc')], ['us-east-1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import io
+import json
+import unittest
+
+import mock
+
+import fedimg.compose
+
+
+def image(path, **kwargs):
+    entry = {'path': path, 'size': 1024, 'checksums': {'sha256': 'abc'},
+             'format': path.split('.', 1)[1] if '.' in path else ''}
+    entry.update(kwargs)
+    return entry
+
+
+MANIFEST = {
+    'header': {'version': '1.0'},
+    'payload': {
+        'compose': {'id': 'Fedora-26-20170601.n.0'},
+        'images': {
+            'CloudImages': {
+                'x86_64': [
+                    image('CloudImages/x86_64/images/Base.x86_64.raw.xz'),
+                    image('CloudImages/x86_64/images/Base.x86_64.qcow2'),
+                ],
+                'i386': [
+                    image('CloudImages/i386/images/Base.i386.raw.xz'),
+                ],
+            },
+            'Workstation': {
+                'x86_64': [
+                    image('Workstation/x86_64/iso/Workstation.x86_64.iso'),
+                ],
+            },
+        },
+    },
+}
+
+
+class TestCompose(unittest.TestCase):
+    """ This tests fedimg/compose.py. """
+
+    def manifest(self):
+        return io.BytesIO(json.dumps(MANIFEST).encode('utf-8'))
+
+    def paths(self, images):
+        return sorted(i['path'] for v, a, i in images)
+
+    def test_parse_subsets(self):
+        self.assertEqual(
+            fedimg.compose.parse_subsets('CloudImages/x86_64 Cloud'),
+            [('CloudImages', 'x86_64'), ('Cloud', '*')])
+
+    def test_images_url(self):
+        self.assertEqual(
+            fedimg.compose.images_url('https://kojipkgs/compose/F26/'),
+            'https://kojipkgs/compose/F26/metadata/images.json')
+
+    def test_iter_images(self):
+        images = fedimg.compose.iter_images(
+            self.manifest(), [('CloudImages', 'x86_64')], ['raw.xz'])
+        self.assertEqual(self.paths(images), [
+            'CloudImages/x86_64/images/Base.x86_64.raw.xz'])
+
+    def test_iter_images_every_arch(self):
+        images = list(fedimg.compose.iter_images(
+            self.manifest(), [('CloudImages', '*')], ['raw.xz', 'qcow2']))
+        self.assertEqual(self.paths(images), [
+            'CloudImages/i386/images/Base.i386.raw.xz',
+            'CloudImages/x86_64/images/Base.x86_64.qcow2',
+            'CloudImages/x86_64/images/Base.x86_64.raw.xz'])
+        # Whole entries come through, nested parts included
+        self.assertEqual(images[0][2]['checksums'], {'sha256': 'abc'})
+
+    def test_stream_matches_loaded(self):
+        subsets = [('CloudImages', '*'), ('Workstation', 'x86_64')]
+        streamed = fedimg.compose._iter_stream(self.manifest(), subsets)
+        loaded = fedimg.compose._iter_loaded(self.manifest(), subsets)
+        self.assertEqual(sorted(streamed), sorted(loaded))
+
+    @mock.patch('fedimg.compose.requests.get')
+    def test_get_images(self, get):
+        get.return_value.raw = self.manifest()
+        with mock.patch('fedimg.COMPOSE_IMAGES', 'CloudImages/x86_64'), \
+                mock.patch('fedimg.COMPOSE_FORMATS', ['raw.xz']):
+            images = fedimg.compose.get_images('https://kojipkgs/F26')
+        get.assert_called_with('https://kojipkgs/F26/metadata/images.json',
+                               stream=True)
+        self.assertEqual([i['path'] for i in images], [
+            'CloudImages/x86_64/images/Base.x86_64.raw.xz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -102,3 +102,111 @@ class TestKojiConsumer(unittest.TestCase):
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestFedimgConsumer(unittest.TestCase):
+    """ Images uploaded early, from their createImage task, should be left
+    out of their compose's uploads unless they changed since. """
+
+    location = 'https://kojipkgs.fedoraproject.org/compose/Fedora-25-1/compose'
+    file_name = 'Fedora-Cloud-Base-25-20170101.n.0.x86_64.raw.xz'
+    task_url = 'https://kojipkgs.fedoraproject.org/work/tasks/1/1/' + file_name
+
+    def setUp(self):
+        class FakeHub(object):
+            config = {'fedimgconsumer': True, 'validate_signatures': False}
+
+            def subscribe(*args, **kwargs):
+                pass
+
+        patchers = [
+            mock.patch('fedimg.EARLY_INTAKE', True),
+            mock.patch('fedimg.EARLY_INTAKE_PATTERNS', ['Fedora-Cloud-*']),
+            mock.patch('fedimg.EARLY_INTAKE_MAX_AGE', 3600),
+            mock.patch('fedimg.util.koji'),
+            mock.patch('fedimg.AWS_REAP_INTERVAL', 0),
+            mock.patch('fedimg.profiler.install'),
+            mock.patch('fedimg.ledger.recover'),
+            mock.patch('fedimg.uploader.upload'),
+            mock.patch('fedimg.consumers.get_task_images',
+                       return_value={self.task_url: 1000}),
+            mock.patch('fedimg.compose.get_images'),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        self.upload = fedimg.uploader.upload
+        self.get_images = fedimg.compose.get_images
+
+        fedimg.consumers.FedimgConsumer._initialized = True  # a lie
+        self.consumer = fedimg.consumers.FedimgConsumer(FakeHub())
+
+    def _task(self):
+        self.consumer.consume_task({'method': 'createImage', 'id': 1,
+                                    'new': fedimg.consumers.TASK_CLOSED})
+
+    def _compose(self, status='FINISHED', size=1000):
+        self.get_images.return_value = [{
+            'path': 'CloudImages/x86_64/images/' + self.file_name,
+            'size': size,
+            'checksums': {'sha256': 'abc'}}]
+        self.consumer.consume_compose({'compose_id': 'Fedora-25-20170101.n.0',
+                                       'status': status,
+                                       'location': self.location})
+
+    def _uploaded(self):
+        return [c[0][0] for c in self.upload.call_args_list]
+
+    def test_duplicate_task(self):
+        """ The same task showing up twice uploads its image once. """
+        self._task()
+        self._task()
+        self.assertEqual(self._uploaded(), [[self.task_url]])
+        self.upload.assert_called_with(
+            [self.task_url], {'compose_id': 'Fedora-25-20170101.n.0'},
+            wait=False)
+
+    def test_reconciled(self):
+        self._task()
+        self._compose()
+        self.assertEqual(self._uploaded(), [[self.task_url]])
+        self.assertEqual(self.consumer.early_images, {})
+
+    def test_size_mismatch(self):
+        """ An image that changed since it was uploaded early is uploaded
+        again from the compose. """
+        self._task()
+        self._compose(size=2000)
+        compose_url = '{0}/CloudImages/x86_64/images/{1}'.format(
+            self.location, self.file_name)
+        self.assertEqual(self._uploaded(), [[self.task_url], [compose_url]])
+        self.assertEqual(self.consumer.early_images, {})
+
+    def test_failed_compose(self):
+        """ A failed compose uploads nothing, and forgets its images'
+        early uploads so that the next compose's aren't skipped. """
+        self._task()
+        self._compose(status='DOOMED')
+        self.assertEqual(self._uploaded(), [[self.task_url]])
+        self.assertFalse(self.get_images.called)
+        self.assertEqual(self.consumer.early_images, {})
+
+    def test_early_topic(self):
+        self.assertIn(fedimg.consumers.TASK_TOPIC, self.consumer.topic)
+
+    @mock.patch('fedimg.util.koji', None)
+    def test_no_koji(self):
+        """ Without koji, images wait for their compose. """
+        consumer = fedimg.consumers.FedimgConsumer(self.consumer.hub)
+        self.assertNotIn(fedimg.consumers.TASK_TOPIC, consumer.topic)
+        self.assertRaises(ValueError, fedimg.util.get_task_images, 1)
+
+    @mock.patch('fedimg.consumers.time.time')
+    def test_expired(self, now):
+        """ An early upload no compose shipped in time is forgotten. """
+        now.return_value = 0
+        self._task()
+        now.return_value = 3601
+        self._task()
+        self.assertEqual(self._uploaded(), [[self.task_url]] * 2)
+        self.assertEqual(list(self.consumer.early_images), [self.file_name])
@@ -0,0 +1,189 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+import fedimg.convert
+
+
+def read_qcow2(f):
+    """ Returns the guest contents of a qcow2 image, checking the refcounts
+    along the way. """
+    f.seek(0)
+    (magic, version, _, _, cluster_bits, size, _, l1_size, l1_offset,
+     rt_offset, rt_clusters, _, _) = struct.unpack('>4sIQIIQIIQQIIQ',
+                                                   f.read(72))
+    assert magic == b'QFI\xfb' and version == 2
+    cs = 1 << cluster_bits
+    shift = 62 - (cluster_bits - 8)
+    refcounts = {0: 1}
+
+    def ref(offset, length):
+        for c in range(offset // cs, (offset + length - 1) // cs + 1):
+            refcounts[c] = refcounts.get(c, 0) + 1
+
+    f.seek(l1_offset)
+    l1 = struct.unpack('>{0}Q'.format(l1_size), f.read(8 * l1_size))
+    ref(l1_offset, 8 * l1_size)
+    data = bytearray()
+    for l2_entry in l1:
+        l2_offset = l2_entry & ((1 << 62) - 1)
+        if not l2_offset:
+            data += b'\0' * (cs * cs // 8)
+            continue
+        ref(l2_offset, cs)
+        f.seek(l2_offset)
+        for entry in struct.unpack('>{0}Q'.format(cs // 8), f.read(cs)):
+            if not entry:
+                data += b'\0' * cs
+            elif entry & (1 << 62):
+                offset = entry & ((1 << shift) - 1)
+                sectors = (entry >> shift) & ((1 << (cluster_bits - 8)) - 1)
+                length = (sectors + 1) * 512 - (offset & 511)
+                ref(offset, length)
+                f.seek(offset)
+                decompressor = zlib.decompressobj(-12)
+                data += decompressor.decompress(f.read(length))[:cs]
+            else:
+                offset = entry & ((1 << 62) - 1)
+                ref(offset, cs)
+                f.seek(offset)
+                data += f.read(cs)
+            f.seek(l2_offset + len(data) % (cs * cs // 8) // cs * 8)
+
+    f.seek(rt_offset)
+    table = struct.unpack('>{0}Q'.format(rt_clusters * cs // 8),
+                          f.read(rt_clusters * cs))
+    ref(rt_offset, rt_clusters * cs)
+    stored = {}
+    for b, block_offset in enumerate(table):
+        if not block_offset:
+            continue
+        ref(block_offset, cs)
+        f.seek(block_offset)
+        counts = struct.unpack('>{0}H'.format(cs // 2), f.read(cs))
+        for i, count in enumerate(counts):
+            if count:
+                stored[b * cs // 2 + i] = count
+    assert stored == refcounts, (stored, refcounts)
+    return bytes(data[:size])
+
+
+def read_vhd(f):
+    """ Returns the contents of a fixed VHD, checking its footer. """
+    f.seek(-512, 2)
+    footer = bytearray(f.read(512))
+    assert footer[:8] == b'conectix'
+    checksum = struct.unpack('>I', bytes(footer[64:68]))[0]
+    footer[64:68] = b'\0' * 4
+    assert checksum == ~sum(footer) & 0xffffffff
+    size = struct.unpack('>Q', bytes(footer[48:56]))[0]
+    assert os.fstat(f.fileno()).st_size == size + 512
+    f.seek(0)
+    return f.read(size)
+
+
+def read_vmdk(f):
+    """ Returns the contents of a streamOptimized VMDK. """
+    f.seek(0)
+    header = f.read(512)
+    assert header[:4] == b'KDMV'
+    f.seek(-1024, 2)
+    footer = f.read(512)
+    capacity, grain = struct.unpack('<QQ', footer[12:28])
+    gtes, = struct.unpack('<I', footer[44:48])
+    gd_offset, = struct.unpack('<Q', footer[56:64])
+    grains = -(-capacity // grain)
+    tables = -(-grains // gtes)
+
+    f.seek(gd_offset * 512)
+    directory = struct.unpack('<{0}I'.format(tables), f.read(4 * tables))
+    data = bytearray()
+    for gt_offset in directory:
+        f.seek(gt_offset * 512)
+        for sector in struct.unpack('<{0}I'.format(gtes), f.read(4 * gtes)):
+            if len(data) >= capacity * 512:
+                break
+            if not sector:
+                data += b'\0' * grain * 512
+                continue
+            here = f.tell()
+            f.seek(sector * 512)
+            lba, length = struct.unpack('<QI', f.read(12))
+            assert lba * 512 == len(data)
+            data += zlib.decompress(f.read(length))
+            f.seek(here)
+    return bytes(data[:capacity * 512])
+
+
+class TestConvert(unittest.TestCase):
+    """ This tests fedimg/convert.py. """
+
+    def setUp(self):
+        # Data, compressible data, and runs of zeros, with a short last block
+        self.raw = (os.urandom(200000) + b'\0' * 1000000 +
+                    b'fedora' * 100000 + b'\0' * 300000 + os.urandom(12345))
+        self.files = {}
+        for fmt in ('qcow2', 'vhd', 'vmdk'):
+            self.files[fmt] = tempfile.TemporaryFile()
+            self.addCleanup(self.files[fmt].close)
+
+    def _chunks(self):
+        return (self.raw[i:i + 100000]
+                for i in range(0, len(self.raw), 100000))
+
+    def test_convert(self):
+        writers = [fedimg.convert.Qcow2Writer(self.files['qcow2'],
+                                              compress=True),
+                   fedimg.convert.VHDWriter(self.files['vhd']),
+                   fedimg.convert.VMDKWriter(self.files['vmdk'])]
+        size = fedimg.convert.convert(self._chunks(), writers, threads=4)
+
+        self.assertEqual(size, len(self.raw))
+        self.assertEqual(read_qcow2(self.files['qcow2']), self.raw)
+        # VMDK sizes are in whole sectors
+        self.assertEqual(read_vmdk(self.files['vmdk']),
+                         self.raw + b'\0' * (-len(self.raw) % 512))
+        padded = self.raw + b'\0' * (-len(self.raw) % (1024 * 1024))
+        self.assertEqual(read_vhd(self.files['vhd']), padded)
+
+        # Zeros take no space, and compressible data takes less
+        qcow2_size = os.fstat(self.files['qcow2'].fileno()).st_size
+        self.assertLess(qcow2_size, 200000 + 12345 + 7 * 65536)
+
+    def test_uncompressed_qcow2(self):
+        writer = fedimg.convert.Qcow2Writer(self.files['qcow2'])
+        fedimg.convert.convert(self._chunks(), [writer])
+        self.assertEqual(read_qcow2(self.files['qcow2']), self.raw)
+
+    def test_chs(self):
+        self.assertEqual(fedimg.convert._chs(127 * 1024 ** 3),
+                         (65278, 16, 255))
+        self.assertEqual(fedimg.convert._chs(3 * 1024 ** 3),
+                         (6241, 16, 63))
+
+
+if __name__ == '__main__':
+    unittest.main()
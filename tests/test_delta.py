@@ -0,0 +1,86 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import io
+import os
+import tempfile
+import unittest
+
+import fedimg.delta
+
+
+class TestDelta(unittest.TestCase):
+    """ This tests fedimg/delta.py. """
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_parse_size(self):
+        self.assertEqual(fedimg.delta.parse_size('4M'), 4 * 1024 * 1024)
+        self.assertEqual(fedimg.delta.parse_size('512k'), 512 * 1024)
+        self.assertEqual(fedimg.delta.parse_size('4096'), 4096)
+
+    def test_write_delta(self):
+        old = b'a' * 4 + b'b' * 4 + b'c' * 4 + b'd' * 2
+        new = b'a' * 4 + b'X' * 4 + b'c' * 4 + b'dY'
+        with open(self.path, 'wb') as f:
+            f.write(old)
+
+        writes = []
+        with open(self.path, 'r+b') as dst:
+            dst_proxy = _Recorder(dst, writes)
+            blocks, written = fedimg.delta.write_delta(
+                io.BytesIO(new), dst_proxy, block_size=4)
+
+        self.assertEqual((blocks, written), (4, 2))
+        self.assertEqual(writes, [b'XXXX', b'dY'])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), new)
+
+    def test_unchanged(self):
+        data = os.urandom(10000)
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        with open(self.path, 'r+b') as dst:
+            self.assertEqual(fedimg.delta.write_delta(
+                io.BytesIO(data), dst, block_size=4096), (3, 0))
+
+
+class _Recorder(object):
+    """ A file that records what's written to it. """
+
+    def __init__(self, fileobj, writes):
+        self.fileobj = fileobj
+        self.writes = writes
+
+    def write(self, data):
+        self.writes.append(data)
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
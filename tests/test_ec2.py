@@ -0,0 +1,645 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import distutils.spawn
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as ET
+
+import mock
+from libcloud.compute.types import NodeState
+
+import fedimg.cancel
+import fedimg.catalog
+import fedimg.ledger
+import fedimg.services.ec2
+import fedimg.trace
+
+URL = 'https://somepage.org/Fedora-Cloud-Base-25-1.3.x86_64.raw.xz'
+
+AMIS = 'us-east-1|x86_64|ami-util|aki-1\neu-west-1|x86_64|ami-util|aki-2'
+
+COPY_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<CopySnapshotResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+    <requestId>59dbff89-35bd-4eac-99ed-be587EXAMPLE</requestId>
+    <snapshotId>snap-copy</snapshotId>
+</CopySnapshotResponse>
+"""
+
+
+class TestSharedSnapshots(unittest.TestCase):
+    """ This tests SharedSnapshots in fedimg/services/ec2/replicate.py. """
+
+    def setUp(self):
+        self.share = fedimg.services.ec2.SharedSnapshots()
+
+    def test_made_once(self):
+        made = []
+
+        def make():
+            time.sleep(0.1)
+            made.append(1)
+            return 'snap-1'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.share.get('eu-west-1', make)))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['snap-1'] * 4)
+        self.assertEqual(made, [1])
+        self.assertEqual(self.share.wait('eu-west-1'), 'snap-1')
+
+    def test_failure_retried(self):
+        def fail():
+            raise Exception('boom')
+
+        self.assertRaises(Exception, self.share.get, 'eu-west-1', fail)
+        self.assertEqual(self.share.get('eu-west-1', lambda: 'snap-2'),
+                         'snap-2')
+
+
+class TestSnapshotReplication(unittest.TestCase):
+    """ This tests how EC2Service replicates snapshots to other regions. """
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        self.driver.path = '/'
+        amis = [{'region': region, 'arch': 'x86_64',
+                 'driver': lambda *args: self.driver}
+                for region in ('us-east-1', 'eu-west-1')]
+        self.share = fedimg.services.ec2.SharedSnapshots()
+        self.share.get('us-east-1', lambda: 'snap-origin')
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=amis):
+            self.services = [
+                fedimg.services.ec2.EC2Service(
+                    URL, vol_type=vol, tester=mock.Mock(),
+                    quota=mock.MagicMock(), share=self.share)
+                for vol in ('standard', 'gp2')]
+
+        self.driver.connection.request.return_value.object = ET.fromstring(
+            COPY_RESPONSE)
+        snapshot = mock.Mock()
+        snapshot.extra = {'state': 'completed'}
+        self.driver.list_snapshots.return_value = [snapshot]
+        self.driver.ex_register_image.side_effect = (
+            lambda name, **kwargs: mock.Mock(id='ami-' + name))
+
+    @mock.patch('fedimg.messenger.message')
+    def test_copied_once(self, message):
+        for service in self.services:
+            service._copy_images(None)
+
+        # One snapshot copy, for both variants
+        self.assertEqual(self.driver.connection.request.call_count, 1)
+        params = self.driver.connection.request.call_args[1]['params']
+        self.assertEqual(params['Action'], 'CopySnapshot')
+        self.assertEqual(params['SourceRegion'], 'us-east-1')
+        self.assertEqual(params['SourceSnapshotId'], 'snap-origin')
+        self.assertEqual(self.share.wait('eu-west-1'), 'snap-copy')
+
+        # Each variant registered from the copy
+        for service in self.services:
+            self.assertEqual(len(service.copies), 1)
+            ami, image = service.copies[0]
+            self.assertEqual(ami['region'], 'eu-west-1')
+        mappings = [kwargs['block_device_mapping'][0]['Ebs']
+                    for args, kwargs
+                    in self.driver.ex_register_image.call_args_list]
+        self.assertEqual([m['SnapshotId'] for m in mappings],
+                         ['snap-copy', 'snap-copy'])
+        self.assertEqual([m['VolumeType'] for m in mappings],
+                         ['standard', 'gp2'])
+
+
+@unittest.skipIf(not distutils.spawn.find_executable('xz') or
+                 not distutils.spawn.find_executable('bash'),
+                 'xz and bash are needed to run the write pipeline')
+class TestWritePipeline(unittest.TestCase):
+    """ This tests the commands that write images on utility nodes. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.image = os.path.join(self.tmpdir, 'image.raw.xz')
+        self.target = os.path.join(self.tmpdir, 'volume')
+        self.data = b'fedimg' * 4096
+        xz = subprocess.Popen(['xz', '-c'], stdin=subprocess.PIPE,
+                              stdout=open(self.image, 'wb'))
+        xz.communicate(self.data)
+
+    def run_pipeline(self, fetch, **kwargs):
+        pipeline = fedimg.services.ec2.write_pipeline(fetch, self.target,
+                                                      **kwargs)
+        return subprocess.call(['bash', '-o', 'pipefail', '-c', pipeline],
+                               stderr=open(os.devnull, 'w'))
+
+    def assert_propagates(self, **kwargs):
+        # Written in full
+        self.assertEqual(
+            self.run_pipeline('cat {0}'.format(self.image), **kwargs), 0)
+        with open(self.target, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+        # The download fails after handing over all of the data, so only
+        # its own status tells
+        self.assertNotEqual(self.run_pipeline(
+            '(cat {0}; exit 22)'.format(self.image), **kwargs), 0)
+
+    def test_redirect(self):
+        self.assert_propagates()
+
+    def test_delta(self):
+        delta_script = os.path.join(os.path.dirname(fedimg.__file__),
+                                    'delta.py')
+        with open(self.target, 'wb') as f:
+            f.write(b'x' * len(self.data))
+        self.assert_propagates(block_size='4096', delta_script=delta_script)
+
+    def test_dd(self):
+        # oflag=direct isn't supported everywhere (on tmpfs, say)
+        probe = subprocess.call(
+            ['dd', 'if=/dev/zero', 'of=' + self.target, 'bs=4096',
+             'count=1', 'oflag=direct'], stderr=open(os.devnull, 'w'))
+        if probe != 0:
+            raise unittest.SkipTest('O_DIRECT is not supported here')
+        self.assert_propagates(block_size='4096')
+
+
+class TestSpot(unittest.TestCase):
+    """ This tests how EC2Service runs nodes on spot capacity. """
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        self.connection = self.driver.connection
+        with mock.patch('fedimg.AWS_AMIS', AMIS):
+            self.service = fedimg.services.ec2.EC2Service(
+                URL, tester=mock.Mock())
+        self.service.cancel = mock.Mock()
+        self.size = mock.Mock(id='m4.large')
+        self.driver.region_name = 'us-east-1'
+        self.deploy = self.driver.deploy_node
+        self.ledger = fedimg.ledger.Ledger(':memory:')
+        patchers = [
+            mock.patch('fedimg.AWS_SPOT', True),
+            mock.patch('fedimg.AWS_SPOT_MAX_PRICE', '0.05'),
+            mock.patch('fedimg.AWS_SPOT_DEADLINE', 60),
+            mock.patch('fedimg.ledger.get_ledger', return_value=self.ledger),
+            mock.patch('fedimg.CLEAN_UP_ON_FAILURE', True),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def deploy_node(self, **kwargs):
+        return self.service._deploy_node(self.driver, deploy=mock.Mock(),
+                                         ssh_username='fedora',
+                                         ssh_alternate_usernames=['root'],
+                                         size=self.size, **kwargs)
+
+    def tracked(self):
+        return [(r['kind'], r['id']) for r in self.ledger.resources()]
+
+    def failed(self, node_id, extra=None):
+        node = mock.Mock(id=node_id, extra=extra or {})
+        return fedimg.services.ec2.DeploymentException(
+            node=node, original_exception=Exception('Connection refused'))
+
+    def test_spot_market(self):
+        traced = fedimg.trace.TracedDriver(self.driver, 'us-east-1')
+        with fedimg.services.ec2.spot_market(traced, '0.05'):
+            self.driver.connection.request(
+                '/', params={'Action': 'RunInstances', 'ImageId': 'ami-1'})
+            self.driver.connection.request(
+                '/', params={'Action': 'DescribeInstances'})
+        self.assertIs(self.driver.connection, self.connection)
+
+        run, describe = [c[0][1] for c in
+                         self.connection.request.call_args_list]
+        self.assertEqual(run['InstanceMarketOptions.MarketType'], 'spot')
+        self.assertEqual(
+            run['InstanceMarketOptions.SpotOptions.MaxPrice'], '0.05')
+        self.assertEqual(describe, {'Action': 'DescribeInstances'})
+
+    def test_spot(self):
+        def deploy(**kwargs):
+            # Asked for while the spot market options are in place
+            self.assertIsInstance(self.driver.connection,
+                                  fedimg.services.ec2.SpotConnection)
+            return mock.Mock(id='i-spot', extra={})
+        self.deploy.side_effect = deploy
+        node = self.deploy_node()
+        self.assertEqual(node.id, 'i-spot')
+        self.assertEqual(self.service.spot_nodes, set(['i-spot']))
+        self.assertIs(self.driver.connection, self.connection)
+        self.assertEqual(self.deploy.call_args[1]['ssh_username'], 'fedora')
+        self.assertEqual(self.tracked(), [('node', 'i-spot')])
+
+    def test_tracked_while_deploying(self):
+        """ A node is in the ledger by its tag while it's being deployed,
+        and is destroyed if that fails. """
+        def deploy(**kwargs):
+            token = kwargs['ex_metadata'][fedimg.ledger.DEPLOY_TAG]
+            self.assertEqual(kwargs['ex_metadata']['build'], 'fedora')
+            self.assertEqual(self.tracked(), [('deploy', token)])
+            raise self.failed('i-spot')
+        self.deploy.side_effect = deploy
+        self.driver.list_nodes.return_value = [
+            mock.Mock(state=NodeState.RUNNING)]
+
+        self.assertRaises(fedimg.services.ec2.DeploymentException,
+                          self.deploy_node, ex_metadata={'build': 'fedora'})
+        self.assertEqual(self.driver.destroy_node.call_args[0][0].id,
+                         'i-spot')
+        self.assertEqual(self.tracked(), [])
+
+    def test_kept_volume(self):
+        """ A volume kept once the node is terminated is recorded even if
+        deploying fails. """
+        mappings = [{'DeviceName': '/dev/sdb',
+                     'Ebs': {'DeleteOnTermination': 'false'}}]
+        self.deploy.side_effect = self.failed('i-spot', {
+            'block_device_mapping': [
+                {'device_name': '/dev/sda1', 'ebs': {'volume_id': 'vol-1'}},
+                {'device_name': '/dev/sdb', 'ebs': {'volume_id': 'vol-2'}},
+            ]})
+        self.driver.list_nodes.return_value = [
+            mock.Mock(state=NodeState.RUNNING)]
+
+        self.assertRaises(fedimg.services.ec2.DeploymentException,
+                          self.deploy_node, ex_blockdevicemappings=mappings)
+        self.assertEqual(self.tracked(), [('volume', 'vol-2')])
+
+    def test_kept_volume_not_attached(self):
+        """ The volumes of a node as RunInstances returned it are looked
+        up. """
+        mappings = [{'DeviceName': '/dev/sdb',
+                     'Ebs': {'DeleteOnTermination': 'false'}}]
+        self.deploy.side_effect = self.failed('i-spot')
+        self.driver.list_nodes.return_value = [mock.Mock(
+            state=NodeState.TERMINATED,
+            extra={'block_device_mapping': [
+                {'device_name': '/dev/sdb', 'ebs': {'volume_id': 'vol-2'}}]})]
+
+        self.assertRaises(fedimg.services.ec2.EC2SpotInterruption,
+                          self.deploy_node, ex_blockdevicemappings=mappings)
+        self.assertEqual(self.tracked(), [('volume', 'vol-2')])
+
+    @mock.patch('fedimg.services.ec2.nodes.time')
+    def test_deadline(self, time):
+        time.side_effect = [0, 0, 30, 61]
+        on_demand = mock.Mock(id='i-on-demand', extra={})
+        self.deploy.side_effect = [
+            Exception('InsufficientInstanceCapacity'),
+            Exception('SpotMaxPriceTooLow'),
+            on_demand]
+
+        # Retried until the deadline, then on-demand
+        node = self.deploy_node()
+        self.assertIs(node, on_demand)
+        self.assertEqual(self.service.cancel.sleep.call_count, 2)
+        self.assertEqual(self.service.spot_nodes, set())
+
+    def test_other_errors(self):
+        self.deploy.side_effect = TypeError('bad argument')
+        self.assertRaises(TypeError, self.deploy_node)
+        self.assertEqual(self.deploy.call_count, 1)
+        self.assertEqual(self.tracked(), [])
+
+    def test_interrupted(self):
+        self.deploy.side_effect = self.failed('i-spot')
+        self.driver.list_nodes.return_value = [
+            mock.Mock(state=NodeState.TERMINATED)]
+        self.assertRaises(fedimg.services.ec2.EC2SpotInterruption,
+                          self.deploy_node)
+        self.assertEqual(self.tracked(), [])
+
+    @mock.patch('fedimg.AWS_SPOT_RESTARTS', 2)
+    def test_with_restarts(self):
+        calls = []
+
+        def stage(arg):
+            calls.append(self.service.on_demand_only)
+            if len(calls) < 3:
+                raise fedimg.services.ec2.EC2SpotInterruption('gone')
+            return arg
+
+        self.assertEqual(self.service._with_restarts(stage, 'done'), 'done')
+        # On-demand once interrupted too often
+        self.assertEqual(calls, [False, False, True])
+
+
+@mock.patch('fedimg.messenger.message')
+class TestTests(unittest.TestCase):
+    """ This tests how EC2Service's boot tests overlap with replication. """
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        self.events = []
+        amis = [{'region': region, 'arch': 'x86_64', 'ami': 'ami-util',
+                 'aki': None, 'driver': lambda *args: self.driver}
+                for region in ('us-east-1', 'eu-west-1')]
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=amis):
+            self.service = fedimg.services.ec2.EC2Service(
+                URL, tester=mock.Mock(), quota=mock.Mock())
+        self.amis = amis
+        patcher = mock.patch('fedimg.catalog.get_catalog', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, name, result=None):
+        def call(*args, **kwargs):
+            self.events.append(name)
+            return result
+        return call
+
+    def test_overlap(self, message):
+        service = self.service
+        test = mock.Mock()
+        test.get.side_effect = self.record('test done')
+        service.tester.submit.side_effect = self.record('test', test)
+        image = mock.Mock(id='ami-1')
+        with mock.patch.object(service, '_origin_snapshot',
+                               return_value='snap-1'), \
+                mock.patch.object(service, '_register_image',
+                                  return_value=image), \
+                mock.patch.object(service, '_copy_images',
+                                  side_effect=self.record('copy')), \
+                mock.patch.object(service, '_clean_up'), \
+                mock.patch.object(service, '_publish_copies',
+                                  side_effect=self.record('publish')):
+            self.assertEqual(service.upload(None), 0)
+
+        # Copies start while the test runs; only publishing waits for it
+        self.assertEqual(self.events,
+                         ['test', 'copy', 'test done', 'publish'])
+
+    def test_copies_complete_first(self, message):
+        service = self.service
+        service.copies = [(self.amis[1], mock.Mock(id='ami-2')),
+                          (self.amis[1], mock.Mock(id='ami-3'))]
+        service.tester.sample.side_effect = lambda copies: copies
+        service.tester.submit.side_effect = self.record('test', mock.Mock())
+
+        def state(id):
+            self.events.append('wait ' + id)
+            return mock.Mock(extra={
+                'state': 'failed' if id == 'ami-3' else 'available'})
+        self.driver.get_image.side_effect = state
+
+        with mock.patch('fedimg.DELETE_IMAGES_ON_FAILURE', False):
+            service._test_copies(None)
+
+        # No test slot is taken before the copy is complete, and copies
+        # that fail count as failed tests
+        self.assertEqual(self.events, ['wait ami-2', 'test', 'wait ami-3'])
+        self.assertEqual(service.failed, set(['ami-3']))
+
+    def test_failed_copy_stays_private(self, message):
+        service = self.service
+        good, bad = mock.Mock(id='ami-2'), mock.Mock(id='ami-3')
+        service.copies = [(self.amis[1], good), (self.amis[1], bad)]
+        service.tester.sample.side_effect = lambda copies: copies[1:]
+        result = mock.Mock()
+        result.get.side_effect = Exception('boom')
+        service.tester.submit.return_value = result
+        self.driver.get_image.return_value = mock.Mock(
+            extra={'state': 'available'})
+
+        with mock.patch('fedimg.DELETE_IMAGES_ON_FAILURE', True):
+            service._publish_copies(None)
+
+        # Only the sampled copy is tested; it failed, so it is deleted and
+        # only the other copy is made public
+        service.tester.submit.assert_called_once_with(
+            service._test_copy, self.amis[1], bad, None)
+        self.driver.delete_image.assert_called_once_with(bad)
+        self.driver.ex_modify_image_attribute.assert_called_once_with(
+            good, {'LaunchPermission.Add.1.Group': 'all'})
+
+    @mock.patch('fedimg.services.ec2.replicate.sleep')
+    def test_clean_up_pending_copy(self, sleep, message):
+        self.service.copies = [(self.amis[1], mock.Mock(id='ami-2'))]
+        self.driver.get_image.side_effect = [
+            mock.Mock(extra={'state': 'pending'}),
+            mock.Mock(extra={'state': 'available'})]
+        self.service._clean_up(self.driver, delete_images=True)
+        self.assertEqual(sleep.call_count, 1)
+        self.driver.delete_image.assert_called_once_with(mock.ANY)
+
+
+@mock.patch('fedimg.messenger.message')
+class TestReuse(unittest.TestCase):
+    """ This tests how EC2Service reuses the AMIs of unchanged images. """
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        self.driver.ex_register_image.side_effect = (
+            lambda name, **kwargs: mock.Mock(id='ami-' + name))
+        self.driver.get_image.side_effect = lambda id: mock.Mock(
+            id=id, extra={'block_device_mapping': [
+                {'ebs': {'snapshot_id': 'snap-of-' + id}}]})
+        amis = [{'region': region, 'arch': 'x86_64',
+                 'driver': lambda *args: self.driver}
+                for region in ('us-east-1', 'eu-west-1')]
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=amis):
+            self.service = fedimg.services.ec2.EC2Service(
+                URL, tester=mock.Mock(), quota=mock.Mock(), checksum='abc')
+        self.catalog = fedimg.catalog.Catalog(':memory:')
+        self.catalog.add_checksum('abc', 'us-east-1', 'hvm', 'gp2',
+                                  'ami-old-us', 'snap-us')
+        self.catalog.add_checksum('abc', 'eu-west-1', 'hvm', 'standard',
+                                  'ami-old-eu')
+        patcher = mock.patch('fedimg.catalog.get_catalog',
+                             return_value=self.catalog)
+        self.get_catalog = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def snapshots(self):
+        return [kwargs['block_device_mapping'][0]['Ebs']['SnapshotId']
+                for args, kwargs
+                in self.driver.ex_register_image.call_args_list]
+
+    @mock.patch('fedimg.AWS_REUSE', 'register')
+    def test_register(self, message):
+        self.assertTrue(self.service._reuse(None))
+        # Registered from the recorded snapshot, or the AMI's own
+        self.assertEqual(self.snapshots(), ['snap-us', 'snap-of-ami-old-eu'])
+        self.assertEqual(self.driver.ex_modify_image_attribute.call_count, 2)
+        self.assertEqual(message.call_count, 2)
+        rows = self.catalog.find_checksum('abc', vol_type='standard')
+        self.assertEqual(len(rows), 2)
+
+    @mock.patch('fedimg.AWS_REUSE', 'reference')
+    def test_reference_needs_variant(self, message):
+        # Only the eu-west-1 AMI is of this variant
+        self.assertFalse(self.service._reuse(None))
+        self.catalog.add_checksum('abc', 'us-east-1', 'hvm', 'standard',
+                                  'ami-old-us2', 'snap-us')
+        self.assertTrue(self.service._reuse(None))
+        self.assertFalse(self.driver.ex_register_image.called)
+        self.assertEqual(
+            sorted(kwargs['extra']['id']
+                   for args, kwargs in message.call_args_list),
+            ['ami-old-eu', 'ami-old-us2'])
+
+    @mock.patch('fedimg.AWS_REUSE', 'register')
+    def test_stale(self, message):
+        self.driver.ex_register_image.side_effect = [
+            mock.Mock(id='ami-new-us'), Exception('InvalidSnapshot.NotFound')]
+        self.assertFalse(self.service._reuse(None))
+        # The stale record is dropped, and what was registered deleted
+        self.assertEqual([r['region'] for r in
+                          self.catalog.find_checksum('abc')], ['us-east-1'])
+        self.assertEqual(self.driver.delete_image.call_args[0][0].id,
+                         'ami-new-us')
+        self.assertFalse(message.called)
+
+    @mock.patch('fedimg.AWS_REUSE', 'register')
+    def test_unknown(self, message):
+        self.service.checksum = 'def'
+        self.assertFalse(self.service._reuse(None))
+
+    @mock.patch('fedimg.AWS_REUSE', '')
+    def test_off(self, message):
+        self.assertFalse(self.service._reuse(None))
+        self.assertFalse(self.driver.ex_register_image.called)
+        # The catalog isn't even opened
+        self.assertFalse(self.get_catalog.called)
+
+    @mock.patch('fedimg.AWS_REUSE', 'register')
+    @mock.patch('fedimg.CLEAN_UP_ON_FAILURE', True)
+    def test_broken_catalog(self, message):
+        self.get_catalog.side_effect = OSError(20, 'Not a directory')
+        with mock.patch.object(self.service, '_clean_up') as clean_up:
+            self.assertEqual(self.service.upload(None), 1)
+        # Fails like any other stage of the upload
+        self.assertTrue(clean_up.called)
+
+
+class TestDelta(unittest.TestCase):
+    """ This tests how EC2Service finds the build to write changes onto. """
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        self.driver.get_image.side_effect = lambda id: mock.Mock(
+            id=id, extra={'block_device_mapping': [
+                {'ebs': {'snapshot_id': 'snap-of-' + id}}]})
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=[]):
+            self.service = fedimg.services.ec2.EC2Service(
+                'https://x/Fedora-Cloud-Base-26-20170602.n.0.x86_64.raw.xz',
+                tester=mock.Mock(), quota=mock.Mock())
+        self.catalog = fedimg.catalog.Catalog(':memory:')
+        patcher = mock.patch('fedimg.catalog.get_catalog',
+                             return_value=self.catalog)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_previous_snapshot(self):
+        self.assertEqual(
+            self.service._previous_snapshot(self.driver, 'eu-west-1'), None)
+        self.catalog.add('ami-old', 'Fedora-Cloud-Base-26-20170601.n.0.x86_64',
+                         'eu-west-1', 'hvm', 'standard', created=1)
+        self.catalog.add('ami-i386', 'Fedora-Cloud-Base-26-20170601.n.0.i386',
+                         'eu-west-1', 'hvm', 'standard', created=2)
+        self.assertEqual(
+            self.service._previous_snapshot(self.driver, 'eu-west-1'),
+            'snap-of-ami-old')
+        self.assertEqual(
+            self.service._previous_snapshot(self.driver, 'us-east-1'), None)
+
+    def test_previous_snapshot_variant(self):
+        """ Only the snapshot of an AMI of the same variant is built on. """
+        self.catalog.add('ami-old', 'Fedora-Cloud-Base-26-20170601.n.0.x86_64',
+                         'eu-west-1', 'hvm', 'standard', created=1)
+        self.catalog.add('ami-gp2', 'Fedora-Cloud-Base-26-20170601.n.0.x86_64',
+                         'eu-west-1', 'hvm', 'gp2', created=2)
+        self.catalog.add('ami-pv', 'Fedora-Cloud-Base-26-20170601.n.0.x86_64',
+                         'eu-west-1', 'paravirtual', 'standard', created=3)
+        self.assertEqual(
+            self.service._previous_snapshot(self.driver, 'eu-west-1'),
+            'snap-of-ami-old')
+        self.service.vol_type = 'gp2'
+        self.assertEqual(
+            self.service._previous_snapshot(self.driver, 'eu-west-1'),
+            'snap-of-ami-gp2')
+
+
+@mock.patch('fedimg.messenger.message')
+class TestHandOff(unittest.TestCase):
+    """ This tests how EC2Service hands off publishing its copies. """
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        amis = [{'region': region, 'arch': 'x86_64',
+                 'driver': lambda *args: self.driver}
+                for region in ('us-east-1', 'eu-west-1')]
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=amis):
+            self.service = fedimg.services.ec2.EC2Service(
+                URL, tester=mock.Mock(), quota=mock.Mock())
+        self.service.tester.sample.return_value = []
+        self.service.copies = [(amis[0], mock.Mock(id='ami-1')),
+                               (amis[1], mock.Mock(id='ami-2'))]
+        patcher = mock.patch('fedimg.catalog.get_catalog', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_checkpoint(self, message):
+        # Jobs whose AMI wasn't tested start over
+        self.assertEqual(self.service.checkpoint(), None)
+
+        self.service.test_success = True
+        self.service.cancel.cancel(fedimg.cancel.SHUTDOWN)
+        self.driver.ex_modify_image_attribute.side_effect = [
+            None, Exception('InvalidAMIID.Unavailable')]
+        with self.assertRaises(fedimg.cancel.JobCancelled):
+            self.service._publish_copies(None)
+        self.assertEqual(self.service.checkpoint(), {
+            'copies': [['eu-west-1', 'ami-2']], 'failed': [],
+            'tested': True})
+
+    def test_resume(self, message):
+        state = {'copies': [['eu-west-1', 'ami-2']], 'failed': [],
+                 'tested': True}
+        self.service.copies = []
+        self.assertEqual(self.service.resume(state, None), 0)
+        image = self.driver.ex_modify_image_attribute.call_args[0][0]
+        self.assertEqual(image.id, 'ami-2')
+        self.assertFalse(self.service.tester.submit.called)
+        self.assertEqual(self.service.published, set(['ami-2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import BaseHTTPServer
+import io
+import os
+import re
+import threading
+import unittest
+
+import fedimg.fetch
+
+DATA = os.urandom(100000)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves DATA at /image, with ranges unless the server says not to,
+        and redirects /mirror there. """
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == '/mirror':
+            self.send_response(302)
+            self.send_header('Location', '/image')
+            self.end_headers()
+            return
+
+        match = re.match(r'bytes=(\d+)-(\d+)',
+                         self.headers.get('Range') or '')
+        if match and self.server.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(DATA)))
+            body = DATA[start:end + 1]
+        else:
+            self.send_response(200)
+            body = DATA
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetch(unittest.TestCase):
+    """ This tests fedimg/fetch.py. """
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.paths = []
+        self.server.ranges = True
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def test_ranged(self):
+        out = io.BytesIO()
+        mode, size = fedimg.fetch.fetch(self.url + '/mirror', out, 4,
+                                        chunk_size=4096)
+        self.assertEqual(mode, '4 ranged connections')
+        self.assertEqual(size, len(DATA))
+        self.assertEqual(out.getvalue(), DATA)
+        # The redirect is only followed once
+        self.assertEqual(self.server.paths.count('/mirror'), 1)
+        self.assertEqual(self.server.paths.count('/image'), 1 + 25)
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        out = io.BytesIO()
+        mode, size = fedimg.fetch.fetch(self.url + '/image', out, 4,
+                                        chunk_size=4096)
+        self.assertEqual(mode, 'a single stream')
+        self.assertEqual(out.getvalue(), DATA)
+        # The probe's response is the download
+        self.assertEqual(self.server.paths, ['/image'])
+
+    def test_failed_range(self):
+        fetch = fedimg.fetch.RangedFetch(self.url + '/missing', len(DATA), 2,
+                                         chunk_size=4096)
+        fetch._get = lambda index: DATA[:10] if index < 3 else 1 / 0
+        self.assertRaises(ZeroDivisionError, fetch.run, io.BytesIO())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+import fedimg.convert
+import fedimg.services.ftp
+
+
+class StubHTTP(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves `data` at any path, with support for range requests. """
+
+    daemon_threads = True
+
+    def __init__(self, data):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHTTPHandler)
+        self.data = data
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+
+class StubHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', None))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.data
+        byte_range = self.headers.get('Range')
+        self.server.requests.append(('GET', byte_range))
+        if byte_range:
+            start, end = byte_range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TestFTP(unittest.TestCase):
+    """ This tests fedimg/services/ftp.py. """
+
+    def setUp(self):
+        self.target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.target_dir)
+        self.data = os.urandom(1000000)
+        self.server = StubHTTP(self.data)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.url = self.server.url + '/Fedora-Cloud-Base-25.x86_64.raw.xz'
+
+        patcher = mock.patch('fedimg.services.ftp.MIN_PART_SIZE', 100000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _service(self, checksum=None, formats=()):
+        return fedimg.services.ftp.FTPService(
+            self.url, checksum=checksum, target_dir=self.target_dir,
+            connections=4, formats=formats)
+
+    @mock.patch('fedimg.messenger.message')
+    def test_upload(self, message):
+        result = self._service().upload({'compose_id': 'Fedora-25-1'})
+
+        self.assertEqual(result, 0)
+        path = os.path.join(self.target_dir, 'Fedora-25-1',
+                            'Fedora-Cloud-Base-25.x86_64.raw.xz')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        ranges = [r for method, r in self.server.requests if method == 'GET']
+        self.assertEqual(sorted(ranges), ['bytes=0-249999',
+                                          'bytes=250000-499999',
+                                          'bytes=500000-749999',
+                                          'bytes=750000-999999'])
+        message.assert_called_with(
+            'image.upload', self.url, 'FTP', 'completed',
+            extra={'path': path, 'converted': []}, compose={'compose_id': 'Fedora-25-1'})
+
+    def test_unchanged(self):
+        first, = self._service().publish({'compose_id': 'Fedora-25-1'})
+        second, = self._service().publish({'compose_id': 'Fedora-25-2'})
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+
+        # Knowing the checksum, there's no need to download it again
+        del self.server.requests[:]
+        checksum = hashlib.sha256(self.data).hexdigest()
+        third, = self._service(checksum).publish(
+            {'compose_id': 'Fedora-25-3'})
+        self.assertEqual(os.stat(first).st_ino, os.stat(third).st_ino)
+        self.assertEqual(self.server.requests, [])
+
+        # Nothing but the published files and the one stored object is left
+        objects = []
+        for root, dirs, files in os.walk(self.target_dir):
+            objects.extend(files)
+        self.assertEqual(sorted(objects), sorted([checksum] + [
+            'Fedora-Cloud-Base-25.x86_64.raw.xz'] * 3))
+
+    def test_formats(self):
+        raw = b'\0' * 500000 + b'fedora' * 100000
+        xz = subprocess.Popen(['xz', '--stdout'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+        self.server.data = xz.communicate(raw)[0]
+
+        with mock.patch('fedimg.convert.convert_files',
+                        wraps=fedimg.convert.convert_files) as convert:
+            first = self._service(formats=['qcow2', 'vhd']).publish(
+                {'compose_id': 'Fedora-25-1'})
+            second = self._service(formats=['qcow2', 'vhd']).publish(
+                {'compose_id': 'Fedora-25-2'})
+
+        self.assertEqual([os.path.basename(p) for p in first], [
+            'Fedora-Cloud-Base-25.x86_64.raw.xz',
+            'Fedora-Cloud-Base-25.x86_64.qcow2',
+            'Fedora-Cloud-Base-25.x86_64.vhd'])
+        with open(first[2], 'rb') as f:
+            self.assertEqual(f.read(len(raw)), raw)
+        # The unchanged image wasn't converted again
+        self.assertEqual(convert.call_count, 1)
+        for a, b in zip(first, second):
+            self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+
+    @mock.patch('fedimg.messenger.message')
+    def test_bad_checksum(self, message):
+        result = self._service('0' * 64).upload(None)
+        self.assertEqual(result, 1)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.target_dir, 'Fedora-Cloud-Base-25.x86_64.raw.xz')))
+
+    def test_prune(self):
+        checksum = hashlib.sha256(self.data).hexdigest()
+        first, = self._service().publish({'compose_id': 'Fedora-25-1'})
+        second, = self._service().publish({'compose_id': 'Fedora-25-2'})
+        leftover = os.path.join(self.target_dir, '.objects', '.fedimg-tmp')
+        open(leftover, 'w').close()
+        service = self._service(checksum)
+        later = mock.patch('fedimg.services.ftp.time.time',
+                           return_value=time.time() + 7200)
+
+        # Nothing has been left alone for an hour yet
+        self.assertEqual(service.prune(3600), [])
+        # The object is still linked from the composes
+        with later:
+            self.assertEqual(service.prune(3600), [leftover])
+
+        shutil.rmtree(os.path.dirname(first))
+        shutil.rmtree(os.path.dirname(second))
+        self.assertEqual(service.prune(3600), [])
+        with later:
+            self.assertEqual(service.prune(3600),
+                             [service._object_path(checksum)])
+        self.assertEqual(os.listdir(os.path.join(self.target_dir,
+                                                 '.objects', checksum[:2])),
+                         [])
+
+    @mock.patch('fedimg.messenger.message')
+    def test_upload_prunes(self, message):
+        with mock.patch('fedimg.FTP_PRUNE_AGE', 3600), \
+                mock.patch.object(fedimg.services.ftp.FTPService,
+                                  'prune') as prune:
+            self._service().upload(None)
+        prune.assert_called_once_with()
+        with mock.patch('fedimg.FTP_PRUNE_AGE', 0), \
+                mock.patch.object(fedimg.services.ftp.FTPService,
+                                  'prune') as prune:
+            self._service().upload(None)
+        self.assertFalse(prune.called)
+
+    def test_pruned_while_linking(self):
+        """ An unchanged image whose object is pruned just before it's
+        linked is downloaded again. """
+        checksum = hashlib.sha256(self.data).hexdigest()
+        service = self._service(checksum)
+        link = service._link
+        pruned = []
+
+        def pruned_link(source, dest):
+            if not pruned:
+                os.unlink(source)
+                pruned.append(source)
+            return link(source, dest)
+
+        self._service().publish(None)
+        os.unlink(os.path.join(self.target_dir,
+                               'Fedora-Cloud-Base-25.x86_64.raw.xz'))
+        with mock.patch.object(service, '_link', side_effect=pruned_link):
+            path, = service.publish({'compose_id': 'Fedora-25-1'})
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
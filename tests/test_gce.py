@@ -0,0 +1,182 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import BaseHTTPServer
+import io
+import subprocess
+import tarfile
+import tempfile
+import threading
+import unittest
+
+import mock
+import requests
+
+import fedimg.services.gce
+import fedimg.stream
+
+
+class StubStorage(BaseHTTPServer.HTTPServer):
+    """ Just enough of the Cloud Storage resumable upload API to upload to,
+    failing the PUT requests listed in `fail`. """
+
+    def __init__(self, fail=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubStorageHandler)
+        self.data = bytearray()
+        self.done = False
+        self.puts = 0
+        self.fail = set(fail)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+
+class StubStorageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _progress(self):
+        if self.server.done:
+            self.send_response(200)
+        else:
+            self.send_response(308)
+            if self.server.data:
+                self.send_header('Range', 'bytes=0-{0}'.format(
+                    len(self.server.data) - 1))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        self._body()
+        self.send_response(200)
+        self.send_header('Location', self.server.url + '/session')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        body = self._body()
+        self.server.puts += 1
+        span, total = self.headers['Content-Range'][len('bytes '):].split('/')
+        if span != '*':
+            start = int(span.split('-')[0])
+            if self.server.puts in self.server.fail:
+                # Only the first half of the chunk made it
+                self.server.data[start:] = body[:len(body) // 2]
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.server.data[start:] = body
+            if total != '*' and len(self.server.data) == int(total):
+                self.server.done = True
+        self._progress()
+
+
+class TestGCE(unittest.TestCase):
+    """ This tests fedimg/services/gce.py. """
+
+    def _serve(self, fail=()):
+        server = StubStorage(fail)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_gce_image_name(self):
+        name = fedimg.services.gce.gce_image_name(
+            'Fedora-Cloud-Base-25-20170102.0.x86_64')
+        self.assertEqual(name, 'fedora-cloud-base-25-20170102-0-x86-64')
+        name = fedimg.services.gce.gce_image_name('25_Base')
+        self.assertEqual(name, 'fedora-25-base')
+
+    @mock.patch('fedimg.services.gce.sleep')
+    def test_resumable_upload(self, sleep):
+        server = self._serve(fail=[2])
+        upload = fedimg.services.gce.ResumableUpload(
+            server.url, 'bucket', 'image.tar.gz', chunk_size=256 * 1024)
+        data = [b'%06d' % i for i in range(100000)]
+
+        size = upload.upload(iter(data))
+
+        self.assertEqual(size, len(b''.join(data)))
+        self.assertTrue(server.done)
+        self.assertEqual(bytes(server.data), b''.join(data))
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(server.puts, 5)
+
+    @mock.patch('fedimg.services.gce.sleep')
+    def test_chunk_made_it(self, sleep):
+        upload = fedimg.services.gce.ResumableUpload(
+            'http://storage', 'bucket', 'image.tar.gz', chunk_size=10)
+        upload.session = mock.Mock()
+        upload.session.post.return_value.headers = {'Location': 'session'}
+
+        def response(status, committed=None):
+            headers = {}
+            if committed:
+                headers['Range'] = 'bytes=0-{0}'.format(committed - 1)
+            return mock.Mock(status_code=status, headers=headers)
+
+        # The first chunk made it although the connection broke
+        upload.session.put.side_effect = [
+            requests.ConnectionError(), response(308, 10),
+            response(308, 20), response(200)]
+
+        self.assertEqual(upload.upload(iter([b'x' * 25])), 25)
+        self.assertEqual(
+            [c[1]['headers']['Content-Range']
+             for c in upload.session.put.call_args_list],
+            ['bytes 0-9/*', 'bytes */*', 'bytes 10-19/*', 'bytes 20-24/25'])
+
+    @mock.patch('fedimg.services.gce.sleep')
+    def test_tarball(self, sleep):
+        raw = (b'\0' * 300000 + b'data' * 50000 + b'\0' * 200000 +
+               b'more' * 1000 + b'\0' * 70000)
+        compressed = tempfile.TemporaryFile()
+        self.addCleanup(compressed.close)
+        xz = subprocess.Popen(['xz', '--stdout'], stdin=subprocess.PIPE,
+                              stdout=compressed)
+        xz.communicate(raw)
+
+        server = self._serve(fail=[3])
+        service = fedimg.services.gce.GCEService(
+            'https://somepage.org/Fedora-Cloud-Base-25.x86_64.raw.xz')
+        upload = fedimg.services.gce.ResumableUpload(
+            server.url, 'bucket', service.object_name, chunk_size=4096)
+        upload.upload(service._tarball(compressed))
+
+        tar = tarfile.open(fileobj=io.BytesIO(bytes(server.data)),
+                           mode='r:gz')
+        member = tar.getmember('disk.raw')
+        self.assertTrue(member.issparse())
+        self.assertEqual(member.size, len(raw))
+        self.assertEqual(tar.extractfile(member).read(), raw)
+
+
+if __name__ == '__main__':
+    unittest.main()
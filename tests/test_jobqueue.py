@@ -0,0 +1,241 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import mock
+import threading
+import unittest
+
+import fedimg.cancel
+import fedimg.jobqueue
+import fedimg.uploader
+
+
+class TestSQLiteQueue(unittest.TestCase):
+    """ This tests the SQLite queue of fedimg/jobqueue.py. """
+
+    def setUp(self):
+        self.queue = fedimg.jobqueue.SQLiteQueue(':memory:', attempts=2)
+        self.queue.put('ec2', 'a.raw.xz', 'ec2 a.raw.xz hvm gp2',
+                       {'compose_id': 'F26'}, 'abc')
+        self.queue.put('ftp', 'a.raw.xz', 'ftp a.raw.xz')
+        self.queue.put('ec2', 'b.raw.xz', 'ec2 b.raw.xz hvm gp2')
+
+    def test_lease(self):
+        job = self.queue.lease('w1', 60, ['ec2'])
+        self.assertEqual((job['id'], job['label'], job['compose'],
+                          job['checksum'], job['attempts']),
+                         (1, 'ec2 a.raw.xz hvm gp2', {'compose_id': 'F26'},
+                          'abc', 1))
+        # Leased jobs aren't handed out twice
+        self.assertEqual(self.queue.lease('w2', 60, ['ec2'])['id'], 3)
+        self.assertEqual(self.queue.lease('w2', 60, ['ec2']), None)
+        self.assertEqual(self.queue.lease('w2', 60, []), None)
+
+    def test_done(self):
+        job = self.queue.lease('w1', 60, ['ftp'])
+        # Only the worker holding the lease can finish the job
+        self.queue.done(job['id'], 'w2')
+        self.assertTrue(self.queue.renew(job['id'], 'w1', 60))
+        self.queue.done(job['id'], 'w1')
+        self.assertFalse(self.queue.renew(job['id'], 'w1', 60))
+
+    @mock.patch('fedimg.jobqueue.time.time')
+    def test_expired(self, time):
+        time.return_value = 1000
+        job = self.queue.lease('w1', 60, ['ftp'])
+
+        # Once the lease runs out, another worker gets the job, and the
+        # first one can't renew it anymore
+        time.return_value = 1061
+        again = self.queue.lease('w2', 60, ['ftp'])
+        self.assertEqual((again['id'], again['attempts']), (job['id'], 2))
+        self.assertFalse(self.queue.renew(job['id'], 'w1', 60))
+
+        # Tried too often
+        time.return_value = 1200
+        self.assertEqual(self.queue.lease('w3', 60, ['ftp']), None)
+        self.assertEqual(self.queue.dead(), [(job['id'], 'ftp a.raw.xz')])
+
+        # Kept for a while, then purged
+        self.assertEqual(self.queue.purge(100), 0)
+        time.return_value = 1300
+        self.assertEqual(self.queue.purge(100), 1)
+        self.assertEqual(self.queue.dead(), [])
+        self.assertEqual(len(self.queue.entries()), 2)
+
+    def test_remove(self):
+        job = self.queue.lease('w1', 60, ['ec2'])
+        self.assertEqual(self.queue.entries(), [
+            (1, 'a.raw.xz', True), (2, 'a.raw.xz', False),
+            (3, 'b.raw.xz', False)])
+        # Leased jobs are only removed when asked to, taking the lease
+        self.assertFalse(self.queue.remove(job['id'], pending_only=True))
+        self.assertTrue(self.queue.remove(3, pending_only=True))
+        self.assertTrue(self.queue.remove(job['id']))
+        self.assertFalse(self.queue.renew(job['id'], 'w1', 60))
+        self.assertEqual(self.queue.entries(), [(2, 'a.raw.xz', False)])
+
+    def test_release(self):
+        job = self.queue.lease('w1', 60, ['ec2'])
+        self.queue.release(job['id'], 'w1', {'copies': []})
+        again = self.queue.lease('w2', 60, ['ec2'])
+        self.assertEqual((again['id'], again['state'], again['attempts']),
+                         (job['id'], {'copies': []}, 1))
+
+
+class FakeJob(object):
+
+    def __init__(self, url, state=None):
+        self.file_name = url
+        self.cancel = None
+        self.state = state
+
+    def upload(self, compose_meta):
+        self.cancel.sleep(5)
+        return 0
+
+    def checkpoint(self):
+        return self.state
+
+
+class TestWorker(unittest.TestCase):
+    """ This tests the workers of fedimg/jobqueue.py. """
+
+    def setUp(self):
+        self.queue = fedimg.jobqueue.SQLiteQueue(':memory:')
+        self.started = threading.Event()
+        self.providers = {'ec2': self.jobs}
+        patchers = [
+            mock.patch('fedimg.services.get_providers',
+                       return_value=self.providers),
+            mock.patch('fedimg.PROVIDER_CONCURRENCY', {'ec2': 1}),
+            mock.patch('fedimg.uploader._groups', {}),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        self.worker = fedimg.jobqueue.Worker(self.queue, name='w1', lease=60,
+                                             poll=0.01)
+
+    def jobs(self, url):
+        self.started.set()
+        return [FakeJob(url, state={'copies': [url]})]
+
+    def test_slots(self):
+        self.queue.put('ec2', 'a.raw.xz', 'ec2 a.raw.xz')
+        self.queue.put('ec2', 'b.raw.xz', 'ec2 b.raw.xz')
+        self.queue.put('ftp', 'c.raw.xz', 'ftp c.raw.xz')
+        self.assertTrue(self.worker.take())
+        # One job at a time for ec2, and this worker doesn't run ftp jobs
+        self.assertFalse(self.worker.take())
+        self.worker.drain(grace=0.1)
+
+    def test_drain(self):
+        self.queue.put('ec2', 'a.raw.xz', 'ec2 a.raw.xz')
+        thread = threading.Thread(target=self.worker.run)
+        thread.start()
+        self.assertTrue(self.started.wait(5))
+
+        # Cut short, and handed back with the state to resume it from
+        self.assertTrue(self.worker.drain(grace=0.1))
+        thread.join(5)
+        job = self.queue.lease('w2', 60, ['ec2'])
+        self.assertEqual((job['label'], job['state'], job['attempts']),
+                         ('ec2 a.raw.xz', {'copies': ['a.raw.xz']}, 1))
+
+    def test_lease_lost(self):
+        self.queue.put('ec2', 'a.raw.xz', 'ec2 a.raw.xz')
+        self.worker.take()
+        self.assertTrue(self.started.wait(5))
+        self.queue.release(1, 'w1')
+        self.queue.lease('w2', 60, ['ec2'])
+
+        # The heartbeat finds out, and the job gives up without touching
+        # the other worker's lease
+        self.worker.stop()
+        self.worker._heartbeat()
+        self.assertTrue(self.worker._wait(5))
+        self.assertFalse(self.queue.renew(1, 'w1', 60))
+        self.assertTrue(self.queue.renew(1, 'w2', 60))
+
+    @mock.patch('fedimg.QUEUE_RETENTION', 60)
+    def test_purge(self):
+        self.queue = self.worker.queue = mock.Mock()
+        self.worker.purge()
+        self.worker.purge()
+        # At most once an hour
+        self.queue.purge.assert_called_once_with(60)
+
+
+class TestSupersede(unittest.TestCase):
+    """ This tests how jobs put on the queue supersede older builds. """
+
+    def setUp(self):
+        self.queue = fedimg.jobqueue.SQLiteQueue(':memory:')
+        patchers = [
+            mock.patch('fedimg.services.get_providers',
+                       return_value={'ec2': lambda url: [FakeJob(url)]}),
+            mock.patch('fedimg.jobqueue.get_queue',
+                       return_value=self.queue),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def urls(self):
+        return [url.split('-')[4] for id, url, leased
+                in self.queue.entries()]
+
+    def upload(self, date):
+        fedimg.uploader.upload(
+            ['Fedora-Cloud-Base-Rawhide-{0}.n.0.x86_64.raw.xz'.format(date)],
+            None)
+
+    @mock.patch('fedimg.SUPERSEDE', 'cancel')
+    def test_cancel(self):
+        self.upload('20170601')
+        self.queue.lease('w1', 60, ['ec2'])
+        self.upload('20170602')
+        self.assertEqual(self.urls(), ['20170602.n.0.x86_64.raw.xz'])
+        # Older builds than one queued aren't queued
+        self.upload('20170531')
+        self.assertEqual(self.urls(), ['20170602.n.0.x86_64.raw.xz'])
+
+    @mock.patch('fedimg.SUPERSEDE', 'queued')
+    def test_queued(self):
+        self.upload('20170601')
+        self.queue.lease('w1', 60, ['ec2'])
+        self.upload('20170602')
+        self.upload('20170603')
+        # The leased job is left to run
+        self.assertEqual(self.urls(), ['20170601.n.0.x86_64.raw.xz',
+                                       '20170603.n.0.x86_64.raw.xz'])
+
+    @mock.patch('fedimg.SUPERSEDE', 'none')
+    def test_none(self):
+        self.upload('20170601')
+        self.upload('20170602')
+        self.assertEqual(len(self.urls()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import mock
+import os
+import unittest
+
+import fedimg.ledger
+
+
+class TestLedger(unittest.TestCase):
+    """ This tests fedimg/ledger.py. """
+
+    def setUp(self):
+        self.ledger = fedimg.ledger.Ledger(':memory:')
+        patchers = [
+            mock.patch('fedimg.ledger.socket.gethostname',
+                       return_value='hub'),
+            mock.patch('fedimg.ledger.os.getpid', return_value=100),
+            mock.patch('fedimg.ledger.start_nonce', return_value=None),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_add_remove(self):
+        self.ledger.add('node', 'i-1', 'eu-west-1', 'Fedora-26')
+        self.ledger.add('volume', 'vol-1', 'eu-west-1', 'Fedora-26')
+        self.ledger.remove('i-1')
+        resources = self.ledger.resources()
+        self.assertEqual([(r['id'], r['kind'], r['owner'])
+                          for r in resources],
+                         [('vol-1', 'volume', 'hub:100')])
+
+    @mock.patch('fedimg.ledger.os.kill')
+    def test_leftovers(self, kill):
+        self.ledger.add('node', 'i-1', 'eu-west-1')
+        with mock.patch('fedimg.ledger.socket.gethostname',
+                        return_value='other'):
+            self.ledger.add('node', 'i-2', 'eu-west-1')
+
+        # This process is alive
+        self.assertEqual(self.ledger.leftovers(), [])
+
+        # Once it's gone, only its own resources are left over; those of
+        # other hosts can't be told apart from live ones
+        kill.side_effect = OSError(fedimg.ledger.errno.ESRCH, 'No process')
+        self.assertEqual([r['id'] for r in self.ledger.leftovers()],
+                         ['i-1'])
+        kill.assert_called_with(100, 0)
+
+    @mock.patch('fedimg.ledger.os.kill')
+    def test_reused_pid(self, kill):
+        """ A process that has been given the PID of a dead one isn't taken
+        for it. """
+        with mock.patch('fedimg.ledger.start_nonce', return_value='boot.1'):
+            self.ledger.add('node', 'i-1', 'eu-west-1')
+        self.assertEqual(self.ledger.resources()[0]['owner'],
+                         'hub:100:boot.1')
+        with mock.patch('fedimg.ledger.start_nonce', return_value='boot.1'):
+            self.assertEqual(self.ledger.leftovers(), [])
+        with mock.patch('fedimg.ledger.start_nonce', return_value='boot.9'):
+            self.assertEqual([r['id'] for r in self.ledger.leftovers()],
+                             ['i-1'])
+
+    def test_checkpoints(self):
+        self.ledger.checkpoint('ec2', 'a.raw.xz', 'ec2 a.raw.xz hvm gp2',
+                               {'compose_id': 'F26'}, 'abc')
+        self.ledger.checkpoint('ec2', 'a.raw.xz', 'ec2 a.raw.xz hvm std',
+                               state={'copies': [['us-east-1', 'ami-1']]})
+        checkpoints = self.ledger.take_checkpoints()
+        self.assertEqual([(c['label'], c['compose'], c['checksum'],
+                           c['state']) for c in checkpoints], [
+            ('ec2 a.raw.xz hvm gp2', {'compose_id': 'F26'}, 'abc', None),
+            ('ec2 a.raw.xz hvm std', None, None,
+             {'copies': [['us-east-1', 'ami-1']]}),
+        ])
+        # Taken checkpoints aren't picked up twice
+        self.assertEqual(self.ledger.take_checkpoints(), [])
+
+    @mock.patch('fedimg.ledger.dead', return_value=True)
+    def test_reclaim(self, dead):
+        self.ledger.add('node', 'i-1', 'eu-west-1')
+        self.ledger.add('volume', 'vol-1', 'eu-west-1')
+        self.ledger.add('node', 'i-2', 'nowhere-1')
+        driver = mock.Mock()
+        driver.return_value.list_nodes.return_value = [mock.Mock()]
+        driver.return_value.list_volumes.return_value = [
+            mock.Mock(id='vol-1'), mock.Mock(id='vol-2')]
+        amis = [{'region': 'eu-west-1', 'driver': driver}]
+
+        with mock.patch('fedimg.ledger.get_aws_amis', return_value=amis):
+            reclaimed = fedimg.ledger.reclaim(self.ledger)
+
+        self.assertEqual(reclaimed, ['i-1', 'vol-1'])
+        conn = driver.return_value
+        conn.list_nodes.assert_called_with(ex_node_ids=['i-1'])
+        conn.destroy_node.assert_called_with(
+            conn.list_nodes.return_value[0])
+        conn.destroy_volume.assert_called_once_with(
+            conn.list_volumes.return_value[0])
+        # Resources in regions fedimg doesn't know are kept
+        self.assertEqual([r['id'] for r in self.ledger.resources()],
+                         ['i-2'])
+
+    def test_reclaim_deploying(self):
+        """ A node left being deployed is found by its tag, and the volume
+        it keeps is reclaimed once its owner is gone too. """
+        self.ledger.add('deploy', 'abc', 'eu-west-1', 'Fedora-26')
+        driver = mock.Mock()
+        driver.return_value.list_nodes.return_value = [mock.Mock(extra={
+            'block_device_mapping': [
+                {'ebs': {'volume_id': 'vol-1', 'delete': 'true'}},
+                {'ebs': {'volume_id': 'vol-2', 'delete': 'false'}}]})]
+        amis = [{'region': 'eu-west-1', 'driver': driver}]
+
+        with mock.patch('fedimg.ledger.get_aws_amis', return_value=amis):
+            with mock.patch('fedimg.ledger.dead', return_value=True):
+                reclaimed = fedimg.ledger.reclaim(self.ledger)
+
+        self.assertEqual(reclaimed, ['abc'])
+        conn = driver.return_value
+        conn.list_nodes.assert_called_with(
+            ex_filters={'tag:fedimg-deploy': 'abc'})
+        self.assertTrue(conn.destroy_node.called)
+        self.assertEqual([(r['kind'], r['id'], r['build'])
+                          for r in self.ledger.resources()],
+                         [('volume', 'vol-2', 'Fedora-26')])
+
+
+class TestStartNonce(unittest.TestCase):
+    """ This tests how fedimg/ledger.py tells processes apart. """
+
+    def test_start_nonce(self):
+        if not os.path.exists('/proc/self/stat'):
+            raise unittest.SkipTest('There is no /proc here')
+        nonce = fedimg.ledger.start_nonce(os.getpid())
+        self.assertTrue(nonce)
+        self.assertEqual(fedimg.ledger.start_nonce(os.getpid()), nonce)
+        self.assertNotEqual(fedimg.ledger.start_nonce(1), nonce)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import imp
+import mock
+import os
+import unittest
+
+list_the_amis = imp.load_source('list_the_amis', os.path.join(
+    os.path.dirname(__file__), '..', 'bin', 'list-the-amis.py'))
+
+HOUR = 60 * 60
+
+
+def message(msg_id, timestamp):
+    return {'msg_id': msg_id, 'timestamp': timestamp}
+
+
+class TestListTheAmis(unittest.TestCase):
+    """ This tests the caching in bin/list-the-amis.py. """
+
+    def cache(self, start, end, messages=()):
+        return {
+            'messages': dict((m['msg_id'], m) for m in messages),
+            'start': start,
+            'end': end,
+        }
+
+    def test_empty_cache(self):
+        cache = list_the_amis.load_cache(None)
+        ranges = list_the_amis.missing_ranges(cache, 0, 100 * HOUR)
+        self.assertEqual(ranges, [(0, 100 * HOUR)])
+
+    def test_newer_than_cache(self):
+        cache = self.cache(0, 50 * HOUR)
+        ranges = list_the_amis.missing_ranges(cache, 10 * HOUR, 100 * HOUR)
+        self.assertEqual(ranges, [(49 * HOUR, 100 * HOUR)])
+
+    def test_older_than_cache(self):
+        cache = self.cache(20 * HOUR, 50 * HOUR)
+        ranges = list_the_amis.missing_ranges(cache, 10 * HOUR, 100 * HOUR)
+        self.assertEqual(ranges, [(10 * HOUR, 20 * HOUR),
+                                  (49 * HOUR, 100 * HOUR)])
+
+    def test_window_after_cache(self):
+        """ A gap between the cache and the window is fetched too. """
+        cache = self.cache(0, 10 * HOUR)
+        ranges = list_the_amis.missing_ranges(cache, 20 * HOUR, 100 * HOUR)
+        self.assertEqual(ranges, [(20 * HOUR, 100 * HOUR)])
+
+    def test_window_before_cache(self):
+        cache = self.cache(50 * HOUR, 100 * HOUR)
+        ranges = list_the_amis.missing_ranges(cache, 0, 40 * HOUR)
+        self.assertEqual(ranges, [(0, 40 * HOUR)])
+
+    def test_update_keeps_newest_timestamp(self):
+        """ The cache ends at the newest message, not when it was run. """
+        cache = self.cache(0, 10 * HOUR, [message('a', 5 * HOUR)])
+        list_the_amis.update_cache(cache, 0, [message('b', 30 * HOUR)])
+        self.assertEqual(cache['start'], 0)
+        self.assertEqual(cache['end'], 30 * HOUR)
+        self.assertEqual(sorted(cache['messages']), ['a', 'b'])
+
+    def test_update_prunes(self):
+        cache = self.cache(0, 10 * HOUR, [message('a', 5 * HOUR)])
+        list_the_amis.update_cache(cache, 8 * HOUR, [message('b', 9 * HOUR)])
+        self.assertEqual(cache['start'], 8 * HOUR)
+        self.assertEqual(list(cache['messages']), ['b'])
+
+    def test_update_without_messages(self):
+        cache = list_the_amis.load_cache(None)
+        list_the_amis.update_cache(cache, 8 * HOUR, [])
+        self.assertEqual(cache['end'], 8 * HOUR)
+
+    def test_late_message(self):
+        """ A message sent before the newest cached one but ingested after
+        the last run is still picked up. """
+        late = message('late', 95 * HOUR + 30 * 60)
+        args = mock.Mock(days=1, cache=None)
+        cache = self.cache(76 * HOUR, 96 * HOUR, [message('a', 96 * HOUR)])
+        with mock.patch.object(list_the_amis, 'load_cache',
+                               return_value=cache), \
+                mock.patch.object(list_the_amis, 'get_range',
+                                  return_value=[late]) as get_range, \
+                mock.patch.object(list_the_amis, 'desirable',
+                                  return_value=True), \
+                mock.patch.object(list_the_amis.time, 'time',
+                                  return_value=100 * HOUR):
+            messages = list_the_amis.get_messages(args)
+        get_range.assert_called_once_with(95 * HOUR, 100 * HOUR)
+        self.assertEqual([m['msg_id'] for m in messages], ['a', 'late'])
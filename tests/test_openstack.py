@@ -0,0 +1,245 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import BaseHTTPServer
+import json
+import SocketServer
+import subprocess
+import threading
+import unittest
+
+import mock
+
+import fedimg.services.hp
+import fedimg.services.openstack
+import fedimg.services.rackspace
+
+
+class StubGlance(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Just enough of Keystone v2 and Glance v2 to register images with.
+    Image uploads to the regions in `fail` are refused. """
+
+    daemon_threads = True
+
+    def __init__(self, regions, fail=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubGlanceHandler)
+        self.regions = regions
+        self.fail = set(fail)
+        self.images = {}
+        self.polls = {}
+        self.auth = None
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+
+class StubGlanceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(';')[0], 16)
+            if not size:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _region(self):
+        return self.path.split('/')[1]
+
+    def do_POST(self):
+        body = json.loads(self._body())
+        if self.path == '/v2.0/tokens':
+            self.server.auth = body['auth']
+            endpoints = [{'region': r.upper(),
+                          'publicURL': '{0}/{1}'.format(self.server.url, r)}
+                         for r in self.server.regions]
+            self._reply(200, {'access': {
+                'token': {'id': 'sometoken'},
+                'serviceCatalog': [{'type': 'image',
+                                    'endpoints': endpoints}]}})
+            return
+
+        with self.server.lock:
+            image_id = 'image-{0}'.format(len(self.server.images))
+            self.server.images[image_id] = {'region': self._region(),
+                                            'name': body['name'],
+                                            'visibility': body['visibility'],
+                                            'data': None}
+        self._reply(201, {'id': image_id})
+
+    def do_PUT(self):
+        image_id = self.path.split('/')[-2]
+        data = self._body()
+        if self._region() in self.server.fail:
+            self._reply(500)
+            return
+        self.server.images[image_id]['data'] = data
+        self._reply(204)
+
+    def do_PATCH(self):
+        image = self.server.images[self.path.split('/')[-1]]
+        if self.headers.get('X-Auth-Token') != 'sometoken':
+            self._reply(401)
+            return
+        for change in json.loads(self._body()):
+            image[change['path'].strip('/')] = change['value']
+        self._reply(200)
+
+    def do_GET(self):
+        image_id = self.path.split('/')[-1]
+        with self.server.lock:
+            polls = self.server.polls.get(image_id, 0) + 1
+            self.server.polls[image_id] = polls
+        self._reply(200, {'id': image_id,
+                          'status': 'active' if polls > 2 else 'saving'})
+
+    def do_DELETE(self):
+        del self.server.images[self.path.split('/')[-1]]
+        self._reply(204)
+
+
+class TestOpenStack(unittest.TestCase):
+    """ This tests fedimg/services/openstack.py. """
+
+    raw_url = 'https://somepage.org/Fedora-Cloud-Base-25.x86_64.raw.xz'
+
+    def setUp(self):
+        self.raw = b''.join(b'%07d\n' % i for i in range(300000))
+        xz = subprocess.Popen(['xz', '--stdout'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+        compressed = xz.communicate(self.raw)[0]
+        chunks = [compressed[i:i + 4096]
+                  for i in range(0, len(compressed), 4096)]
+
+        patchers = [
+            mock.patch('fedimg.stream.iter_url',
+                       side_effect=lambda url: iter(chunks)),
+            mock.patch('fedimg.services.openstack.sleep'),
+            mock.patch('fedimg.messenger.message'),
+        ]
+        self.iter_url, self.sleep, self.message = [p.start()
+                                                   for p in patchers]
+        for p in patchers:
+            self.addCleanup(p.stop)
+
+    def _serve(self, regions, fail=()):
+        server = StubGlance(regions, fail)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _statuses(self):
+        return sorted((c[0][2], c[0][3]) for c in self.message.call_args_list)
+
+    def test_rackspace_upload(self):
+        server = self._serve(['dfw', 'ord', 'iad', 'lon', 'syd', 'hkg'])
+        service = fedimg.services.rackspace.RackspaceService(self.raw_url)
+        with mock.patch('fedimg.RACKSPACE_AUTH_URL', server.url + '/v2.0'):
+            result = service.upload({'compose_id': 'Fedora-25'})
+
+        self.assertEqual(result, 0)
+        # The image was downloaded once, for all six regions
+        self.assertEqual(self.iter_url.call_count, 1)
+        self.assertEqual(len(server.images), 6)
+        for image in server.images.values():
+            self.assertEqual(image['name'], 'Fedora-Cloud-Base-25.x86_64')
+            self.assertEqual(image['data'], self.raw)
+            self.assertEqual(image['visibility'], 'public')
+        self.assertTrue(self.sleep.called)
+        completed = [s for s in self._statuses() if s[1] == 'completed']
+        self.assertEqual(len(completed), 6)
+        self.assertIn(('Rackspace (dfw)', 'completed'), completed)
+
+    def test_failed_region(self):
+        server = self._serve(['region-b.geo-1', 'region-a.geo-1'],
+                             fail=['region-a.geo-1'])
+        service = fedimg.services.hp.HPService(self.raw_url)
+        service.regions = ['region-a.geo-1', 'region-b.geo-1', 'nowhere']
+        with mock.patch('fedimg.HP_AUTH_URL', server.url + '/v2.0'), \
+                mock.patch('fedimg.HP_USER', 'someuser'), \
+                mock.patch('fedimg.DELETE_IMAGES_ON_FAILURE', True):
+            result = service.upload(None)
+
+        self.assertEqual(result, 1)
+        # The failed image was deleted; the other one made it
+        self.assertEqual([i['region'] for i in server.images.values()],
+                         ['region-b.geo-1'])
+        self.assertEqual(server.images.values()[0]['data'], self.raw)
+        self.assertEqual(server.auth['passwordCredentials']['username'],
+                         'someuser')
+        self.assertEqual(self._statuses(), [
+            ('HP (nowhere)', 'failed'),
+            ('HP (nowhere)', 'started'),
+            ('HP (region-a.geo-1)', 'failed'),
+            ('HP (region-a.geo-1)', 'started'),
+            ('HP (region-b.geo-1)', 'completed'),
+            ('HP (region-b.geo-1)', 'started'),
+        ])
+
+    def test_failed_region_stays_private(self):
+        """ An image whose upload failed is never made public, even if it
+        can't be deleted. """
+        server = self._serve(['region-a.geo-1'], fail=['region-a.geo-1'])
+        service = fedimg.services.hp.HPService(self.raw_url)
+        service.regions = ['region-a.geo-1']
+        with mock.patch('fedimg.HP_AUTH_URL', server.url + '/v2.0'), \
+                mock.patch('fedimg.DELETE_IMAGES_ON_FAILURE', False):
+            result = service.upload(None)
+
+        self.assertEqual(result, 1)
+        self.assertEqual([i['visibility'] for i in server.images.values()],
+                         ['private'])
+
+    def test_session_per_thread(self):
+        service = fedimg.services.hp.HPService(self.raw_url)
+        service.token = 'sometoken'
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(service.session))
+        thread.start()
+        thread.join()
+        self.assertIs(service.session, service.session)
+        self.assertIsNot(service.session, sessions[0])
+        self.assertEqual(sessions[0].headers['X-Auth-Token'], 'sometoken')
+
+
+if __name__ == '__main__':
+    unittest.main()
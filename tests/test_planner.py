@@ -0,0 +1,175 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import fedimg.planner
+import fedimg.services.ec2
+import fedimg.uploader
+
+REGIONS = ['us-east-1', 'ap-southeast-1', 'sa-east-1']
+
+
+def event(name, seconds, **args):
+    return {'name': name, 'ph': 'X', 'ts': 0, 'dur': seconds * 1000000,
+            'pid': 1, 'tid': 1, 'args': args}
+
+
+class FakeJob(object):
+
+    def upload(self, compose_meta):
+        return 0
+
+
+class TestPlanner(unittest.TestCase):
+    """ This tests fedimg/planner.py. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_trace(self, name, events):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+    def test_durations(self):
+        self.write_trace('a.json', [
+            event('copy', 100, region='sa-east-1'),
+            event('copy', 300, region='sa-east-1'),
+            event('copy', 1000, region='ap-southeast-1'),
+            event('job', 60, job='gce Fedora.raw.xz'),
+            {'name': 'thread_name', 'ph': 'M', 'args': {'name': 'main'}},
+        ])
+        with open(os.path.join(self.directory, 'b.json'), 'w') as f:
+            f.write('{not json')
+
+        durations = fedimg.planner.Durations.load(self.directory)
+        self.assertEqual(durations.get('copy', 'sa-east-1'), 200)
+        # Regions that never ran a stage get its median anywhere
+        self.assertEqual(durations.get('copy', 'eu-west-1'), 300)
+        self.assertEqual(durations.get('job', 'gce'), 60)
+        self.assertEqual(durations.get('test', 'sa-east-1'),
+                         fedimg.planner.DEFAULT_DURATIONS['test'])
+
+    def test_api_calls(self):
+        self.assertEqual(fedimg.planner.api_calls('register'), 1)
+        self.assertEqual(fedimg.planner.api_calls('copy', 100), 1 + 5)
+        self.assertEqual(fedimg.planner.api_calls(
+            'build snapshot', 30, wait='take snapshot'), 9 + 3)
+
+    def test_plan_jobs(self):
+        durations = fedimg.planner.Durations(
+            {('job', 'gce'): [100], ('job', 'ftp'): [10]})
+        jobs = [('gce', 'gce a', FakeJob()), ('gce', 'gce b', FakeJob()),
+                ('gce', 'gce c', FakeJob()), ('ftp', 'ftp a', FakeJob())]
+
+        plan = fedimg.planner.plan_jobs(jobs, durations,
+                                        concurrency={'gce': 2})
+        starts = [(e['job'], e['start'], e['end']) for e in plan['jobs']]
+        self.assertEqual(starts, [('gce a', 0, 100), ('gce b', 0, 100),
+                                  ('gce c', 100, 200), ('ftp a', 0, 10)])
+        self.assertEqual(plan['seconds'], 200)
+        self.assertTrue(fedimg.planner.format_plan(plan).endswith(
+            '4 jobs, ~0 API calls, done in about 0h03m'))
+
+    @mock.patch('fedimg.services.get_providers')
+    def test_uploader_plan(self, get_providers):
+        get_providers.return_value = {'fake': lambda url: [FakeJob()]}
+        plan = fedimg.uploader.plan(['a.raw.xz', 'b.raw.xz'],
+                                    fedimg.planner.Durations())
+        self.assertEqual([e['provider'] for e in plan['jobs']],
+                         ['fake', 'fake'])
+
+
+@mock.patch('fedimg.benchmark.best_util_size',
+            return_value=('c4.large', None))
+@mock.patch('fedimg.AWS_REGIONAL_TESTS', 0)
+class TestEC2Plan(unittest.TestCase):
+    """ This tests how EC2Service plans its upload process. """
+
+    def setUp(self):
+        amis = [{'region': region, 'arch': 'x86_64', 'driver': None}
+                for region in REGIONS]
+        self.durations = fedimg.planner.Durations({
+            ('build snapshot', 'us-east-1'): [1000],
+            ('build snapshot', 'ap-southeast-1'): [1200],
+            ('test', 'us-east-1'): [300],
+            ('copy', 'ap-southeast-1'): [2000],
+            ('copy', 'sa-east-1'): [500],
+        })
+        url = 'https://somepage.org/Fedora-Cloud-Base-25-1.3.x86_64.raw.xz'
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=amis), \
+                mock.patch('fedimg.AWS_REPLICATE', 'image'):
+            self.service = fedimg.services.ec2.EC2Service(
+                url, tester=mock.Mock(), quota=mock.Mock())
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=amis), \
+                mock.patch('fedimg.AWS_REPLICATE', 'snapshot'):
+            self.shared = fedimg.services.ec2.jobs(url)
+
+    def test_plan(self, best_util_size):
+        plan = self.service.plan(self.durations)
+        stages = [(s['stage'], s['region']) for s in plan['stages']]
+        self.assertEqual(stages, [('build snapshot', 'us-east-1'),
+                                  ('test', 'us-east-1'),
+                                  ('copy', 'ap-southeast-1'),
+                                  ('copy', 'sa-east-1')])
+        self.assertEqual(plan['stages'][0]['instance_type'], 'c4.large')
+        self.assertEqual(
+            [i['name'] for i in plan['images']],
+            ['Fedora-Cloud-Base-25-1.3.x86_64-{0}-HVM-standard-0'.format(r)
+             for r in REGIONS])
+        # The slowest copy is the last thing to finish
+        self.assertEqual(plan['seconds'], 1000 + 2000)
+        # 9 + 30 polls to build, 1 to register, 3 to test, 1 + 100 and
+        # 1 + 25 to copy, 3 to publish
+        self.assertEqual(plan['api_calls'], 173)
+
+    @mock.patch('fedimg.AWS_ORIGINS', ['us-east-1', 'ap-southeast-1'])
+    def test_plan_origins(self, best_util_size):
+        plan = self.service.plan(self.durations)
+        copies = [(s['region'], s['source']) for s in plan['stages']
+                  if s['stage'] == 'copy']
+        self.assertEqual(copies, [('sa-east-1', 'us-east-1')])
+        # The copy from the first origin finishes after the second origin
+        # is built and the first one tested
+        self.assertEqual(plan['seconds'], 1000 + 500)
+
+    def test_plan_shared(self, best_util_size):
+        seen = set()
+        first, second = [job.plan(self.durations, seen)
+                         for job in self.shared[:2]]
+        self.assertFalse(any(s.get('shared') for s in first['stages']))
+        self.assertTrue(all(s['shared'] for s in second['stages']
+                            if s['stage'] != 'test'))
+        self.assertTrue(second['api_calls'] < first['api_calls'])
+
+
+if __name__ == '__main__':
+    unittest.main()
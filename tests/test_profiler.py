@@ -0,0 +1,118 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import os
+import shutil
+import signal
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+import fedimg.profiler
+
+
+def busy_worker(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+class TestProfiler(unittest.TestCase):
+    """ This tests fedimg/profiler.py. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        fedimg.profiler._profiler = None
+
+    def tearDown(self):
+        profiler = fedimg.profiler._profiler
+        if profiler is not None:
+            profiler.stop()
+        fedimg.profiler._profiler = None
+        shutil.rmtree(self.directory)
+
+    def test_collapse(self):
+        stack = fedimg.profiler.collapse(sys._getframe())
+        frames = stack.split(';')
+        self.assertTrue(
+            frames[-1].startswith('test_collapse (test_profiler.py'))
+        self.assertTrue(len(frames) > 1)
+
+    def test_sample_all_threads(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_worker, args=(stop,),
+                                  name='upload-worker')
+        worker.start()
+        try:
+            profiler = fedimg.profiler.Profiler(interval=0.001)
+            profiler.start()
+            time.sleep(0.1)
+            samples = profiler.stop()
+        finally:
+            stop.set()
+            worker.join()
+
+        self.assertFalse(profiler.active)
+        stacks = [s for s in samples if s.startswith('upload-worker;')]
+        self.assertTrue(stacks)
+        self.assertTrue(any('busy_worker' in s for s in stacks))
+        # The profiler doesn't sample itself
+        self.assertFalse(any(s.startswith('fedimg-profiler;')
+                             for s in samples))
+
+        out = StringIO.StringIO()
+        profiler.write(out)
+        for line in out.getvalue().splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertEqual(samples[stack], int(count))
+
+    def test_toggle(self):
+        with mock.patch('fedimg.PROFILE_DIR', self.directory), \
+                mock.patch('fedimg.PROFILE_INTERVAL', 0.001):
+            self.assertEqual(fedimg.profiler.toggle(), None)
+            self.assertTrue(fedimg.profiler.get_profiler().active)
+            time.sleep(0.05)
+            path = fedimg.profiler.toggle()
+
+        self.assertFalse(fedimg.profiler.get_profiler().active)
+        self.assertEqual(os.path.dirname(path), self.directory)
+        with open(path) as f:
+            self.assertTrue(f.read().strip())
+
+    def test_install(self):
+        old = signal.getsignal(signal.SIGUSR2)
+        try:
+            with mock.patch('fedimg.profiler.toggle') as toggle:
+                self.assertTrue(fedimg.profiler.install('SIGUSR2'))
+                os.kill(os.getpid(), signal.SIGUSR2)
+                time.sleep(0.01)
+            self.assertEqual(toggle.call_count, 1)
+            self.assertFalse(fedimg.profiler.install('SIGNOPE'))
+        finally:
+            signal.signal(signal.SIGUSR2, old)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import threading
+import time
+import unittest
+
+import mock
+
+import fedimg.quota
+
+
+class TestQuota(unittest.TestCase):
+    """ This tests fedimg/quota.py. """
+
+    def setUp(self):
+        self.accountant = fedimg.quota.Accountant(
+            'instances=2 eu-west-1:instances=1 copies=3')
+
+    def test_parse_limits(self):
+        limits = fedimg.quota.parse_limits('instances=2 eu-west-1:copies=5')
+        self.assertEqual(limits[None]['instances'], 2)
+        self.assertEqual(limits[None]['copies'], 50)
+        self.assertEqual(limits['eu-west-1'], {'copies': 5})
+        self.assertRaises(ValueError, fedimg.quota.parse_limits, 'cpus=2')
+
+    def test_limit(self):
+        self.assertEqual(self.accountant.limit('eu-west-1', 'instances'), 1)
+        self.assertEqual(self.accountant.limit('us-east-1', 'instances'), 2)
+        self.assertEqual(self.accountant.limit('eu-west-1', 'copies'), 3)
+
+    def _acquire_later(self, region, **amounts):
+        acquired = threading.Event()
+
+        def acquire():
+            self.accountant.acquire(region, **amounts)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.daemon = True
+        thread.start()
+        return acquired
+
+    def test_wait_for_capacity(self):
+        self.accountant.acquire('us-east-1', instances=1, volumes=2)
+        self.accountant.acquire('us-east-1', instances=1, volumes=2)
+        self.accountant.acquire('eu-west-1', instances=1)
+
+        waiting = self._acquire_later('us-east-1', instances=1, volumes=2)
+        time.sleep(0.1)
+        self.assertFalse(waiting.is_set())
+        self.assertEqual(self.accountant.usage('us-east-1')['instances'], 2)
+
+        # Releasing capacity in another region doesn't help
+        self.accountant.release('eu-west-1', instances=1)
+        time.sleep(0.1)
+        self.assertFalse(waiting.is_set())
+
+        self.accountant.release('us-east-1', instances=1, volumes=2)
+        self.assertTrue(waiting.wait(5))
+        self.assertEqual(self.accountant.usage('us-east-1'),
+                         {'instances': 2, 'volumes': 4, 'snapshots': 0,
+                          'copies': 0})
+
+    def test_reserve(self):
+        with self.accountant.reserve('eu-west-1', instances=1):
+            waiting = self._acquire_later('eu-west-1', instances=1)
+            time.sleep(0.1)
+            self.assertFalse(waiting.is_set())
+        self.assertTrue(waiting.wait(5))
+
+    def test_over_limit(self):
+        # A reservation bigger than the limit still runs on its own
+        self.accountant.acquire('us-east-1', copies=5)
+        self.assertEqual(self.accountant.usage('us-east-1')['copies'], 5)
+
+    @mock.patch('fedimg.quota.time.sleep')
+    def test_retry(self, sleep):
+        func = mock.Mock(side_effect=[
+            Exception('InstanceLimitExceeded: You have requested more'),
+            'node'])
+        self.assertEqual(fedimg.quota.retry(func, size='m1.xlarge'), 'node')
+        func.assert_called_with(size='m1.xlarge')
+        self.assertEqual(sleep.call_count, 1)
+
+        func = mock.Mock(side_effect=Exception('InvalidAMIID.NotFound'))
+        self.assertRaises(Exception, fedimg.quota.retry, func)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import datetime
+import mock
+import unittest
+
+from libcloud.compute.types import NodeState
+
+import fedimg.reaper
+
+OLD = datetime.datetime.utcnow() - datetime.timedelta(hours=3)
+NEW = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+
+
+def resource(id, tags=None, **extra):
+    extra['tags'] = tags or {}
+    return mock.Mock(id=id, extra=extra, created=extra.get('created'))
+
+
+class TestReaper(unittest.TestCase):
+    """ This tests fedimg/reaper.py. """
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        amis = [{'region': 'us-east-1', 'arch': 'x86_64',
+                 'driver': lambda *args: self.driver},
+                {'region': 'us-east-1', 'arch': 'i386',
+                 'driver': lambda *args: self.driver}]
+        with mock.patch('fedimg.reaper.get_aws_amis', return_value=amis):
+            self.reaper = fedimg.reaper.Reaper(max_age=7200)
+
+        launch = OLD.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        util = resource('i-old', {'build': 'F25'}, launch_time=launch)
+        util.name = 'Fedimg AMI builder'
+        util.state = NodeState.RUNNING
+        young = resource('i-new', {'build': 'F25'},
+                         launch_time=NEW.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+        young.name = 'Fedimg AMI tester'
+        young.state = NodeState.RUNNING
+        other = resource('i-other', {'build': 'x'}, launch_time=launch)
+        other.name = 'somebody else'
+        other.state = NodeState.RUNNING
+        self.driver.list_nodes.return_value = [util, young, other]
+
+        self.driver.list_volumes.return_value = [
+            resource('vol-old', {'build': 'F25'}, state='available',
+                     create_time=OLD),
+            resource('vol-used', {'build': 'F25'}, state='in-use',
+                     create_time=OLD),
+        ]
+
+        image = mock.Mock(extra={'block_device_mapping': [
+            {'ebs': {'snapshot_id': 'snap-used'}}]})
+        self.driver.list_images.return_value = [image]
+        self.driver.list_snapshots.return_value = [
+            resource('snap-old', {'build': 'F25'}, state='completed',
+                     created=OLD),
+            resource('snap-used', {'build': 'F25'}, state='completed',
+                     created=OLD),
+            resource('snap-untagged', state='completed', created=OLD),
+        ]
+
+    def test_reap(self):
+        reaped = self.reaper.reap()
+        self.assertEqual(sorted(reaped), [
+            ('us-east-1', 'node', 'i-old'),
+            ('us-east-1', 'snapshot', 'snap-old'),
+            ('us-east-1', 'volume', 'vol-old'),
+        ])
+        self.assertEqual(self.driver.destroy_node.call_count, 1)
+        self.assertEqual(self.driver.destroy_volume.call_count, 1)
+        self.assertEqual(self.driver.destroy_volume_snapshot.call_count, 1)
+
+    def test_dry_run(self):
+        self.reaper.dry_run = True
+        self.assertEqual(len(self.reaper.reap()), 3)
+        self.assertFalse(self.driver.destroy_node.called)
+        self.assertFalse(self.driver.destroy_volume.called)
+        self.assertFalse(self.driver.destroy_volume_snapshot.called)
+
+    def test_no_regions(self):
+        with mock.patch('fedimg.reaper.get_aws_amis', return_value=[]):
+            reaper = fedimg.reaper.Reaper(max_age=7200)
+        self.assertEqual(reaper.reap(), [])
+
+
+class Stop(Exception):
+    pass
+
+
+class TestSchedule(unittest.TestCase):
+    """ This tests the reaper thread of fedimg/reaper.py. """
+
+    @mock.patch('fedimg.reaper.Reaper')
+    @mock.patch('fedimg.reaper.threading.Thread')
+    @mock.patch('fedimg.reaper.time.sleep')
+    def test_failed_run(self, sleep, thread, reaper):
+        # The third wait ends the loop
+        sleep.side_effect = [None, None, Stop()]
+        reaper.return_value.reap.side_effect = [Exception('boom'), []]
+        fedimg.reaper.schedule(60)
+        loop = thread.call_args[1]['target']
+        self.assertRaises(Stop, loop)
+        # The run after the one that failed still happened
+        self.assertEqual(reaper.return_value.reap.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
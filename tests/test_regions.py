@@ -0,0 +1,134 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import unittest
+
+import mock
+
+import fedimg.regions
+import fedimg.services.ec2
+
+REGIONS = ['us-east-1', 'ap-southeast-1', 'ap-southeast-2', 'sa-east-1',
+           'eu-west-1']
+
+
+class TestRegions(unittest.TestCase):
+    """ This tests fedimg/regions.py. """
+
+    def test_parse_distances(self):
+        distances = fedimg.regions.parse_distances(
+            'sa-east-1:us-east-1=500 us-east-1:mars-1=9000')
+        self.assertEqual(
+            fedimg.regions.distance('us-east-1', 'sa-east-1', distances),
+            500)
+        self.assertEqual(
+            fedimg.regions.distance('mars-1', 'us-east-1', distances), 9000)
+
+    def test_distance(self):
+        distances = fedimg.regions.DEFAULT_DISTANCES
+        self.assertEqual(
+            fedimg.regions.distance('eu-west-1', 'eu-west-1', distances), 0)
+        self.assertEqual(
+            fedimg.regions.distance('eu-central-1', 'eu-west-1', distances),
+            25)
+        self.assertEqual(
+            fedimg.regions.distance('eu-west-1', 'mars-1', distances), None)
+
+    def test_nearest(self):
+        distances = fedimg.regions.DEFAULT_DISTANCES
+        origins = ['us-east-1', 'ap-southeast-1']
+        self.assertEqual(fedimg.regions.nearest('ap-southeast-2', origins,
+                                                distances), 'ap-southeast-1')
+        self.assertEqual(fedimg.regions.nearest('sa-east-1', origins,
+                                                distances), 'us-east-1')
+        # Unknown regions go to the first origin
+        self.assertEqual(fedimg.regions.nearest('mars-1', origins,
+                                                distances), 'us-east-1')
+
+
+class TestOrigins(unittest.TestCase):
+    """ This tests how EC2Service copies from several origins. """
+
+    def setUp(self):
+        amis = [{'region': region, 'arch': 'x86_64', 'driver': None}
+                for region in REGIONS]
+        with mock.patch('fedimg.services.ec2.get_aws_amis',
+                        return_value=amis):
+            self.service = fedimg.services.ec2.EC2Service(
+                'https://somepage.org/Fedora-Cloud-Base-25-1.3.x86_64.raw.xz',
+                tester=mock.Mock(), quota=mock.Mock())
+        self.service.images = ['ami-us']
+        self.service._copy_to = mock.Mock()
+
+    def _copies(self):
+        return sorted((args[0]['region'], args[1], args[2])
+                      for args, kwargs in self.service._copy_to.call_args_list)
+
+    @mock.patch('fedimg.AWS_ORIGINS', ['ap-southeast-1', 'us-east-1'])
+    def test_origin_amis(self):
+        regions = [a['region'] for a in self.service._origin_amis()]
+        self.assertEqual(regions, ['ap-southeast-1', 'us-east-1'])
+
+    def test_single_origin(self):
+        origins = self.service._origin_amis()
+        self.service._copy_images(None, origins)
+        self.assertEqual(self._copies(), [
+            ('ap-southeast-1', ['ami-us'], 'us-east-1'),
+            ('ap-southeast-2', ['ami-us'], 'us-east-1'),
+            ('eu-west-1', ['ami-us'], 'us-east-1'),
+            ('sa-east-1', ['ami-us'], 'us-east-1'),
+        ])
+
+    def test_nearest_origin(self):
+        origins = self.service.util_amis[:2]
+        result = mock.Mock()
+        result.get.return_value = ['ami-ap']
+        self.service.origin_builds['ap-southeast-1'] = (origins[1], result)
+
+        self.service._copy_images(None, origins)
+
+        self.assertEqual(self._copies(), [
+            ('ap-southeast-2', ['ami-ap'], 'ap-southeast-1'),
+            ('eu-west-1', ['ami-us'], 'us-east-1'),
+            ('sa-east-1', ['ami-us'], 'us-east-1'),
+        ])
+        # The origin's own image is handled like a copy
+        self.assertEqual(self.service.copies, [(origins[1], 'ami-ap')])
+
+    def test_failed_origin(self):
+        origins = self.service.util_amis[:2]
+        result = mock.Mock()
+        result.get.side_effect = Exception('boom')
+        self.service.origin_builds['ap-southeast-1'] = (origins[1], result)
+
+        self.service._copy_images(None, origins)
+
+        self.assertEqual(self._copies(), [
+            ('ap-southeast-1', ['ami-us'], 'us-east-1'),
+            ('ap-southeast-2', ['ami-us'], 'us-east-1'),
+            ('eu-west-1', ['ami-us'], 'us-east-1'),
+            ('sa-east-1', ['ami-us'], 'us-east-1'),
+        ])
+        self.assertEqual(self.service.copies, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import threading
+import unittest
+
+import mock
+
+import fedimg.tester
+
+
+class TestScheduler(unittest.TestCase):
+    """ This tests fedimg/tester.py. """
+
+    def setUp(self):
+        self.scheduler = fedimg.tester.TestScheduler(processes=2)
+
+    def test_concurrent(self):
+        # Both tests have to be running at once for either to finish
+        started = {'a': threading.Event(), 'b': threading.Event()}
+
+        def test(name):
+            started[name].set()
+            other = 'b' if name == 'a' else 'a'
+            if not started[other].wait(5):
+                raise Exception('{0} ran alone'.format(name))
+            return name
+
+        results = [self.scheduler.submit(test, name) for name in 'ab']
+        self.assertEqual([r.get(5) for r in results], ['a', 'b'])
+
+    def test_failure(self):
+        def test():
+            raise ValueError('boom')
+
+        result = self.scheduler.submit(test)
+        self.assertRaises(ValueError, result.get, 5)
+
+    def test_sample(self):
+        with mock.patch('fedimg.AWS_REGIONAL_TESTS', 2):
+            self.assertEqual(len(self.scheduler.sample(range(5))), 2)
+        self.assertEqual(sorted(self.scheduler.sample(range(3), 5)),
+                         [0, 1, 2])
+        self.assertEqual(self.scheduler.sample(range(3), 0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
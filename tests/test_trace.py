@@ -0,0 +1,153 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import fedimg.cancel
+import fedimg.trace
+import fedimg.uploader
+
+
+def background():
+    with fedimg.trace.span('background'):
+        pass
+
+
+class FakeJob(object):
+    file_name = 'Fedora-Cloud-Base-25-1.3.x86_64.raw.xz'
+
+    def __init__(self, region):
+        self.region = region
+
+    def upload(self, compose_meta):
+        driver = fedimg.trace.driver(mock.Mock(), self.region)
+        with fedimg.trace.span('build', region=self.region):
+            driver.deploy_node()
+        thread = threading.Thread(target=fedimg.trace.propagate(background))
+        thread.start()
+        thread.join()
+        return 0
+
+
+class TestTrace(unittest.TestCase):
+    """ This tests fedimg/trace.py. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        fedimg.trace._tracer = None
+
+    def tearDown(self):
+        fedimg.trace._tracer = None
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        with mock.patch('fedimg.TRACE_DIR', ''):
+            self.assertEqual(fedimg.trace.get_tracer(), None)
+            driver = mock.Mock()
+            self.assertTrue(fedimg.trace.driver(driver, 'eu-west-1')
+                            is driver)
+            with fedimg.trace.job('compose', 'job'):
+                with fedimg.trace.span('nothing'):
+                    pass
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_end(self):
+        tracer = fedimg.trace.Tracer(self.directory)
+        # Ending a trace that was never begun writes nothing
+        self.assertEqual(tracer.end('compose'), None)
+        tracer.begin('compose', 2)
+        self.assertEqual(tracer.end('compose'), None)
+        self.assertTrue(tracer.end('compose').startswith(self.directory))
+        self.assertEqual(tracer.end('compose'), None)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_chrome_events(self):
+        events = [{'name': 'build', 'cat': 'stage', 'start': 10.0,
+                   'end': 10.5, 'tid': 7, 'thread': 'Thread-1',
+                   'args': {'region': 'eu-west-1'}}]
+        result = fedimg.trace.chrome_events(events, pid=1)
+        self.assertEqual(result, [
+            {'name': 'build', 'cat': 'stage', 'ph': 'X', 'ts': 10000000,
+             'dur': 500000, 'pid': 1, 'tid': 7,
+             'args': {'region': 'eu-west-1'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 7,
+             'args': {'name': 'Thread-1'}},
+        ])
+
+    @mock.patch('fedimg.uploader.get_pool')
+    def test_upload(self, get_pool):
+        get_pool.return_value = fedimg.uploader.multiprocessing.pool \
+            .ThreadPool(processes=2)
+        providers = {'fake': lambda url: [FakeJob('eu-west-1'),
+                                          FakeJob('us-east-1')]}
+        with mock.patch('fedimg.TRACE_DIR', self.directory), \
+                mock.patch('fedimg.services.get_providers',
+                           return_value=providers):
+            results = fedimg.uploader.upload(
+                ['https://somepage.org/' + FakeJob.file_name],
+                {'compose_id': 'Fedora-25-20161201.0'})
+        self.assertEqual(results, [0, 0])
+
+        # One trace for the compose, once both jobs are done
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith('Fedora-25-20161201.0-'))
+        with open(os.path.join(self.directory, names[0])) as f:
+            trace = json.load(f)
+
+        spans = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(sorted(set(e['name'] for e in spans)),
+                         ['background', 'build', 'deploy_node', 'job',
+                          'queued'])
+        job = 'fake Fedora-Cloud-Base-25-1.3.x86_64.raw.xz'
+        self.assertTrue(all(e['args']['job'] == job for e in spans))
+        api = [e for e in spans if e['cat'] == 'api']
+        self.assertEqual(sorted(e['args']['region'] for e in api),
+                         ['eu-west-1', 'us-east-1'])
+        self.assertTrue(any(e['ph'] == 'M' for e in trace['traceEvents']))
+
+    def test_skipped(self):
+        token = fedimg.cancel.Token()
+        token.cancel('superseded')
+        with mock.patch('fedimg.TRACE_DIR', self.directory):
+            tracer = fedimg.trace.get_tracer()
+            tracer.begin('compose', 2)
+            result = fedimg.uploader._run('fake', FakeJob('eu-west-1'),
+                                          None, 'compose', token)
+            self.assertEqual(result, 1)
+            self.assertEqual(os.listdir(self.directory), [])
+            fedimg.uploader._run('fake', FakeJob('eu-west-1'), None,
+                                 'compose')
+
+        # The job that never started still counts as done
+        self.assertEqual(tracer.pending, {})
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,19 +20,225 @@
 #
 
 import mock
+import threading
 import unittest
 
+import fedimg.services
 import fedimg.uploader
 
 
+class FakeJob(object):
+
+    def __init__(self, url, result=0, gate=None):
+        self.url = url
+        self.result = result
+        self.gate = gate
+
+    def upload(self, compose_meta):
+        if self.gate is not None:
+            self.gate.wait()
+        if self.result is None:
+            raise Exception('Boom')
+        return self.result
+
+
 class TestUploader(unittest.TestCase):
     """ This tests fedimg/uploader.py. """
 
     def setUp(self):
-        pass
+        self.gate = threading.Event()
+        self.providers = {
+            'fast': lambda url: [FakeJob(url), FakeJob(url, result=1)],
+            'slow': lambda url: [FakeJob(url, gate=self.gate)],
+            'broken': lambda url: [FakeJob(url, result=None)],
+        }
+        patchers = [
+            mock.patch('fedimg.services.get_providers',
+                       return_value=self.providers),
+            mock.patch('fedimg.PROVIDER_CONCURRENCY', {'slow': 1}),
+            mock.patch('fedimg.uploader._pools', {}),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.gate.set()
+
+    def test_upload(self):
+        self.gate.set()
+        results = fedimg.uploader.upload(['a.raw.xz', 'b.raw.xz'], None)
+        # broken, fast and slow jobs for each image, in provider order
+        self.assertEqual(results, [1, 0, 1, 0] * 2)
+
+    def test_slow_provider(self):
+        results = fedimg.uploader.upload(['a.raw.xz', 'b.raw.xz'], None,
+                                         wait=False)
+        slow = [results[3], results[7]]
+        others = [r for r in results if r not in slow]
+
+        # The slow provider doesn't hold up the others
+        self.assertEqual([r.get(5) for r in others], [1, 0, 1] * 2)
+        self.assertFalse(any(r.ready() for r in slow))
+
+        self.gate.set()
+        self.assertEqual([r.get(5) for r in slow], [0, 0])
+
+    def test_checksums(self):
+        self.providers['fast'] = lambda url: [FakeJob(url)]
+        FakeJob.checksum = None
+        self.addCleanup(delattr, FakeJob, 'checksum')
+        jobs = fedimg.uploader._jobs(['a.raw.xz', 'b.raw.xz'],
+                                     {'a.raw.xz': 'abc'})
+        self.assertEqual([(j.url, j.checksum) for name, url, j in jobs],
+                         [('a.raw.xz', 'abc')] * 3 + [('b.raw.xz', None)] * 3)
+
+
+class CancellableJob(FakeJob):
+    """ A job that runs until it's cancelled, with a state to resume. """
+
+    def __init__(self, url, state=None):
+        super(CancellableJob, self).__init__(url)
+        self.file_name = url
+        self.cancel = None
+        self.state = state
+        self.resumed = None
+
+    def upload(self, compose_meta):
+        self.cancel.sleep(5)
+        return 0
+
+    def checkpoint(self):
+        return self.state
+
+    def resume(self, state, compose_meta):
+        self.resumed = state
+        return 0
+
+
+class TestDrain(unittest.TestCase):
+    """ This tests the shutdown path of fedimg/uploader.py. """
+
+    def setUp(self):
+        self.gate = threading.Event()
+        self.jobs = []
+
+        def cancellable(url):
+            job = CancellableJob(url, state={'copies': [url]})
+            self.jobs.append(job)
+            return [job]
+
+        self.providers = {
+            'slow': lambda url: [FakeJob(url, gate=self.gate)],
+            'long': cancellable,
+        }
+        self.ledger = mock.Mock()
+        patchers = [
+            mock.patch('fedimg.services.get_providers',
+                       return_value=self.providers),
+            mock.patch('fedimg.PROVIDER_CONCURRENCY', {}),
+            mock.patch('fedimg.uploader._pools', {}),
+            mock.patch('fedimg.uploader._running', {}),
+            mock.patch('fedimg.uploader._draining', threading.Event()),
+            mock.patch('fedimg.uploader._groups', {}),
+            mock.patch('fedimg.ledger.get_ledger',
+                       return_value=self.ledger),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
 
     def tearDown(self):
-        pass
+        self.gate.set()
+
+    def handed_off(self):
+        return sorted((c[0][1], c[0][5])
+                      for c in self.ledger.checkpoint.call_args_list)
+
+    def test_drain(self):
+        self.providers.pop('long')
+        results = fedimg.uploader.upload(['a.raw.xz', 'b.raw.xz'], None,
+                                         wait=False)
+
+        # The job that finishes within the grace period isn't handed off,
+        # nor is the one queued behind it on the provider's pool run
+        threading.Timer(0.1, self.gate.set).start()
+        fedimg.uploader.drain(grace=5)
+        self.assertEqual(results[0].get(1), 0)
+        self.assertEqual(self.handed_off(), [('b.raw.xz', None)])
+
+        # Nothing new is taken
+        self.assertEqual(fedimg.uploader.upload(['c.raw.xz'], None), [])
+        self.assertEqual(self.handed_off(), [('b.raw.xz', None),
+                                             ('c.raw.xz', None)])
+
+    def test_drain_cancels(self):
+        self.providers.pop('slow')
+        results = fedimg.uploader.upload(['a.raw.xz'], {'compose_id': 'F'},
+                                         wait=False)
+        while not self.jobs[0].cancel.started:
+            self.gate.wait(0.01)
+
+        # Cancelled when the grace period is up, and handed off with the
+        # state it can be resumed from
+        fedimg.uploader.drain(grace=0.1)
+        self.assertEqual(results[0].get(1), 1)
+        self.ledger.checkpoint.assert_called_once_with(
+            'long', 'a.raw.xz', 'long a.raw.xz', {'compose_id': 'F'}, None,
+            {'copies': ['a.raw.xz']})
+
+    def test_resume(self):
+        results = fedimg.uploader.resume([
+            {'provider': 'long', 'url': 'a.raw.xz', 'label': 'long a.raw.xz',
+             'compose': None, 'checksum': None, 'state': {'copies': []}},
+            {'provider': 'gone', 'url': 'a.raw.xz', 'label': 'gone a.raw.xz',
+             'compose': None, 'checksum': None, 'state': None},
+        ])
+        self.assertEqual([r.get(5) for r in results], [0])
+        self.assertEqual(self.jobs[0].resumed, {'copies': []})
+
+    @mock.patch('fedimg.uploader.time.time')
+    def test_find_job_together(self, time):
+        def variants(url):
+            share = object()
+            jobs = [CancellableJob(url) for i in range(3)]
+            for job, virt_type in zip(jobs, ('hvm', 'pv', 'arm')):
+                job.virt_type = virt_type
+                job.share = share
+            return jobs
+        self.providers['variants'] = variants
+        time.return_value = 0
+
+        # The jobs of an image picked up one at a time share what they
+        # would have shared if they had been made together
+        hvm = fedimg.uploader.find_job('variants', 'a.raw.xz',
+                                       'variants a.raw.xz hvm')
+        pv = fedimg.uploader.find_job('variants', 'a.raw.xz',
+                                      'variants a.raw.xz pv')
+        self.assertIs(hvm.share, pv.share)
+        # Each job is only handed out once
+        again = fedimg.uploader.find_job('variants', 'a.raw.xz',
+                                         'variants a.raw.xz hvm')
+        self.assertIsNot(again, hvm)
+        self.assertIsNot(again.share, hvm.share)
+
+        # Until the rest of the image's jobs are forgotten
+        time.return_value = fedimg.uploader.GROUP_TTL + 1
+        arm = fedimg.uploader.find_job('variants', 'a.raw.xz',
+                                       'variants a.raw.xz arm')
+        self.assertIsNot(arm.share, again.share)
+        self.assertEqual(fedimg.uploader._groups.keys(),
+                         [('variants', 'a.raw.xz')])
+
+
+class TestServices(unittest.TestCase):
+    """ This tests fedimg/services/__init__.py. """
+
+    def test_get_providers(self):
+        with mock.patch('fedimg.FTP_TARGET_DIR', None):
+            providers = fedimg.services.get_providers(['ftp', 'nope'])
+            self.assertEqual(sorted(providers), ['ftp'])
+            self.assertEqual(providers['ftp']('a.raw.xz'), [])
 
 if __name__ == '__main__':
     unittest.main()
@@ -100,6 +100,51 @@ class TestUtil(unittest.TestCase):
         vtypes = fedimg.util.virt_types_from_url(url)
         self.assertEqual(vtypes, ['hvm'])
 
+    def test_compose_id_from_image(self):
+        name = 'Fedora-Cloud-Base-26-20170601.n.0.x86_64.raw.xz'
+        self.assertEqual(fedimg.util.compose_id_from_image(name),
+                         'Fedora-26-20170601.n.0')
+        name = 'Fedora-Atomic-Rawhide-20170601.n.1.x86_64.raw.xz'
+        self.assertEqual(fedimg.util.compose_id_from_image(name),
+                         'Fedora-Rawhide-20170601.n.1')
+        name = 'Fedora-Cloud-Base-25-1.3.x86_64.raw.xz'
+        self.assertEqual(fedimg.util.compose_id_from_image(name), None)
+
+    def test_build_series(self):
+        self.assertEqual(
+            fedimg.util.build_series(
+                'Fedora-Cloud-Base-26-20170601.n.0.x86_64'),
+            ('Fedora-Cloud-Base-26-', '.x86_64'))
+        self.assertEqual(
+            fedimg.util.build_series(
+                'Fedora-Atomic-Rawhide-20170601.n.1.i386'),
+            ('Fedora-Atomic-Rawhide-', '.i386'))
+        self.assertEqual(
+            fedimg.util.build_series('Fedora-Cloud-Base-25-1.3.x86_64'),
+            ('Fedora-Cloud-Base-25-', '.x86_64'))
+        self.assertEqual(fedimg.util.build_series('Something'), None)
+
+    def test_build_key(self):
+        self.assertEqual(
+            fedimg.util.build_key('Fedora-Cloud-Base-26-20170601.n.1.x86_64'),
+            (20170601, 1))
+        self.assertEqual(
+            fedimg.util.build_key('Fedora-Cloud-Base-25-1.3.x86_64'), (1, 3))
+        self.assertEqual(fedimg.util.build_key('Something'), None)
+        self.assertTrue(
+            fedimg.util.build_key('Fedora-Atomic-Rawhide-20170601.n.10.i386') >
+            fedimg.util.build_key('Fedora-Atomic-Rawhide-20170601.n.9.i386'))
+
+    def test_early_image(self):
+        patterns = ['Fedora-Cloud-Base-*.x86_64.raw.xz']
+        with mock.patch('fedimg.EARLY_INTAKE_PATTERNS', patterns):
+            self.assertTrue(fedimg.util.early_image(
+                'Fedora-Cloud-Base-26-20170601.n.0.x86_64.raw.xz'))
+            self.assertFalse(fedimg.util.early_image(
+                'Fedora-Cloud-Base-26-20170601.n.0.i386.raw.xz'))
+            self.assertFalse(fedimg.util.early_image(
+                'Fedora-Atomic-26-20170601.n.0.x86_64.raw.xz'))
+
 
 if __name__ == '__main__':
     unittest.main()